@@ -34,6 +34,10 @@ dirtreedigest - Generates cryptographic digests and collects stats across a dire
 
 dirtreecmp - Compares two dirtreedigest reports
 
+dirtreeconv - Converts reports between the text (.thd) and binary (.thdx) formats
+
+dirtreebench - Benchmarks the digester on synthetic trees
+
 For Windows, OS X, and Linux
     """,
     'keywords': 'directory digest hashing integrity filesystem checksums',
@@ -55,6 +59,8 @@ For Windows, OS X, and Linux
         'console_scripts': [
             'dirtreedigest=dirtreedigest.main_digest:main',
             'dirtreecmp=dirtreedigest.main_compare:main',
+            'dirtreeconv=dirtreedigest.main_convert:main',
+            'dirtreebench=dirtreedigest.main_bench:cli',
         ],
     },
     'install_requires': [],
@@ -70,12 +76,38 @@ CONTROL_DATA = {
     'outfile_ext': 'thd',
     'outfile_name': None,
     'altfile_name': None,
+    'thdx_name': None,
+    'thdx_writer': None,
+    'report_flush_secs': 5.0,
+    'report_fsync': 'none',
+    'report_writer': None,
+    'alt_writer': None,
+    'tree_digests': None,
     'logfile_ext': 'log',
     'shm_mode': True,
+    'mmap_mode': False,
+    'low_impact': False,
     'max_concurrent_jobs': 32,
     'max_buffers': 4,
     'max_block_size_mb': 16,
     'max_block_size': None,
+    'min_block_size_kb': 64,
+    'min_block_size': None,
+    'buffer_memory_mb': 0,
+    'buffer_memory': None,
+    'inline_max_size_kb': 64,
+    'inline_max_size': None,
+    'cache_file': None,
+    'cache_max_age_days': 90,
+    'cache_max_size_mb': 512,
+    'digest_cache': None,
+    'walk_threads': 4,
+    'walk_prefetch': 256,
+    'walk_stats': None,
+    'progress_secs': 0,
+    'progress_format': 'auto',
+    'progress_prescan': False,
+    'progress': None,
     'ignore_path_case': False,
     'ignored_files': None,
     'ignored_dirs': None,
@@ -85,20 +117,42 @@ CONTROL_DATA = {
         'ignored': 0,
         'errors': 0,
         'bytes_read': 0,
+        'bytes_copied': 0,
+        'hole_bytes': 0,
+        'queue_messages': 0,
+        'cache_hits': 0,
     },
     'altfile_digest': None,
-    'buffer_blocks': None,
-    'buffer_names': None,
-    'buffer_sizes': None,
+    'buffer_sems': None,
     'default_digests': None,
     'selected_digests': [],
+    'calibrate': False,
+    'calibration_file': None,
+    'worker_digests': None,
+    'pipeline_depth': 1,
+    'engine': 'processes',
+    'digest_engine': None,
+    'file_pool_size': 0,
+    'file_pool_max_size_mb': 64,
+    'file_pool_max_size': None,
+    'file_pool': None,
     'reader_proc': None,
     'reader_cmd_queue': None,
-    'reader_results_queue': None,
     'worker_procs': None,
     'worker_cmd_queues': None,
-    'worker_results_queue': None,
+    'results_queue': None,
     'debug_queue': None,
+    'subproc_log_level': None,
+    'proc_stats': None,
+    'stage_times': None,
+    'profile_prefix': None,
+    'update_file': None,
+    'update_report': None,
+    'report_parsers': 0,
+    'compare_memory_mb': 0,
+    'temp_dir': None,
+    'bloom_filter': False,
+    'full_compare': False,
     'root_dir': None,
 }
 
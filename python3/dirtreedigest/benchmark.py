@@ -0,0 +1,372 @@
+"""
+
+    Copyright (c) 2017-2021 Martin F. Falatic
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    End-to-end digester benchmarks
+
+    Synthetic trees are generated once (deterministically, from a seed) and
+    reused. Each benchmark case runs the digester in a fresh process over
+    one tree with one combination of options, and records its throughput,
+    CPU time and peak RSS. Cold runs first evict the tree from the page
+    cache and age its access times, then record how much the page cache
+    grew and how many access times the run touched. Results are saved as
+    JSON, and a previous results file serves as the baseline for spotting
+    regressions.
+
+"""
+
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+
+import dirtreedigest.utils as dtutils
+
+RESULTS_VERSION = 1
+TREE_VERSION = 1
+
+# Tree shapes: dirs top-level directories, each a chain of depth nested
+# levels holding files files of min_size..max_size bytes. The scale factor
+# multiplies the 'scaled' parameter (for 'size', both sizes, and the hole
+# spacing). Files with hole_every are sparse: only the first 1/16th of each
+# hole_every bytes (up to a data pool's worth) is data, and the rest is a hole.
+TREE_PROFILES = {
+    'tiny': {'dirs': 100, 'depth': 1, 'files': 100, 'min_size': 0, 'max_size': 4096, 'scaled': 'dirs'},
+    'huge': {'dirs': 1, 'depth': 1, 'files': 4, 'min_size': 64 << 20, 'max_size': 64 << 20, 'scaled': 'size'},
+    'deep': {'dirs': 4, 'depth': 64, 'files': 4, 'min_size': 0, 'max_size': 65536, 'scaled': 'dirs'},
+    'wide': {'dirs': 1, 'depth': 1, 'files': 10000, 'min_size': 0, 'max_size': 16384, 'scaled': 'files'},
+    'sparse': {'dirs': 1, 'depth': 1, 'files': 4, 'min_size': 256 << 20, 'max_size': 256 << 20, 'scaled': 'size',
+               'hole_every': 16 << 20},
+}
+
+# Random data that file contents are cut from
+DATA_POOL_SIZE = 1024 * 1024
+
+# Default regression thresholds: how many percent worse than the baseline a metric may get
+THRESHOLDS = {
+    'mb_per_s': 10.0,
+    'files_per_s': 10.0,
+    'cpu_s': 15.0,
+    'peak_rss_mb': 20.0,
+}
+
+# Whether more of a metric is better
+HIGHER_IS_BETTER = {
+    'mb_per_s': True,
+    'files_per_s': True,
+    'cpu_s': False,
+    'peak_rss_mb': False,
+}
+
+# Runs the digester in a fresh interpreter, with the rest of the command line as its arguments
+RUN_DIGEST = 'import sys; import dirtreedigest.main_digest as m; sys.exit(1 if m.main() is False else 0)'
+
+# For writer.summary_line and main_digest's timing line
+SUMMARY_RE = re.compile(
+    r'Processed: ([\d,]+) file\(s\), ([\d,]+) folder\(s\) \(([\d,]+) ignored, ([\d,]+) errors\) '
+    r'comprising ([\d,]+) bytes')
+RUN_TIME_RE = re.compile(r'run_time= ([\d.]+)s walk_time= ([\d.]+)s')
+HOLE_BYTES_RE = re.compile(r'hole_bytes= (\d+)')
+
+# Where the page cache's size can be read (Linux)
+MEMINFO_FILE = '/proc/meminfo'
+
+
+def tree_shape(profile, scale=1.0):
+    """ A profile's parameters with the scale factor applied """
+    shape = dict(TREE_PROFILES[profile])
+    scaled = shape.pop('scaled')
+    if scaled == 'size':
+        shape['min_size'] = int(shape['min_size'] * scale)
+        shape['max_size'] = int(shape['max_size'] * scale)
+        if 'hole_every' in shape:
+            shape['hole_every'] = max(16, int(shape['hole_every'] * scale))
+    else:
+        shape[scaled] = max(1, round(shape[scaled] * scale))
+    return shape
+
+
+def make_tree(root, profile, scale=1.0, seed=0):
+    """ Generate a synthetic tree at root (which mustn't exist yet); returns its manifest """
+    shape = tree_shape(profile, scale)
+    rnd = random.Random(seed)
+    pool = rnd.getrandbits(8 * DATA_POOL_SIZE).to_bytes(DATA_POOL_SIZE, 'little')
+    pool += pool  # Any slice of up to DATA_POOL_SIZE can start anywhere in the first half
+    manifest = {
+        'version': TREE_VERSION,
+        'profile': profile,
+        'scale': scale,
+        'seed': seed,
+        'dirs': 0,
+        'files': 0,
+        'bytes': 0,
+    }
+    os.makedirs(root)
+    for dir_index in range(shape['dirs']):
+        level_path = root
+        for level in range(shape['depth']):
+            level_path = os.path.join(level_path, f'd{dir_index:04d}' if level == 0 else f'l{level:03d}')
+            os.mkdir(level_path)
+            manifest['dirs'] += 1
+            for file_index in range(shape['files']):
+                size = rnd.randint(shape['min_size'], shape['max_size'])
+                if shape.get('hole_every'):
+                    _write_sparse(os.path.join(level_path, f'f{file_index:05d}'), size, pool, shape['hole_every'])
+                else:
+                    _write_data(os.path.join(level_path, f'f{file_index:05d}'), size, pool, rnd)
+                manifest['files'] += 1
+                manifest['bytes'] += size
+    return manifest
+
+
+def _write_data(filename, size, pool, rnd):
+    """ Write size bytes of pool data; past a pool's worth, each block is numbered so none repeat """
+    with open(filename, 'wb') as fileh:
+        if size <= DATA_POOL_SIZE:
+            start = rnd.randrange(DATA_POOL_SIZE)
+            fileh.write(pool[start:start + size])
+            return
+        block = bytearray(pool[:DATA_POOL_SIZE])
+        for (block_index, pos) in enumerate(range(0, size, DATA_POOL_SIZE)):
+            block[:8] = block_index.to_bytes(8, 'little')
+            fileh.write(block[:size - pos])
+
+
+def _write_sparse(filename, size, pool, hole_every):
+    """ Write size bytes, a numbered run of pool data at the start of every hole_every bytes and holes between """
+    data_size = min(hole_every // 16, DATA_POOL_SIZE)
+    with open(filename, 'wb') as fileh:
+        for (run_index, pos) in enumerate(range(0, size, hole_every)):
+            fileh.seek(pos)
+            run = bytearray(pool[run_index % DATA_POOL_SIZE:][:min(data_size, size - pos)])
+            run[:8] = run_index.to_bytes(8, 'little')[:len(run)]
+            fileh.write(run)
+        fileh.truncate(size)
+
+
+def ensure_tree(workdir, profile, scale=1.0, seed=0):
+    """ The root and manifest of a generated tree in workdir, generating it unless it's already there """
+    root = os.path.join(workdir, f'{profile}-x{scale:g}-s{seed}')
+    manifest_name = root + '.json'
+    try:
+        with open(manifest_name, 'r', encoding='utf-8') as fileh:
+            manifest = json.load(fileh)
+        if manifest['version'] == TREE_VERSION and os.path.isdir(root):
+            return (root, manifest)
+    except (OSError, ValueError, KeyError):
+        pass
+    shutil.rmtree(root, ignore_errors=True)
+    manifest = make_tree(root, profile, scale, seed)
+    with open(manifest_name, 'w', encoding='utf-8') as fileh:
+        json.dump(manifest, fileh)
+    return (root, manifest)
+
+
+def expand_matrix(shm_modes, buffers, block_sizes, digest_sets, extra_args=(), low_impact_modes=(False,)):
+    """ The digester arguments for every combination of the matrix axes """
+    cases = []
+    for (shm, buffer_count, block_size, digests, low_impact) in itertools.product(
+            shm_modes, buffers, block_sizes, digest_sets, low_impact_modes):
+        args = ['--digests', digests, '--buffers', str(buffer_count), '--blocksize', str(block_size)]
+        if not shm:
+            args.append('--noshm')
+        if low_impact:
+            args.append('--low-impact')
+        cases.append(args + list(extra_args))
+    return cases
+
+
+def case_id(tree, args):
+    """ What identifies a case between runs (and against a baseline) """
+    return ' '.join([tree] + list(args))
+
+
+def page_cache_mb():
+    """ How much the page cache holds, in MB, or None where that can't be found out """
+    try:
+        with open(MEMINFO_FILE, 'r', encoding='ascii') as fileh:
+            for line in fileh:
+                if line.startswith('Cached:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def chill_tree(root):
+    """ Make a tree look unread: out of the page cache, and each file's atime before its mtime
+        (which a read updates even with relatime). Returns {path: atime_ns} for count_touched
+    """
+    atimes = {}
+    for (dirpath, _, filenames) in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            mtime_ns = os.stat(path).st_mtime_ns
+            atimes[path] = mtime_ns - 1000000000
+            os.utime(path, ns=(atimes[path], mtime_ns))
+            if hasattr(os, 'posix_fadvise'):
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+                finally:
+                    os.close(fd)
+    return atimes
+
+
+def count_touched(atimes):
+    """ How many of chill_tree's files have had their atime changed since """
+    return sum(1 for (path, atime_ns) in atimes.items() if os.stat(path).st_atime_ns != atime_ns)
+
+
+def run_digest(root, args, rundir, cold=False):
+    """ Run the digester over root once, in a fresh process; returns its measurements
+        A cold run chills the tree first, and measures page cache growth and atimes touched
+    """
+    (atimes, cache_mb) = (chill_tree(root), page_cache_mb()) if cold else (None, None)
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = package_dir
+    if os.environ.get('PYTHONPATH'):
+        env['PYTHONPATH'] += os.pathsep + os.environ['PYTHONPATH']
+    cmd = [sys.executable, '-c', RUN_DIGEST, root, '--title', 'bench', '--tstamp', '0'] + list(args)
+    start_time = dtutils.curr_time_secs()
+    proc = subprocess.Popen(cmd, cwd=rundir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    (cpu_s, peak_rss_mb) = (None, None)
+    if hasattr(os, 'wait4'):
+        # Unlike RUSAGE_CHILDREN, this covers just this run (and the workers it waited for)
+        (_, status, rusage) = os.wait4(proc.pid, 0)
+        proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+        cpu_s = rusage.ru_utime + rusage.ru_stime
+        peak_rss_mb = rusage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)  # Else it's in KB
+    else:
+        proc.wait()
+    wall_s = dtutils.curr_time_secs() - start_time
+    result = {
+        'returncode': proc.returncode,
+        'wall_s': wall_s,
+        'run_s': None,
+        'walk_s': None,
+        'cpu_s': cpu_s,
+        'peak_rss_mb': peak_rss_mb,
+        'files': None,
+        'bytes': None,
+        'errors': None,
+        'hole_bytes': None,
+        'cache_growth_mb': None,
+        'atimes_touched': None,
+    }
+    if cold:
+        if cache_mb is not None:
+            result['cache_growth_mb'] = page_cache_mb() - cache_mb
+        result['atimes_touched'] = count_touched(atimes)
+    report_name = os.path.join(rundir, 'bench.0.thd')
+    log_name = os.path.join(rundir, 'bench.0.log')
+    if os.path.exists(report_name):
+        match = SUMMARY_RE.search(dtutils.read_report_footer(report_name)['summary'] or '')
+        if match:
+            (files, _, _, errors, bytes_read) = (int(value.replace(',', '')) for value in match.groups())
+            result.update(files=files, bytes=bytes_read, errors=errors)
+    if os.path.exists(log_name):
+        with open(log_name, 'r', encoding='utf-8') as fileh:
+            log_text = fileh.read()
+        match = RUN_TIME_RE.search(log_text)
+        if match:
+            (result['run_s'], result['walk_s']) = (float(match.group(1)), float(match.group(2)))
+        match = HOLE_BYTES_RE.search(log_text)
+        if match:
+            result['hole_bytes'] = int(match.group(1))
+    for filename in os.listdir(rundir):
+        if filename.startswith('bench.0.'):
+            os.remove(os.path.join(rundir, filename))
+    return result
+
+
+def run_case(tree, root, args, rundir, repeat=1, cold=False):
+    """ Run a case repeat times and keep the fastest run, along with every run's wall time """
+    logger = logging.getLogger('benchmark')
+    runs = [run_digest(root, args, rundir, cold) for _ in range(repeat)]
+    best = min(runs, key=lambda run: run['wall_s'])
+    case = {'id': case_id(tree, args), 'tree': tree, 'args': list(args)}
+    case.update(best)
+    case['wall_s_runs'] = [run['wall_s'] for run in runs]
+    # Rates are over the walk where the log gave it (as main_digest's rate=), leaving out process start-up
+    secs = best['walk_s'] or best['wall_s']
+    case['mb_per_s'] = (best['bytes'] or 0) / (1024 * 1024) / secs if secs > 0 else None
+    case['files_per_s'] = (best['files'] or 0) / secs if secs > 0 else None
+    if best['returncode']:
+        logger.error('%s: digester failed (exit status %d)', case['id'], best['returncode'])
+    else:
+        logger.info('%s: %s', case['id'], format_case(case))
+    return case
+
+
+def format_case(case):
+    """ One line of a case's key numbers """
+    def fmt(value, spec):
+        return 'n/a' if value is None else format(value, spec)
+    return 'MB/s= {} files/s= {} wall= {}s cpu= {}s peak_rss= {} MB errors= {}'.format(
+        fmt(case['mb_per_s'], '.1f'),
+        fmt(case['files_per_s'], '.0f'),
+        fmt(case['wall_s'], '.3f'),
+        fmt(case['cpu_s'], '.3f'),
+        fmt(case['peak_rss_mb'], '.1f'),
+        fmt(case['errors'], 'd')) + (
+        ' holes= {:.1f} MB'.format(case['hole_bytes'] / 1024 / 1024) if case.get('hole_bytes') else '') + (
+        ' cache+= {} MB atimes_touched= {}'.format(
+            fmt(case['cache_growth_mb'], '.1f'), case['atimes_touched'])
+        if case.get('atimes_touched') is not None else '')
+
+
+def new_results(scale, seed):
+    """ An empty results document, describing the machine it's from """
+    return {
+        'version': RESULTS_VERSION,
+        'created': dtutils.datetime_as_str(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'scale': scale,
+        'seed': seed,
+        'cases': [],
+    }
+
+
+def compare_to_baseline(results, baseline, thresholds=None):
+    """ Metrics that got worse than the baseline by more than their threshold
+
+        Cases are matched by id; those only in one of the two are left out.
+        Returns [(case_id, metric, baseline value, new value, percent worse)].
+    """
+    thresholds = dict(THRESHOLDS, **(thresholds or {}))
+    baseline_cases = {case['id']: case for case in baseline['cases']}
+    regressions = []
+    for case in results['cases']:
+        base_case = baseline_cases.get(case['id'])
+        if not base_case:
+            continue
+        for (metric, threshold) in sorted(thresholds.items()):
+            (old, new) = (base_case.get(metric), case.get(metric))
+            if not old or new is None:
+                continue
+            worse = 100.0 * ((old - new) if HIGHER_IS_BETTER[metric] else (new - old)) / old
+            if worse > threshold:
+                regressions.append((case['id'], metric, old, new, worse))
+    return regressions
@@ -0,0 +1,168 @@
+"""
+
+    Copyright (c) 2017-2021 Martin F. Falatic
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+"""
+
+import logging
+import os
+import sqlite3
+import sys
+import time
+
+CACHE_FILE_NAME = 'digests.sqlite'
+
+# Files modified this recently may still change within the same timestamp tick, so they aren't cached
+RACY_SECS = 2.0
+
+# Pending cache writes are committed in batches of this many
+COMMIT_ROWS = 4096
+
+
+def default_cache_file():
+    """ The per-user cache location for the platform """
+    if sys.platform == 'win32':
+        cache_dir = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    elif sys.platform == 'darwin':
+        cache_dir = os.path.expanduser('~/Library/Caches')
+    else:
+        cache_dir = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    return os.path.join(cache_dir, 'dirtreedigest', CACHE_FILE_NAME)
+
+
+def cache_key(stats):
+    """ Identify a file's content by where it lives and when it last changed
+        Returns None where the filesystem doesn't supply inode numbers
+    """
+    if not stats.st_ino:
+        return None
+    return (stats.st_dev, stats.st_ino, stats.st_size, stats.st_mtime_ns, stats.st_ctime_ns)
+
+
+class DigestCache(object):
+    """ Persistent digests shared between runs, roots and concurrent jobs
+
+        Digests are stored per algorithm under the file's device, inode,
+        size and nanosecond mtime/ctime, so an unchanged file is recognized
+        by its stat alone wherever it's reached from. Entries not used for
+        max_age_secs are dropped at close, as are the least recently used
+        ones while the database exceeds max_size bytes.
+    """
+
+    def __init__(self, filename, max_age_secs, max_size):
+        self.logger = logging.getLogger('cache')
+        self.filename = filename
+        self.max_age_secs = max_age_secs
+        self.max_size = max_size
+        self.now = int(time.time())
+        self.updates = {}
+        self.touched = []
+        cache_dir = os.path.dirname(filename)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.conn = sqlite3.connect(filename, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS digests ('
+            'dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, ctime_ns INTEGER, '
+            'digest_name TEXT, digest_value TEXT, last_used INTEGER, '
+            'PRIMARY KEY (dev, ino, size, mtime_ns, ctime_ns, digest_name)) WITHOUT ROWID')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS digests_last_used ON digests (last_used)')
+        self.conn.commit()
+
+    def lookup(self, key, digest_names):
+        """ Return the cached digests for key if all of digest_names are there, else None """
+        if key is None:
+            return None
+        if key in self.updates:  # e.g., a hard link to a file seen earlier in this run
+            found = self.updates[key]
+            stale = False
+        else:
+            rows = self.conn.execute(
+                'SELECT digest_name, digest_value, last_used FROM digests '
+                'WHERE dev=? AND ino=? AND size=? AND mtime_ns=? AND ctime_ns=?', key).fetchall()
+            found = {digest_name: digest_value for (digest_name, digest_value, _) in rows}
+            stale = any(last_used < self.now for (_, _, last_used) in rows)
+        if not all(digest_name in found for digest_name in digest_names):
+            return None
+        if stale:
+            self.touched.append((self.now,) + key)
+            self._maybe_commit()
+        return {digest_name: found[digest_name] for digest_name in digest_names}
+
+    def store(self, key, digests):
+        """ Remember freshly computed digests for key """
+        if key is None or not digests:
+            return
+        if time.time() - key[3] / 1000000000 < RACY_SECS:
+            return
+        self.updates[key] = digests
+        self._maybe_commit()
+
+    def evict(self, now=None):
+        """ Drop entries by age, then the least recently used ones down to the size limit """
+        now = self.now if now is None else now
+        self.commit()
+        evicted = self.conn.execute('DELETE FROM digests WHERE last_used < ?', (now - self.max_age_secs,)).rowcount
+        used = self._used_bytes()
+        while used > self.max_size:
+            (rows,) = self.conn.execute('SELECT COUNT(*) FROM digests').fetchone()
+            if not rows:
+                break
+            excess = max(1, rows - int(rows * 0.9 * self.max_size / used))  # Leave some headroom
+            evicted += self.conn.execute(
+                'DELETE FROM digests WHERE (dev, ino, size, mtime_ns, ctime_ns, digest_name) IN '
+                '(SELECT dev, ino, size, mtime_ns, ctime_ns, digest_name FROM digests ORDER BY last_used LIMIT ?)',
+                (excess,)).rowcount
+            used = self._used_bytes()
+        self.conn.commit()
+        return evicted
+
+    def commit(self):
+        """ Write out pending inserts and usage updates """
+        if self.updates:
+            self.conn.executemany('INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (
+                key + (digest_name, digest_value, self.now)
+                for (key, digests) in self.updates.items()
+                for (digest_name, digest_value) in digests.items()))
+            self.updates = {}
+        if self.touched:
+            self.conn.executemany(
+                'UPDATE digests SET last_used=? '
+                'WHERE dev=? AND ino=? AND size=? AND mtime_ns=? AND ctime_ns=?', self.touched)
+            self.touched = []
+        self.conn.commit()
+
+    def close(self):
+        """ Commit, evict and close """
+        try:
+            evicted = self.evict()
+            if evicted:
+                self.logger.info('Evicted %d cached digests', evicted)
+        finally:
+            self.conn.close()
+
+    def _maybe_commit(self):
+        """ Commit once enough changes have built up """
+        if len(self.updates) + len(self.touched) >= COMMIT_ROWS:
+            self.commit()
+
+    def _used_bytes(self):
+        """ Database size, not counting free pages """
+        (page_size,) = self.conn.execute('PRAGMA page_size').fetchone()
+        (page_count,) = self.conn.execute('PRAGMA page_count').fetchone()
+        (freelist_count,) = self.conn.execute('PRAGMA freelist_count').fetchone()
+        return (page_count - freelist_count) * page_size
@@ -0,0 +1,165 @@
+"""
+
+    Copyright (c) 2017-2021 Martin F. Falatic
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Digest calibration and packing digests onto workers
+
+    Every block goes to every worker, and the next block can't be handed
+    out until the slowest worker is done with the last one, so a worker
+    running only crc32 mostly waits on the one running sha3_512. Given
+    each digest's throughput on this host (measured once and saved), the
+    cheap digests are packed together into as few workers as will keep
+    up with the most expensive one, which keeps a worker to itself.
+
+"""
+
+import json
+import logging
+import os
+import platform
+
+import dirtreedigest.cache as dtcache
+import dirtreedigest.digester as dtdigester
+import dirtreedigest.utils as dtutils
+
+CALIBRATION_FILE_NAME = 'calibration.json'
+CALIBRATION_VERSION = 1
+
+# Each digest hashes this much data, over and over, for at least this long
+CALIBRATION_SAMPLE_SIZE = 4 * 1024 * 1024
+CALIBRATION_SECS = 0.25
+
+
+def default_calibration_file():
+    """ The per-user calibration table, next to the digest cache """
+    return os.path.join(os.path.dirname(dtcache.default_cache_file()), CALIBRATION_FILE_NAME)
+
+
+def host_id():
+    """ What the figures are good for: the machine, and the Python doing the hashing """
+    return '{} {} {} {}'.format(
+        platform.node(), platform.machine(), platform.python_implementation(), platform.python_version())
+
+
+def measure_rate(digest_func, sample, min_secs=CALIBRATION_SECS):
+    """ MB/s that digest_func's digest hashes sample at """
+    digest_instance = digest_func()
+    digest_instance.update(sample)  # Warm up
+    passes = 0
+    start_time = dtutils.curr_time_secs()
+    while True:
+        digest_instance.update(sample)
+        passes += 1
+        secs = dtutils.curr_time_secs() - start_time
+        if secs >= min_secs:
+            break
+    return passes * len(sample) / 1024 / 1024 / secs
+
+
+def calibrate(digest_names, sample_size=CALIBRATION_SAMPLE_SIZE, min_secs=CALIBRATION_SECS):
+    """ Measure each digest's MB/s on this host
+        Returns {digest_name: mb_per_s}
+    """
+    sample = os.urandom(sample_size)
+    return {
+        digest_name: measure_rate(dtdigester.DIGEST_FUNCTIONS[digest_name]['entry'], sample, min_secs)
+        for digest_name in digest_names}
+
+
+def load_calibration(filename):
+    """ This host's saved {digest_name: mb_per_s}, or {} if there are none """
+    logger = logging.getLogger('calibrate')
+    try:
+        with open(filename, 'r', encoding='utf-8') as fileh:
+            table = json.load(fileh)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as err:
+        logger.warning('Ignoring calibration file %s: %s', filename, err)
+        return {}
+    if not isinstance(table, dict) or table.get('version') != CALIBRATION_VERSION:
+        return {}
+    return dict(table.get('hosts', {}).get(host_id(), {}).get('mb_per_s', {}))
+
+
+def save_calibration(filename, rates):
+    """ Merge this host's {digest_name: mb_per_s} into the calibration file """
+    table = {'version': CALIBRATION_VERSION, 'hosts': {}}
+    try:
+        with open(filename, 'r', encoding='utf-8') as fileh:
+            saved = json.load(fileh)
+        if isinstance(saved, dict) and saved.get('version') == CALIBRATION_VERSION:
+            table = saved
+    except (OSError, ValueError):
+        pass
+    host = table['hosts'].setdefault(host_id(), {'mb_per_s': {}})
+    host['mb_per_s'].update(rates)
+    host['updated'] = dtutils.datetime_as_str()
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    temp_name = f'{filename}.{os.getpid()}.tmp'
+    with open(temp_name, 'w', encoding='utf-8') as fileh:
+        json.dump(table, fileh, indent=2, sort_keys=True)
+    os.replace(temp_name, filename)
+
+
+def pack_digests(digest_names, rates, max_workers):
+    """ Group digests into workers, each taking about as long per block as the most expensive digest
+        Digests without a rate get a worker each. Returns a list of lists of digest names.
+    """
+    costs = {name: 1.0 / rates[name] for name in digest_names if rates.get(name, 0) > 0}
+    if not costs:
+        return [[name] for name in digest_names]
+    capacity = max(costs.values()) * (1 + 1e-9)
+    workers = []
+    loads = []
+    for name in sorted(digest_names, key=lambda name: costs.get(name, capacity), reverse=True):
+        cost = costs.get(name, capacity)
+        fits = [i for i in range(len(workers)) if loads[i] + cost <= capacity]
+        if fits:
+            i = fits[0]
+        elif len(workers) < max_workers:
+            workers.append([])
+            loads.append(0.0)
+            i = len(workers) - 1
+        else:
+            i = loads.index(min(loads))
+        workers[i].append(name)
+        loads[i] += cost
+    return workers
+
+
+def plan_workers(control_data):
+    """ Pack the selected digests onto workers using (and if need be, updating) the calibration table
+        Returns a list of lists of digest names, one per worker
+    """
+    logger = logging.getLogger('calibrate')
+    filename = control_data['calibration_file']
+    rates = {} if control_data['calibrate'] else load_calibration(filename)
+    missing = [name for name in control_data['selected_digests'] if name not in rates]
+    if missing:
+        logger.info('Calibrating: %s', ', '.join(missing))
+        measured = calibrate(missing)
+        rates.update(measured)
+        try:
+            save_calibration(filename, measured)
+            logger.info('Calibration saved: %s', filename)
+        except OSError as err:
+            logger.warning('Calibration not saved to %s: %s', filename, err)
+    for name in sorted(control_data['selected_digests'], key=lambda name: rates[name]):
+        logger.info('    %-10s %10.1f MB/s', name, rates[name])
+    workers = pack_digests(control_data['selected_digests'], rates, control_data['max_concurrent_jobs'])
+    for (i, names) in enumerate(workers):
+        logger.info('worker %d: %s', i, ', '.join(names))
+    return workers
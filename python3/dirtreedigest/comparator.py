@@ -17,14 +17,26 @@
 """
 
 import logging
+import tempfile
 
-from collections import defaultdict
+from array import array
 from datetime import datetime
 from enum import Enum
+from itertools import chain, groupby
+from operator import itemgetter
 
 import dirtreedigest.digester as dtdigester
+import dirtreedigest.extsort as dtextsort
+import dirtreedigest.thdx as dtthdx
 import dirtreedigest.utils as dtutils
 
+# Key hashes are taken to this many bits
+HASH_MASK = (1 << 64) - 1
+
+
+class ReportOrderError(ValueError):
+    """ A report's elements aren't in walk order """
+
 
 class DiffType(Enum):
     M_UNDEF = 0  # Undefined (error case)  # noqa: E221
@@ -35,12 +47,202 @@ class DiffType(Enum):
     M_DNSD  = 5  # Diff file Name, Same Data (Opposite and Same sides)  # noqa: E221
 
 
+class RowIndex(object):
+    """ Row numbers by key hash, in an open-addressed table of two flat arrays
+
+        At most 16 bytes per row, against ~100 for a dict of objects. Rows
+        are found by hash alone, so callers check each candidate's key.
+    """
+
+    def __init__(self, rows):
+        size = 1 << max(3, (2 * rows).bit_length())  # Under half full
+        self.mask = size - 1
+        self.slots = array('i', [-1]) * size
+        self.tags = array('I', [0]) * size
+
+    def add(self, key_hash, row):
+        """ File row under key_hash """
+        slot = key_hash & self.mask
+        while self.slots[slot] >= 0:
+            slot = (slot + 1) & self.mask
+        self.slots[slot] = row
+        self.tags[slot] = key_hash >> 32
+
+    def replace(self, key_hash, old_row, row):
+        """ File row in place of old_row, which was filed under key_hash """
+        slot = key_hash & self.mask
+        while self.slots[slot] != old_row:
+            slot = (slot + 1) & self.mask
+        self.slots[slot] = row
+
+    def rows(self, key_hash):
+        """ Yield the rows filed under key_hash (and any that only share its bits) """
+        (slots, tags, mask) = (self.slots, self.tags, self.mask)
+        tag = key_hash >> 32
+        slot = key_hash & mask
+        row = slots[slot]
+        while row >= 0:
+            if tags[slot] == tag:
+                yield row
+            slot = (slot + 1) & mask
+            row = slots[slot]
+
+
+class ReportTable(object):
+    """ The files of one report, as compact columns
+
+        Only what a comparison needs is kept: names (split into an interned
+        directory prefix and a utf-8 base name), integer mtimes and sizes,
+        and the one digest being compared as raw bytes. Rows are indexed by
+        full name and by digest once the report is loaded.
+
+        Files in subtrees known to be identical in the other report are only
+        kept as base names and digests, to be found by scan_skipped.
+    """
+
+    def __init__(self, digest_name, digest_width):
+        self.digest_name = digest_name
+        self.digest_width = digest_width
+        self.elements = 0
+        self.prefixes = []  # Interned 'dir/' parts of full names
+        self.prefix_index = {}
+        self.prefix_rows = array('I')
+        self.names = bytearray()
+        self.name_offsets = array('Q', [0])
+        self.mtimes = array('q')
+        self.sizes = array('q')
+        self.digests = bytearray()
+        self.odd_digests = {}  # Row: digest text that isn't a hex value (e.g., '!!!!' for an unreadable file)
+        self.dropped = set()  # Rows whose name turns up again later in the report
+        self.by_name = None
+        self.by_digest = None
+        self.skipped_files = 0
+        self.skipped_names = bytearray()
+        self.skipped_name_offsets = array('Q', [0])
+        self.skipped_digests = bytearray()
+        self.skipped_odd_digests = {}
+
+    def __len__(self):
+        return len(self.mtimes) - len(self.dropped)
+
+    def load(self, elements):
+        """ Add a report's elements, then index them """
+        for elem in elements:
+            self.add(elem)
+        self.finish()
+
+    def add(self, elem):
+        """ Add an element (counting directories, but keeping only files) """
+        self.elements += 1
+        if elem['type'] != 'F':
+            return
+        row = len(self.mtimes)
+        file_name = elem['file_name']
+        prefix = elem['full_name'][:len(elem['full_name']) - len(file_name)]
+        prefix_row = self.prefix_index.get(prefix)
+        if prefix_row is None:
+            prefix_row = self.prefix_index[prefix] = len(self.prefixes)
+            self.prefixes.append(prefix)
+        self.prefix_rows.append(prefix_row)
+        self.names += file_name.encode('utf-8')
+        self.name_offsets.append(len(self.names))
+        self.mtimes.append(int(elem['mtime'], 16))
+        self.sizes.append(int(elem['size'], 16))
+        self.digests += self._raw_digest(elem, row, self.odd_digests)
+
+    def add_skipped(self, elem):
+        """ Add an element from a subtree that's identical in the other report """
+        self.elements += 1
+        if elem['type'] != 'F':
+            return
+        self.skipped_names += elem['file_name'].encode('utf-8')
+        self.skipped_name_offsets.append(len(self.skipped_names))
+        self.skipped_digests += self._raw_digest(elem, self.skipped_files, self.skipped_odd_digests)
+        self.skipped_files += 1
+
+    def finish(self):
+        """ Index the rows once they've all been added """
+        self.prefix_index = None
+        self._index()
+
+    def rows(self):
+        """ Yield the live row numbers """
+        dropped = self.dropped
+        return (row for row in range(len(self.mtimes)) if row not in dropped)
+
+    def file_name(self, row):
+        return self.names[self.name_offsets[row]:self.name_offsets[row + 1]].decode('utf-8')
+
+    def full_name(self, row):
+        return self.prefixes[self.prefix_rows[row]] + self.file_name(row)
+
+    def digest(self, row):
+        """ The row's digest: raw bytes, or the text it was given as if that isn't hex """
+        if row in self.odd_digests:
+            return self.odd_digests[row]
+        return bytes(self.digests[row * self.digest_width:(row + 1) * self.digest_width])
+
+    def find_name(self, full_name):
+        """ The row with this full name, else None """
+        for row in self.by_name.rows(hash(full_name) & HASH_MASK):
+            if self.full_name(row) == full_name:
+                return row
+        return None
+
+    def find_digest(self, digest):
+        """ The rows with this digest """
+        return [row for row in self.by_digest.rows(hash(digest) & HASH_MASK) if self.digest(row) == digest]
+
+    def scan_skipped(self, digests):
+        """ The skipped files with any of these digests, in one pass over them: {digest: [file_name]} """
+        found = {}
+        if not digests:
+            return found
+        width = self.digest_width
+        offsets = self.skipped_name_offsets
+        for row in range(self.skipped_files):
+            if row in self.skipped_odd_digests:
+                digest = self.skipped_odd_digests[row]
+            else:
+                digest = bytes(self.skipped_digests[row * width:(row + 1) * width])
+            if digest in digests:
+                found.setdefault(digest, []).append(
+                    self.skipped_names[offsets[row]:offsets[row + 1]].decode('utf-8'))
+        return found
+
+    def _raw_digest(self, elem, row, odd_digests):
+        """ An element's digest as raw bytes; if it isn't hex, zeros, with the text kept in odd_digests """
+        digest_value = elem['digests'][self.digest_name]
+        raw = dtthdx.digest_bytes(digest_value, self.digest_width)
+        if raw is None:
+            odd_digests[row] = digest_value
+            raw = bytes(self.digest_width)
+        return raw
+
+    def _index(self):
+        """ Build the name and digest indexes; where a name repeats, the last row wins """
+        rows = len(self.mtimes)
+        self.by_name = RowIndex(rows)
+        for row in range(rows):
+            full_name = self.full_name(row)
+            key_hash = hash(full_name) & HASH_MASK
+            old_row = self.find_name(full_name)
+            if old_row is None:
+                self.by_name.add(key_hash, row)
+            else:
+                self.by_name.replace(key_hash, old_row, row)
+                self.dropped.add(old_row)
+        self.by_digest = RowIndex(rows)
+        for row in self.rows():
+            self.by_digest.add(hash(self.digest(row)) & HASH_MASK, row)
+
+
 class Comparator(object):
     """ Digest blob comparator and supporting functions """
-    elements_l = []
-    elements_r = []
-    files_by_name_l = {}
-    files_by_name_r = {}
+    table_l = None
+    table_r = None
+    elements_l = 0
+    elements_r = 0
     basepath_l = ''
     basepath_r = ''
     best_digest = None
@@ -69,127 +271,456 @@ class Comparator(object):
         best_name = dtdigester.DIGEST_PRIORITY[best]
         return best_name
 
-    def slice_data(self, elements):
-        files_by_name = {elem['full_name']: elem for elem in elements if elem['type'] == 'F'}
-        files_by_digest = defaultdict(list)
-        for elem in elements:
-            if elem['type'] == 'F':
-                cmp_digest = elem['digests'][self.best_digest]  #TODO: Mix in file size here?
-                files_by_digest[cmp_digest].append(elem)
-        return (files_by_name, files_by_digest)
-
-    def compare_by_full_names(self, name_same):
-        elems_changed = []
-        for name in name_same:
-            digest_l = self.files_by_name_l[name]['digests'][self.best_digest]
-            digest_r = self.files_by_name_r[name]['digests'][self.best_digest]
-            self.files_by_name_l[name]['match'] = [self.files_by_digest_r[digest_l]]
-            self.files_by_name_r[name]['match'] = [self.files_by_digest_l[digest_r]]
-            if digest_l == digest_r:
-                self.files_by_name_l[name]['status'] = 'same'
-                self.files_by_name_r[name]['status'] = 'same'
-                if not self.control_data['notimestamps'] and self.files_by_name_l[name]['mtime'] != self.files_by_name_r[name]['mtime']:
-                    time_l = datetime.fromtimestamp(int("0x"+self.files_by_name_l[name]['mtime'], 16))
-                    time_r = datetime.fromtimestamp(int("0x"+self.files_by_name_r[name]['mtime'], 16))
-                    self.logger.info("SAME-T: %ss: \"%s\"", int((time_r - time_l).total_seconds()), name)
-            else:
-                self.files_by_name_l[name]['status'] = 'changed'
-                self.files_by_name_r[name]['status'] = 'changed'
-                if not self.control_data['notimestamps'] and self.files_by_name_l[name]['mtime'] == self.files_by_name_r[name]['mtime']:
-                    self.logger.info("MOD-T : \"%s\"", name)
-                elems_changed.append(self.files_by_name_r[name])
-        return (elems_changed)
+    def compare_by_full_names(self):
+        """ Match up the files in both reports; returns (changed, only_l, only_r) rows """
+        elems_changed = array('I')
+        elems_retimed = array('I')
+        only_r = array('I')
+        matched_l = bytearray(len(self.table_l.mtimes))
+        for row_r in self.table_r.rows():
+            row_l = self.table_l.find_name(self.table_r.full_name(row_r))
+            if row_l is None:
+                only_r.append(row_r)
+                continue
+            matched_l[row_l] = 1
+            same = self.table_l.digest(row_l) == self.table_r.digest(row_r)
+            if not same:
+                elems_changed.append(row_r)
+            if not self.control_data['notimestamps'] and same == (
+                    self.table_l.mtimes[row_l] != self.table_r.mtimes[row_r]):
+                elems_retimed.append(row_r)
+        for row_r in sorted(elems_retimed, key=self.table_r.full_name):
+            name = self.table_r.full_name(row_r)
+            row_l = self.table_l.find_name(name)
+            self.log_timestamps(
+                name, self.table_l.digest(row_l) == self.table_r.digest(row_r),
+                self.table_l.mtimes[row_l], self.table_r.mtimes[row_r])
+        only_l = array('I', (row for row in self.table_l.rows() if not matched_l[row]))
+        return (elems_changed, only_l, only_r)
+
+    def log_timestamps(self, name, same, mtime_l, mtime_r):
+        """ Note a file whose timestamp changed but not its data, or the reverse """
+        if same:
+            time_l = datetime.fromtimestamp(mtime_l)
+            time_r = datetime.fromtimestamp(mtime_r)
+            self.logger.info("SAME-T: %ss: \"%s\"", int((time_r - time_l).total_seconds()), name)
+        else:
+            self.logger.info("MOD-T : \"%s\"", name)
 
     def check_lhs(self, name_diff_l):
         elems_moved = []
         elems_deleted = []
-        for name in name_diff_l:
-            digest_l = self.files_by_name_l[name]['digests'][self.best_digest]
-            # print("checking", name)
-            if digest_l in self.files_by_digest_r:
-                # print(name, digest_l)
-                # matched_elems = [elem['full_name'] for elem in self.files_by_digest_r[digest_l]]
-                # matched_names = ','.join(matched_elems)
-                # print("< MOVED   {} == {}".format(name, matched_names))
-                self.files_by_name_l[name]['status'] = 'moved'
-                self.files_by_name_l[name]['match'] = self.files_by_digest_r[digest_l]
-                elems_moved.append(self.files_by_name_l[name])
+        skipped_r = self.table_r.scan_skipped({self.table_l.digest(row) for row in name_diff_l})
+        for row in name_diff_l:
+            digest = self.table_l.digest(row)
+            if self.table_r.find_digest(digest) or digest in skipped_r:
+                elems_moved.append(row)
             else:
-                # print("< DELETED {}".format(name))
-                self.files_by_name_l[name]['status'] = 'deleted'
-                elems_deleted.append(self.files_by_name_l[name])
+                elems_deleted.append(row)
         return (elems_moved, elems_deleted)
 
     def check_rhs(self, name_diff_r):
         elems_copied = []
         elems_added = []
-        for name in name_diff_r:
-            digest_r = self.files_by_name_r[name]['digests'][self.best_digest]
-            # print("checking", name)
-            if digest_r in self.files_by_digest_l:
-                # print(name, digest_r)
-                # matched_elems = [elem['full_name'] for elem in self.files_by_digest_l[digest_r]]
-                # matched_names = ','.join(matched_elems)
-                # print("> COPIED  {} == {}".format(name, matched_names))
-                self.files_by_name_r[name]['status'] = 'copied'
-                for elem in self.files_by_digest_l[digest_r]:
-                    if elem['file_name'] == self.files_by_name_r[name]['file_name']:
-                        self.logger.info("------: Found likely source: \"%s\"", self.files_by_name_r[name]['full_name'])
-                        break
-                self.files_by_name_r[name]['match'] = self.files_by_digest_l[digest_r]
-                elems_copied.append(self.files_by_name_r[name])
+        likely_copies = []
+        skipped_l = self.table_l.scan_skipped({self.table_r.digest(row) for row in name_diff_r})
+        for row in name_diff_r:
+            digest = self.table_r.digest(row)
+            rows_l = self.table_l.find_digest(digest)
+            if rows_l or digest in skipped_l:
+                file_name = self.table_r.file_name(row)
+                if any(self.table_l.file_name(row_l) == file_name for row_l in rows_l) or (
+                        file_name in skipped_l.get(digest, [])):
+                    likely_copies.append(row)
+                elems_copied.append(row)
             else:
-                # print("> ADDED   {}".format(name))
-                self.files_by_name_r[name]['status'] = 'added'
-                elems_added.append(self.files_by_name_r[name])
+                elems_added.append(row)
+        for name in sorted(map(self.table_r.full_name, likely_copies)):
+            self.logger.info("------: Found likely source: \"%s\"", name)
         return (elems_copied, elems_added)
 
     def compare(self, file_l, file_r):
         """ Main entry: compare two dirtreedigest reports """
-        (self.basepath_l, self.elements_l) = dtutils.read_dtd_report(file_l, self.logger)
-        (self.basepath_r, self.elements_r) = dtutils.read_dtd_report(file_r, self.logger)
+        (header_l, header_r) = ({'basepath': ''}, {'basepath': ''})
+        elements_l = dtutils.iter_dtd_report(
+            file_l, self.logger, header_l, processes=self.control_data['report_parsers'])
+        elements_r = dtutils.iter_dtd_report(
+            file_r, self.logger, header_r, processes=self.control_data['report_parsers'])
+        # The first element of each report (read along with its header) settles the digest to compare
+        firsts_l = [elem for elem in [next(elements_l, None)] if elem]
+        firsts_r = [elem for elem in [next(elements_r, None)] if elem]
+        self.basepath_l = header_l['basepath']
+        self.basepath_r = header_r['basepath']
 
         self.logger.info("Root L: %s", self.basepath_l)
         self.logger.info("Root R: %s", self.basepath_r)
 
-        self.best_digest = self.choose_best_digest_for_compare(self.elements_l, self.elements_r)
+        self.best_digest = self.choose_best_digest_for_compare(firsts_l, firsts_r)
         if self.best_digest is None:
             return None
 
         self.logger.info("BestDG: %s", self.best_digest)
 
-        (self.files_by_name_l, self.files_by_digest_l) = self.slice_data(self.elements_l)
-        (self.files_by_name_r, self.files_by_digest_r) = self.slice_data(self.elements_r)
+        digest_width = dtdigester.DIGEST_FUNCTIONS[self.best_digest]['len'] // 2
+        if self.control_data['full_compare']:
+            self.compare_elements(chain(firsts_l, elements_l), chain(firsts_r, elements_r), digest_width)
+            return
+        if self.trees_match(file_l, file_r):
+            return
+        try:
+            self.compare_elements(
+                chain(firsts_l, elements_l), chain(firsts_r, elements_r), digest_width, skip_subtrees=True)
+        except ReportOrderError as err:
+            self.logger.warning("Comparing in full: %s", err)
+            elements_l.close()
+            elements_r.close()
+            self.compare_elements(
+                dtutils.iter_dtd_report(file_l, self.logger, processes=self.control_data['report_parsers']),
+                dtutils.iter_dtd_report(file_r, self.logger, processes=self.control_data['report_parsers']),
+                digest_width)
 
-        name_set_l = set(self.files_by_name_l)
-        name_set_r = set(self.files_by_name_r)
-        name_diff_l = name_set_l - name_set_r
-        name_diff_r = name_set_r - name_set_l
-        name_same = name_set_r & name_set_l
+    def trees_match(self, file_l, file_r):
+        """ Whether both reports' tree digests (if they have them) say their trees are identical
+            Only when ignoring timestamps, since mtime changes don't show in the digests
+        """
+        if not self.control_data['notimestamps']:
+            return False
+        tree_l = dtutils.read_report_footer(file_l)['tree_digests'] or {}
+        tree_r = dtutils.read_report_footer(file_r)['tree_digests'] or {}
+        digest_value = tree_l.get(self.best_digest)
+        if digest_value is None or digest_value != tree_r.get(self.best_digest):
+            return False
+        self.logger.info("SAME  : Trees are identical (%s %s)", self.best_digest, digest_value)
+        return True
 
-        (elems_changed) = self.compare_by_full_names(name_same)
+    def split_subtrees(self, elements_l, elements_r, add_l, add_r, skip_l, skip_r):
+        """ Pass each report's elements to add_l or add_r, except those in a subtree
+            that's identical in both (per its directory's digests), which go to
+            skip_l or skip_r. Mtimes aren't in the digests, so files there whose
+            mtime changed are still added. The reports are merged in walk order,
+            and must be in it (else ReportOrderError).
+        """
+        digest_width = dtdigester.DIGEST_FUNCTIONS[self.best_digest]['len'] // 2
+        (elements_l, elements_r) = (iter(elements_l), iter(elements_r))
+        (elem_l, key_l) = _next_in_order(elements_l, None)
+        (elem_r, key_r) = _next_in_order(elements_r, None)
+        prefix = None  # Of the names in the subtree being skipped
+        (subtrees, files) = (0, 0)
+        while elem_l or elem_r:
+            take_l = elem_l is not None and (elem_r is None or key_l <= key_r)
+            take_r = elem_r is not None and (elem_l is None or key_r <= key_l)
+            name = (elem_l if take_l else elem_r)['full_name']
+            if prefix and name.startswith(prefix) and take_l and take_r and self.retimed(elem_l, elem_r):
+                add_l(elem_l)  # For its SAME-T line
+                add_r(elem_r)
+            elif prefix and name.startswith(prefix):
+                if take_l:
+                    skip_l(elem_l)
+                if take_r:
+                    skip_r(elem_r)
+                    files += elem_r['type'] == 'F'
+            else:
+                prefix = None
+                if take_l:
+                    add_l(elem_l)
+                if take_r:
+                    add_r(elem_r)
+                if take_l and take_r and elem_l['type'] == elem_r['type'] == 'D':
+                    digest_value = elem_l['digests'].get(self.best_digest, '')
+                    if dtthdx.digest_bytes(digest_value, digest_width) and (
+                            digest_value == elem_r['digests'].get(self.best_digest)):
+                        prefix = name + '/'
+                        subtrees += 1
+            if take_l:
+                (elem_l, key_l) = _next_in_order(elements_l, key_l)
+            if take_r:
+                (elem_r, key_r) = _next_in_order(elements_r, key_r)
+        if subtrees:
+            self.logger.info("Skipped %d identical subtree(s) holding %d file(s)", subtrees, files)
+
+    def retimed(self, elem_l, elem_r):
+        """ Whether a file's mtime differs between the reports (when timestamps are compared) """
+        return (not self.control_data['notimestamps'] and elem_l['type'] == elem_r['type'] == 'F' and
+                int(elem_l['mtime'], 16) != int(elem_r['mtime'], 16))
+
+    def compare_elements(self, elements_l, elements_r, digest_width, skip_subtrees=False):
+        """ Compare with both reports loaded into memory """
+        self.table_l = ReportTable(self.best_digest, digest_width)
+        self.table_r = ReportTable(self.best_digest, digest_width)
+        if skip_subtrees:
+            self.split_subtrees(
+                elements_l, elements_r,
+                self.table_l.add, self.table_r.add, self.table_l.add_skipped, self.table_r.add_skipped)
+        else:
+            for elem in elements_l:
+                self.table_l.add(elem)
+            for elem in elements_r:
+                self.table_r.add(elem)
+        self.table_l.finish()
+        self.table_r.finish()
+        self.elements_l = self.table_l.elements
+        self.elements_r = self.table_r.elements
+
+        (elems_changed, name_diff_l, name_diff_r) = self.compare_by_full_names()
         (elems_moved, elems_deleted) = self.check_lhs(name_diff_l)
         (elems_copied, elems_added) = self.check_rhs(name_diff_r)
 
-        for elem in sorted(elems_changed, key=lambda k: k['full_name']):
-            self.logger.info(f"MOD   : \"{elem['full_name']}\"")
+        self.log_results(
+            changed=sorted(map(self.table_r.full_name, elems_changed)),
+            added=sorted(map(self.table_r.full_name, elems_added)),
+            deleted=sorted(map(self.table_l.full_name, elems_deleted)),
+            copied=sorted(map(self.table_r.full_name, elems_copied)),
+            moved=sorted(map(self.table_l.full_name, elems_moved)),
+            files=(
+                len(self.table_l) + self.table_l.skipped_files,
+                len(self.table_r) + self.table_r.skipped_files,
+                len(self.table_r) - len(name_diff_r) + self.table_r.skipped_files))
+
+    def log_results(self, changed, added, deleted, copied, moved, files):
+        """ Log each kind of difference, by name, and the totals """
+        for name in changed:
+            self.logger.info(f"MOD   : \"{name}\"")
+
+        for name in added:
+            self.logger.info(f"ADD   : \"{name}\"")
+
+        for name in deleted:
+            self.logger.info(f"DEL   : \"{name}\"")
+
+        for name in copied:
+            self.logger.info(f"COPY  : \"{name}\" == \"{'---'}\"")
+
+        for name in moved:
+            self.logger.info(f"MOVE  : \"{name}\" == \"{'---'}\"")
+
+        (files_l, files_r, files_both) = files
+        self.logger.info("ElemsL: %d", self.elements_l)
+        self.logger.info("ElemsR: %d", self.elements_r)
+        self.logger.info("FilesL: %d", files_l)
+        self.logger.info("FilesR: %d", files_r)
+        self.logger.info("  Both: %d", files_both)
+        self.logger.info("Only L: %d", files_l - files_both)
+        self.logger.info("Only R: %d", files_r - files_both)
+
+
+def _next_in_order(elements, prev_key):
+    """ The next element and its walk-order key, or (None, None) at the end
+        Raises ReportOrderError if it comes before the previous one
+    """
+    elem = next(elements, None)
+    if elem is None:
+        return (None, None)
+    key = dtutils.path_sort_key(elem['full_name'])
+    if prev_key is not None and key < prev_key:
+        raise ReportOrderError(f"\"{elem['full_name']}\" is out of order")
+    return (elem, key)
+
+
+def digest_key(digest_value, digest_width):
+    """ A digest as bytes that are equal exactly when the digests are, and sort either way:
+        raw digests for hex values, text for anything else (e.g., '!!!!')
+    """
+    raw = dtthdx.digest_bytes(digest_value, digest_width)
+    return b'\x00' + raw if raw is not None else b'\x01' + digest_value.encode('utf-8')
+
+
+class SortedCursor(object):
+    """ Lookups in sorted records, for keys that come in sorted order too """
+
+    def __init__(self, records):
+        self.records = iter(records)
+        self.current = next(self.records, None)
+        self.passed = None  # The last record moved past
 
-        for elem in sorted(elems_added, key=lambda k: k['full_name']):
-            self.logger.info(f"ADD   : \"{elem['full_name']}\"")
+    def find(self, key):
+        """ 2 if key matches a record, 1 if only its first item does, else 0 """
+        while self.current is not None and self.current < key:
+            self.passed = self.current
+            self.current = next(self.records, None)
+        if self.current == key:
+            return 2
+        if any(record is not None and record[0] == key[0] for record in (self.current, self.passed)):
+            return 1
+        return 0
 
-        for elem in sorted(elems_deleted, key=lambda k: k['full_name']):
-            self.logger.info(f"DEL   : \"{elem['full_name']}\"")
 
-        for elem in sorted(elems_copied, key=lambda k: k['full_name']):
-            self.logger.info(f"COPY  : \"{elem['full_name']}\" == \"{'---'}\"")
+class ExternalComparator(Comparator):
+    """ Comparator for reports too big to hold in memory
 
-        for elem in sorted(elems_moved, key=lambda k: k['full_name']):
-            self.logger.info(f"MOVE  : \"{elem['full_name']}\" == \"{'---'}\"")
+        Both reports are sorted by name on disk and merge-joined, which
+        settles same-name files and leaves the names found on only one side.
+        Those are then joined by digest against all of the other side's
+        files, again through on-disk sorts, to tell moves and copies from
+        deletions and additions. With Bloom filters of each side's digests,
+        one-sided files with no possible match are settled without a sort,
+        and only the digests that might match are sorted. Results are the
+        same as Comparator's.
+    """
 
-        self.logger.info("ElemsL: %d", len(self.elements_l))
-        self.logger.info("ElemsR: %d", len(self.elements_r))
-        self.logger.info("FilesL: %d", len(self.files_by_name_l))
-        self.logger.info("FilesR: %d", len(self.files_by_name_r))
-        self.logger.info("  Both: %d", len(name_same))
-        self.logger.info("Only L: %d", len(name_diff_l))
-        self.logger.info("Only R: %d", len(name_diff_r))
+    def compare_elements(self, elements_l, elements_r, digest_width, skip_subtrees=False):
+        """ Compare with both reports streamed through on-disk sorts """
+        memory = self.control_data['compare_memory_mb'] * 1024 * 1024
+        # Up to two sorts hold a run in memory at once
+        self.run_rows = max(1, memory // (2 * dtextsort.RECORD_BYTES))
+        (self.elements_l, self.elements_r) = (0, 0)
+        with tempfile.TemporaryDirectory(prefix='dtdcmp-', dir=self.control_data['temp_dir']) as tempdir:
+            self.tempdir = tempdir
+            (skipped_l, skipped_r) = ((), ())
+            if skip_subtrees:
+                (kept_l, kept_r) = (self.spool(), self.spool())
+                (skipped_l, skipped_r) = (self.spool(), self.spool())  # (digest_key, file_name) of skipped files
+                self.split_subtrees(
+                    elements_l, elements_r, kept_l.write, kept_r.write,
+                    lambda elem: self.skip_element(elem, digest_width, skipped_l, 'elements_l'),
+                    lambda elem: self.skip_element(elem, digest_width, skipped_r, 'elements_r'))
+                (elements_l, elements_r) = (kept_l, kept_r)
+            self.compare_sorted(
+                self.sorted_files(elements_l, digest_width, 'elements_l'),
+                self.sorted_files(elements_r, digest_width, 'elements_r'),
+                skipped_l, skipped_r)
+
+    def skip_element(self, elem, digest_width, skipped, counter):
+        """ Count an element from a subtree that's identical in the other report, spooling it if it's a file """
+        setattr(self, counter, getattr(self, counter) + 1)
+        if elem['type'] == 'F':
+            skipped.write((digest_key(elem['digests'][self.best_digest], digest_width), elem['file_name']))
+
+    def sort(self, records, key=None):
+        return dtextsort.external_sort(records, self.tempdir, self.run_rows, key=key)
+
+    def spool(self):
+        return dtextsort.Spool(self.tempdir)
+
+    def sorted_files(self, elements, digest_width, counter):
+        """ Yield (full_name, file_name, mtime, digest_key) for each file, by name
+            Where a name repeats, only its last file is kept
+        """
+        records = self.sort(self.file_records(elements, digest_width, counter), key=itemgetter(0))
+        for (_, group) in groupby(records, key=itemgetter(0)):
+            for record in group:
+                pass
+            yield record
+
+    def file_records(self, elements, digest_width, counter):
+        """ The records for sorted_files, in report order (counting elements as they go by) """
+        for elem in elements:
+            setattr(self, counter, getattr(self, counter) + 1)
+            if elem['type'] != 'F':
+                continue
+            yield (elem['full_name'], elem['file_name'], int(elem['mtime'], 16),
+                   digest_key(elem['digests'][self.best_digest], digest_width))
+
+    def compare_sorted(self, files_l, files_r, skipped_l=(), skipped_r=()):
+        """ Merge-join the name-sorted files of both reports, then resolve the one-sided ones by digest
+            Skipped files (from subtrees identical in both) only count, and serve as digests to match
+        """
+        changed = self.spool()
+        only_l = self.spool()  # (digest_key, full_name)
+        only_r = self.spool()  # (digest_key, file_name, full_name)
+        digests_l = self.spool()  # (digest_key, file_name)
+        digests_r = self.spool()  # (digest_key,)
+        (files_l_only, files_r_only, files_both) = (0, 0, 0)
+        file_l = next(files_l, None)  # Both reports have been read once these are in hand
+        file_r = next(files_r, None)
+        bloom_l = bloom_r = None
+        if self.control_data['bloom_filter']:
+            bloom_l = dtextsort.BloomFilter(self.elements_l)
+            bloom_r = dtextsort.BloomFilter(self.elements_r)
+        while file_l or file_r:
+            if file_l and file_r and file_l[0] == file_r[0]:
+                (name, file_name_l, mtime_l, digest_l) = file_l
+                (_, _, mtime_r, digest_r) = file_r
+                same = digest_l == digest_r
+                if not same:
+                    changed.write(name)
+                if not self.control_data['notimestamps'] and same == (mtime_l != mtime_r):
+                    self.log_timestamps(name, same, mtime_l, mtime_r)
+                files_both += 1
+                (file_l, file_r) = (next(files_l, None), next(files_r, None))
+            elif file_l and (not file_r or file_l[0] < file_r[0]):
+                (name, file_name_l, _, digest_l) = file_l
+                only_l.write((digest_l, name))
+                digest_r = None
+                files_l_only += 1
+                file_l = next(files_l, None)
+            else:
+                (name, file_name_r, _, digest_r) = file_r
+                only_r.write((digest_r, file_name_r, name))
+                digest_l = None
+                files_r_only += 1
+                file_r = next(files_r, None)
+            if digest_l is not None:
+                digests_l.write((digest_l, file_name_l))
+                if bloom_l:
+                    bloom_l.add(digest_l)
+            if digest_r is not None:
+                digests_r.write((digest_r,))
+                if bloom_r:
+                    bloom_r.add(digest_r)
+        for record in skipped_l:
+            digests_l.write(record)
+            if bloom_l:
+                bloom_l.add(record[0])
+        for (digest_r, _) in skipped_r:
+            digests_r.write((digest_r,))
+            if bloom_r:
+                bloom_r.add(digest_r)
+            files_both += 1
+
+        added = self.spool()
+        deleted = self.spool()
+        if bloom_l:
+            (only_l, only_r, wanted) = self.prefilter(only_l, only_r, bloom_l, bloom_r, added, deleted)
+            digests_l = (record for record in digests_l if record[0] in wanted)
+            digests_r = (record for record in digests_r if record[0] in wanted)
+
+        moved = self.spool()
+        digests = SortedCursor(self.sort(digests_r))
+        for (digest, name) in self.sort(only_l):
+            if digests.find((digest,)):
+                moved.write(name)
+            else:
+                deleted.write(name)
+
+        copied = self.spool()
+        likely_copies = self.spool()
+        digests = SortedCursor(self.sort(digests_l))
+        for (digest, file_name, name) in self.sort(only_r):
+            match = digests.find((digest, file_name))
+            if match:
+                copied.write(name)
+                if match == 2:
+                    likely_copies.write(name)
+            else:
+                added.write(name)
+        for name in self.sort(likely_copies):
+            self.logger.info("------: Found likely source: \"%s\"", name)
+
+        self.log_results(
+            changed=changed, added=self.sort(added), deleted=self.sort(deleted),
+            copied=self.sort(copied), moved=self.sort(moved),
+            files=(files_l_only + files_both, files_r_only + files_both, files_both))
+
+    def prefilter(self, only_l, only_r, bloom_l, bloom_r, added, deleted):
+        """ Settle the one-sided files whose digest the other side certainly lacks
+            Returns the rest, and a filter for the digests that might match them
+        """
+        unsettled_l = self.spool()
+        unsettled_r = self.spool()
+        wanted = dtextsort.BloomFilter(only_l.rows + only_r.rows)
+        for record in only_l:
+            if record[0] in bloom_r:
+                unsettled_l.write(record)
+                wanted.add(record[0])
+            else:
+                deleted.write(record[1])
+        for record in only_r:
+            if record[0] in bloom_l:
+                unsettled_r.write(record)
+                wanted.add(record[0])
+            else:
+                added.write(record[2])
+        self.logger.debug(
+            "Bloom : %d of %d one-sided files left to join", unsettled_l.rows + unsettled_r.rows,
+            only_l.rows + only_r.rows)
+        return (unsettled_l, unsettled_r, wanted)
@@ -18,9 +18,18 @@
 
 import hashlib
 import logging
+import mmap
+import os
 import queue
+import threading
 import zlib
 
+from concurrent import futures
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import dirtreedigest.reader as dtreader
+import dirtreedigest.treehash as dttreehash
 import dirtreedigest.utils as dtutils
 
 if dtutils.shared_memory_available():
@@ -151,11 +160,21 @@ DIGEST_FUNCTIONS_PY36 = {
     'sha3_384':   {'name': 'sha3_384',  'len':  96, 'entry': hashlib.sha3_384},  # noqa: E241
     'sha3_512':   {'name': 'sha3_512',  'len': 128, 'entry': hashlib.sha3_512},  # noqa: E241
 }
+DIGEST_FUNCTIONS_TREE = {
+    # Tree hashes, whose leaves are hashed in parallel
+    'sha256tree':  {'name': 'sha256tree',  'len':  64, 'entry': dttreehash.Sha256Tree},  # noqa: E241
+    'blake2btree': {'name': 'blake2btree', 'len': 128, 'entry': dttreehash.Blake2bTree},  # noqa: E241
+}
 # pylint: enable=bad-whitespace, no-member
 DIGEST_FUNCTIONS = {}
 DIGEST_FUNCTIONS.update(DIGEST_FUNCTIONS_TEST)
 DIGEST_FUNCTIONS.update(DIGEST_FUNCTIONS_MAIN)
 DIGEST_FUNCTIONS.update(DIGEST_FUNCTIONS_PY36)
+DIGEST_FUNCTIONS.update(DIGEST_FUNCTIONS_TREE)
+
+
+''' Digests of zero-length content, so empty files never need to be opened '''
+EMPTY_DIGESTS = {name: info['entry']().hexdigest() for name, info in DIGEST_FUNCTIONS.items()}
 
 
 ''' From least to most secure, excluding tests '''
@@ -167,12 +186,14 @@ DIGEST_PRIORITY = [
     'sha224',
     'sha3_224',
     'sha256',
+    'sha256tree',
     'blake2s',
     'sha3_256',
     'sha384',
     'sha3_384',
     'sha512',
     'blake2b',
+    'blake2btree',
     'sha3_512',
 ]
 
@@ -187,7 +208,9 @@ def validate_digests(control_data):
     if digests_not_found:
         logger.warning('Warning: invalid digest(s): %s', digests_not_found)
     digest_list = sorted(digests_available)
-    if len(digest_list) > control_data['max_concurrent_jobs']:
+    # Packed digests share workers, and plan_workers keeps those within max jobs
+    packed = control_data['calibration_file'] and control_data['engine'] == 'processes'
+    if not packed and len(digest_list) > control_data['max_concurrent_jobs']:
         logger.error(
             'Error: Number of digests (%d) may not exceed max jobs (%d)',
             len(digest_list), control_data['max_concurrent_jobs'])
@@ -203,89 +226,492 @@ def fill_digest_str(control_data, fillchar='-'):
             control_data['selected_digests'])) + '}'
 
 
-def digest_file(control_data, element):
-    """ Digest a given element """
+def digest_str(digests):
+    """ Create the report's digest value from {digest_name: hex digest} """
+    return '{' + ', '.join('{}: {}'.format(i, digests[i]) for i in sorted(digests)) + '}'
+
+
+class DirDigester(object):
+    """ Rolls a directory's children up into one digest per algorithm
+
+        Each child adds its type, name and digest (or the report's placeholder
+        for it) with that algorithm, in walk order; a subdirectory adds its own
+        rolled-up digest. Two directories get the same digests exactly when
+        their trees hold the same names, types and contents.
+    """
+
+    def __init__(self, digest_names):
+        self.hashers = {digest_name: DIGEST_FUNCTIONS[digest_name]['entry']() for digest_name in digest_names}
+
+    def add(self, elem_type, name, digests=None, fillchar='?'):
+        """ Add a child with its {digest_name: hex digest}, or with fillchar placeholders """
+        prefix = (elem_type + name + '\0').encode('utf-8')  # Names never contain NUL; digests are fixed width
+        for (digest_name, hasher) in self.hashers.items():
+            if digests and digest_name in digests:
+                digest_value = digests[digest_name]
+            else:
+                digest_value = fillchar * DIGEST_FUNCTIONS[digest_name]['len']
+            hasher.update(prefix + digest_value.encode('ascii'))
+
+    def hexdigests(self):
+        return {digest_name: hasher.hexdigest() for (digest_name, hasher) in self.hashers.items()}
+
+
+def digest_file_inline(control_data, element):
+    """ Digest a small element in-process, bypassing the reader and workers """
     logger = logging.getLogger('digester')
-    start_time = dtutils.curr_time_secs()
-    logger.debug('process_file(%s)', element)
-    total_jobs = len(control_data['selected_digests'])
-    bytes_read = 0
-    found_eof = False
+    logger.debug('process_file_inline(%s)', element)
+    stage_times = control_data['stage_times']
     hash_stats = {}
-
-    control_data['reader_cmd_queue'].put({
-        'cmd': dtutils.Cmd.INIT,
-        'buf_names': control_data['buffer_names'],
-        'element': element,
-    })
-    result = control_data['reader_results_queue'].get()
-    dtutils.flush_debug_queue(control_data['debug_queue'], logging.getLogger('worker'))
-    if result['errors']:
+    start_time = dtutils.curr_time_secs()
+    try:
+        with dtreader.open_element(element, control_data['low_impact']) as fileh:
+            read_time = dtutils.curr_time_secs()
+            dtutils.add_stage_time(stage_times, 'open', read_time - start_time)
+            byte_block = fileh.readall()
+            if control_data['low_impact']:
+                dtreader.advise_read(fileh, None, 0, len(byte_block))
+            dtutils.add_stage_time(stage_times, 'read', dtutils.curr_time_secs() - read_time)
+    except IOError as err:
+        logger.error('Problem opening "%s": %s', element, err)
         return hash_stats
+    for digest_name in control_data['selected_digests']:
+        start_time = dtutils.curr_time_secs()
+        digest_instance = DIGEST_FUNCTIONS[digest_name]['entry']()
+        digest_instance.update(byte_block)
+        hash_stats[digest_name] = digest_instance.hexdigest()
+        dtutils.add_stage_time(stage_times, f'hash.{digest_name}', dtutils.curr_time_secs() - start_time)
+    control_data['counts']['bytes_read'] += len(byte_block)
+    control_data['counts']['bytes_copied'] += len(byte_block)
+    return hash_stats
 
-    for i, worker_cmd_queue in enumerate(control_data['worker_cmd_queues']):
-        digest_name = control_data['selected_digests'][i]
-        digest_func = DIGEST_FUNCTIONS[digest_name]['entry']
-        worker_cmd_queue.put({
-            'cmd': dtutils.Cmd.INIT,
-            'digest_func': digest_func,
+
+class DigestPipeline(object):
+    """ Feeds files through the long-running reader and worker processes
+
+        Files may be submitted ahead of time: the reader opens and reads the
+        next queued file into free buffers while the workers are still busy
+        with the previous one. Blocks travel from the reader straight to the
+        workers; all that comes back here is one digest per worker and one
+        summary from the reader per file. Each submission returns a Future
+        that completes with the file's digests (or an empty dict if the file
+        couldn't be read). Each file is read in blocks sized for it, from the
+        read and hash times reported for the files before it.
+    """
+
+    def __init__(self, control_data):
+        self.logger = logging.getLogger('digester')
+        self.control_data = control_data
+        self.total_jobs = len(control_data['selected_digests'])
+        self.sizer = dtreader.BlockSizer(control_data['min_block_size'], control_data['max_block_size'])
+        self.next_file_id = 0
+        self.files = {}
+
+    def submit(self, element, file_size=None):
+        """ Queue an element with the reader """
+        file_id = self.next_file_id
+        self.next_file_id += 1
+        block_size = self.sizer.block_size(file_size)
+        self.logger.debug('process_file(%s) block_size= %d', element, block_size)
+        self.files[file_id] = {
             'element': element,
-        })
-
-    while not found_eof:
-        block_read = control_data['reader_results_queue'].get()
-        logger.debug('BLOCK READ: %s %s %s', block_read['block_size'], block_read['buf_name'], element)
-        found_eof = block_read['found_eof']
-        block_size = block_read['block_size']
-        buf_block = block_read['buf_block']
-        buf_name = block_read['buf_name']
-        bytes_read += block_size
-        for worker_cmd_queue in control_data['worker_cmd_queues']:
-            worker_cmd_queue.put({
-                'cmd': dtutils.Cmd.PROCESS,
-                'block_size': block_size,
-                'buf_name': buf_name,  # Shared memory mode
-                'buf_block': buf_block,  # Non-shared memory mode
-                'element': element,
-            })
-        # Gather any intermediate outputs
-        jobs = total_jobs
-        while jobs > 0:
+            'future': Future(),
+            'digests': {},
+            'hash_secs': 0.0,
+            'done': False,
+            'start_time': dtutils.curr_time_secs(),
+        }
+        self.control_data['reader_cmd_queue'].put((dtutils.Cmd.INIT.value, file_id, element, block_size))
+        self.control_data['counts']['queue_messages'] += 1
+        return self.files[file_id]['future']
+
+    def wait(self, future):
+        """ Drive the pipeline until the given submission completes """
+        while not future.done():
+            self._handle(self.control_data['results_queue'].get())
+        return future.result()
+
+    def poll(self):
+        """ Handle any messages that have already arrived, without blocking """
+        while True:
             try:
-                result = control_data['worker_results_queue'].get_nowait()
+                retval = self.control_data['results_queue'].get_nowait()
             except queue.Empty:
-                continue
-            if result:
-                jobs -= 1
-        if buf_name:
-            control_data['reader_cmd_queue'].put({
-                'cmd': dtutils.Cmd.FREE,
-                'buf_names': [buf_name],
-            })
-
-    for worker_cmd_queue in control_data['worker_cmd_queues']:
-        worker_cmd_queue.put({
-            'cmd': dtutils.Cmd.RESULT,
-        })
-    dtutils.flush_debug_queue(control_data['debug_queue'], logging.getLogger('worker'))
-    jobs = total_jobs
-    while jobs > 0:
-        retval = control_data['worker_results_queue'].get()
-        logger.debug('RETVAL: %s', retval)
-        if 'msg' in retval:
-            continue  #TODO: messages pop up here from time to time.
-        hash_stats[retval['digest_name']] = retval['digest_value']
-        jobs -= 1
-    dtutils.flush_debug_queue(control_data['debug_queue'], logging.getLogger('worker'))
-
-    end_time = dtutils.curr_time_secs()
-    delta_time = end_time - start_time if end_time - start_time > 0 else 0.000001
-    logger.debug('MAINLINE finished at %f', end_time)
-    logger.debug(
-        'run_time= %.3fs rate= %.3f MB/s bytes= %d %s',
-        delta_time,
-        bytes_read / 1024 / 1024 / delta_time,
-        bytes_read,
-        element)
-    control_data['counts']['bytes_read'] += bytes_read
-    return hash_stats
+                return
+            self._handle(retval)
+
+    def _handle(self, retval):
+        """ Dispatch one record from the reader or a worker """
+        cmd = retval[0]
+        if cmd == dtutils.Cmd.RESULT:
+            (_, file_id, digest_index, digest_value, hash_secs) = retval
+            file_data = self.files[file_id]
+            file_data['digests'][self.control_data['selected_digests'][digest_index]] = digest_value
+            file_data['hash_secs'] = max(file_data['hash_secs'], hash_secs)
+        elif cmd == dtutils.Cmd.DONE:
+            (_, file_id, error, bytes_read, bytes_copied, read_secs, hole_bytes) = retval
+            file_data = self.files[file_id]
+            file_data['done'] = True
+            file_data['error'] = error
+            file_data['read_secs'] = read_secs
+            self.control_data['counts']['bytes_read'] += bytes_read
+            self.control_data['counts']['bytes_copied'] += bytes_copied
+            self.control_data['counts']['hole_bytes'] += hole_bytes
+            file_data['bytes_read'] = bytes_read
+        else:
+            self.logger.debug('Unexpected message: %s', retval)
+            return
+        if file_data['done'] and (file_data['error'] or len(file_data['digests']) == self.total_jobs):
+            self._finish(file_id)
+
+    def _finish(self, file_id):
+        """ Record a finished file and complete its future """
+        file_data = self.files.pop(file_id)
+        end_time = dtutils.curr_time_secs()
+        delta_time = end_time - file_data['start_time']
+        delta_time = delta_time if delta_time > 0 else 0.000001
+        self.logger.debug(
+            'run_time= %.3fs rate= %.3f MB/s bytes= %d %s',
+            delta_time,
+            file_data['bytes_read'] / 1024 / 1024 / delta_time,
+            file_data['bytes_read'],
+            file_data['element'])
+        if not file_data['error']:
+            self.sizer.record(file_data['bytes_read'], max(file_data['read_secs'], file_data['hash_secs']))
+        file_data['future'].set_result({} if file_data['error'] else file_data['digests'])
+
+
+class ThreadedDigester(object):
+    """ In-process digest engine: the same DIGEST_FUNCTIONS run on a thread pool
+
+        hashlib and zlib release the GIL while digesting large buffers, so
+        the digests of one block run in parallel with each other and with the
+        read of the next block. Blocks come from a shared ring of buffers, so
+        nothing is pickled or placed in shared memory; only as much of each
+        as the file's block size is used. Holes in sparse files aren't read:
+        their blocks are cut from one buffer of zeros. Stage times are kept
+        under a lock and handed over to control_data at shutdown.
+    """
+
+    def __init__(self, control_data):
+        self.logger = logging.getLogger('digester')
+        self.control_data = control_data
+        total_jobs = len(control_data['selected_digests'])
+        depth = control_data['pipeline_depth']
+        self.file_pool = ThreadPoolExecutor(max_workers=depth, thread_name_prefix='reader')
+        self.hash_pool = ThreadPoolExecutor(max_workers=total_jobs * depth, thread_name_prefix='worker')
+        self.counts_lock = threading.Lock()
+        self.stage_times = {}
+        self.sizer = dtreader.BlockSizer(control_data['min_block_size'], control_data['max_block_size'])
+        self.free_buffers = queue.Queue()
+        for _ in range(max(control_data['max_buffers'], 2 * depth)):
+            self.free_buffers.put(bytearray(control_data['max_block_size']))
+        self.zeros = bytes(control_data['max_block_size'])  # Pages only get touched if there are holes
+
+    def submit(self, element, file_size=None):
+        """ Queue an element for digesting """
+        with self.counts_lock:
+            block_size = self.sizer.block_size(file_size)
+        self.logger.debug('process_file(%s) block_size= %d', element, block_size)
+        return self.file_pool.submit(self._digest, element, block_size)
+
+    def wait(self, future):
+        """ Wait for a submission to complete """
+        return future.result()
+
+    def poll(self):
+        """ Nothing to drive: the pools run on their own """
+
+    def shutdown(self):
+        """ Stop the thread pools """
+        self.file_pool.shutdown()
+        self.hash_pool.shutdown()
+        dtutils.merge_stage_times(self.control_data['stage_times'], self.stage_times)
+
+    def _digest(self, element, block_size):
+        """ Read an element block by block, hashing each block while the next is read """
+        start_time = dtutils.curr_time_secs()
+        digest_instances = [
+            (digest_name, DIGEST_FUNCTIONS[digest_name]['entry']())
+            for digest_name in self.control_data['selected_digests']]
+        hash_secs = [0.0] * len(digest_instances)  # Per digest, for this file
+        bytes_read = 0
+        hole_bytes = 0
+        blocks = 0
+        read_time = 0.0
+        hashing = []  # (buffer, view, futures) for the block being digested
+        try:
+            with dtreader.open_element(element, self.control_data['low_impact']) as file_obj:
+                open_time = dtutils.curr_time_secs() - start_time
+                file_map = None
+                try:
+                    if self.control_data['mmap_mode']:
+                        try:
+                            file_map = mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+                        except ValueError:  # Empty files can't be mapped
+                            file_map = None
+                    file_size = os.fstat(file_obj.fileno()).st_size
+                    extents = dtreader.Extents(file_obj, file_size)
+                    while True:
+                        buf = self.free_buffers.get()
+                        view = memoryview(buf)[:block_size]
+                        read_start = dtutils.curr_time_secs()
+                        count = extents.limit(bytes_read, block_size)
+                        if extents.hole:
+                            hole_bytes += count
+                        else:
+                            with view[:count] as read_view:
+                                count = dtreader.read_block_into(file_obj, file_map, bytes_read, read_view)
+                            if self.control_data['low_impact']:
+                                dtreader.advise_read(
+                                    file_obj, file_map, bytes_read, count,
+                                    max(0, min(block_size, file_size - bytes_read - count)))
+                        read_time += dtutils.curr_time_secs() - read_start
+                        blocks += 1
+                        self._release(hashing)
+                        if not count:
+                            view.release()
+                            self.free_buffers.put(buf)
+                            break
+                        bytes_read += count
+                        block_view = memoryview(self.zeros)[:count] if extents.hole else view[:count]
+                        hashing = [(buf, view, block_view, [
+                            self.hash_pool.submit(self._update, digest_name, digest_instance, block_view, hash_secs, i)
+                            for (i, (digest_name, digest_instance)) in enumerate(digest_instances)])]
+                finally:
+                    self._release(hashing)
+                    if file_map is not None:
+                        file_map.close()
+        except IOError as err:
+            self.logger.error('Problem opening "%s": %s', element, err)
+            return {}
+
+        end_time = dtutils.curr_time_secs()
+        delta_time = end_time - start_time if end_time - start_time > 0 else 0.000001
+        self.logger.debug(
+            'run_time= %.3fs rate= %.3f MB/s bytes= %d %s',
+            delta_time,
+            bytes_read / 1024 / 1024 / delta_time,
+            bytes_read,
+            element)
+        with self.counts_lock:
+            self.control_data['counts']['bytes_read'] += bytes_read
+            self.control_data['counts']['bytes_copied'] += bytes_read - hole_bytes
+            self.control_data['counts']['hole_bytes'] += hole_bytes
+            dtutils.add_stage_time(self.stage_times, 'open', open_time)
+            dtutils.add_stage_time(self.stage_times, 'read', read_time, blocks)
+            self.sizer.record(bytes_read, max([read_time] + hash_secs))
+        return {
+            digest_instance.name: digest_instance.hexdigest() for (_, digest_instance) in digest_instances}
+
+    def _update(self, digest_name, digest_instance, block_view, hash_secs, index):
+        """ Hash pool: digest one block, timing it (into hash_secs[index] too) """
+        start_time = dtutils.curr_time_secs()
+        digest_instance.update(block_view)
+        secs = dtutils.curr_time_secs() - start_time
+        hash_secs[index] += secs  # Only one block per file is in flight
+        with self.counts_lock:
+            dtutils.add_stage_time(self.stage_times, f'hash.{digest_name}', secs)
+
+    def _release(self, hashing):
+        """ Wait for the in-flight block's digests, then return its buffer to the ring """
+        while hashing:
+            (buf, view, block_view, futures) = hashing.pop()
+            for future in futures:
+                future.result()
+            block_view.release()
+            view.release()
+            self.free_buffers.put(buf)
+
+
+def digest_whole_file(element, selected_digests, file_size, max_block_size, mmap_mode=False, low_impact=False):
+    """ Digest one element start to finish with every selected digest
+        Runs in a file-pool process, so it reports back rather than logging:
+        returns (hash_stats, bytes_read, error, stage_times, hole_bytes)
+    """
+    digest_instances = [
+        (f'hash.{digest_name}', DIGEST_FUNCTIONS[digest_name]['entry']()) for digest_name in selected_digests]
+    stage_times = {}
+    bytes_read = 0
+    hole_bytes = 0
+    buf = bytearray(max(1, min(max_block_size, file_size)))
+    zeros = None
+    start_time = dtutils.curr_time_secs()
+    try:
+        with dtreader.open_element(element, low_impact) as file_obj:
+            file_map = None
+            try:
+                if mmap_mode and file_size > 0:
+                    file_map = mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+                dtutils.add_stage_time(stage_times, 'open', dtutils.curr_time_secs() - start_time)
+                extents = dtreader.Extents(file_obj, file_size)
+                with memoryview(buf) as view:
+                    while True:
+                        start_time = dtutils.curr_time_secs()
+                        count = extents.limit(bytes_read, len(buf))
+                        if extents.hole:
+                            zeros = zeros or bytes(len(buf))
+                            hole_bytes += count
+                        else:
+                            with view[:count] as read_view:
+                                count = dtreader.read_block_into(file_obj, file_map, bytes_read, read_view)
+                            if low_impact:
+                                dtreader.advise_read(
+                                    file_obj, file_map, bytes_read, count,
+                                    max(0, min(len(buf), file_size - bytes_read - count)))
+                        dtutils.add_stage_time(stage_times, 'read', dtutils.curr_time_secs() - start_time)
+                        if not count:
+                            break
+                        bytes_read += count
+                        with memoryview(zeros if extents.hole else buf)[:count] as block_view:
+                            for (stage, digest_instance) in digest_instances:
+                                start_time = dtutils.curr_time_secs()
+                                digest_instance.update(block_view)
+                                dtutils.add_stage_time(stage_times, stage, dtutils.curr_time_secs() - start_time)
+            finally:
+                if file_map is not None:
+                    file_map.close()
+    except (IOError, ValueError) as err:
+        return ({}, bytes_read, f'Problem opening "{element}": {err}', stage_times, hole_bytes)
+    hash_stats = {
+        digest_instance.name: digest_instance.hexdigest() for (_, digest_instance) in digest_instances}
+    return (hash_stats, bytes_read, None, stage_times, hole_bytes)
+
+
+def _start_pool_process(leaf_threads, profile_prefix):
+    """ ProcessPoolExecutor initializer: take a share of the cores for tree digests, and profile if asked """
+    dttreehash.set_leaf_threads(leaf_threads)
+    if profile_prefix:
+        dtutils.start_pool_profiling(profile_prefix)
+
+
+class FilePoolDigester(object):
+    """ File-parallel engine: a pool of processes, each digesting whole files
+
+        This uses as many cores as there are pool processes regardless of how
+        many digests are selected. Results are handed back on the main thread
+        (in poll/wait) so the shared counters are only touched from there.
+        If a pool process dies, the files it took down with it are reported
+        as read errors and a new pool takes over.
+    """
+
+    def __init__(self, control_data):
+        self.logger = logging.getLogger('digester')
+        self.control_data = control_data
+        self.pool = self._new_pool()
+        self.inflight = {}
+
+    def _new_pool(self):
+        pool_size = self.control_data['file_pool_size']
+        return ProcessPoolExecutor(
+            max_workers=pool_size,
+            initializer=_start_pool_process,
+            initargs=(max(1, (os.cpu_count() or 1) // pool_size), self.control_data['profile_prefix']))
+
+    def _restart(self, pool):
+        """ Replace a broken pool (unless that's been done already) """
+        if pool is self.pool:
+            self.logger.warning('File pool broke: starting a new one')
+            pool.shutdown(wait=False)
+            self.pool = self._new_pool()
+
+    def submit(self, element, file_size):
+        """ Queue an element for digesting """
+        self.logger.debug('process_file_pool(%s)', element)
+        args = (
+            digest_whole_file,
+            element,
+            self.control_data['selected_digests'],
+            file_size,
+            self.control_data['max_block_size'],
+            self.control_data['mmap_mode'],
+            self.control_data['low_impact'],
+        )
+        try:
+            inner = self.pool.submit(*args)
+        except BrokenProcessPool:  # Broke since the last results were handed back
+            self._restart(self.pool)
+            inner = self.pool.submit(*args)
+        future = Future()
+        future.digest_engine = self
+        self.inflight[inner] = (element, future, self.pool)
+        return future
+
+    def wait(self, future):
+        """ Wait for a submission to complete """
+        while not future.done():
+            (done, _) = futures.wait(list(self.inflight), return_when=futures.FIRST_COMPLETED)
+            for inner in done:
+                self._transfer(inner)
+        return future.result()
+
+    def poll(self):
+        """ Hand back whatever has finished, without blocking """
+        for inner in [inner for inner in self.inflight if inner.done()]:
+            self._transfer(inner)
+
+    def shutdown(self):
+        """ Stop the pool """
+        self.pool.shutdown()
+
+    def _transfer(self, inner):
+        """ Move a finished pool result onto its Future """
+        (element, future, pool) = self.inflight.pop(inner)
+        try:
+            (hash_stats, bytes_read, error, stage_times, hole_bytes) = inner.result()
+        except BrokenProcessPool as err:
+            (hash_stats, bytes_read, stage_times, hole_bytes) = ({}, 0, {}, 0)
+            error = f'Problem reading "{element}": a file pool process died ({err})'
+            self._restart(pool)
+        if error:
+            self.logger.error('%s', error)
+        dtutils.merge_stage_times(self.control_data['stage_times'], stage_times)
+        self.control_data['counts']['bytes_read'] += bytes_read
+        self.control_data['counts']['bytes_copied'] += bytes_read - hole_bytes
+        self.control_data['counts']['hole_bytes'] += hole_bytes
+        future.set_result(hash_stats)
+
+
+def _completed(hash_stats):
+    """ Wrap an already-computed result as a finished Future """
+    future = Future()
+    future.set_result(hash_stats)
+    return future
+
+
+def submit_file(control_data, element, file_size=None):
+    """ Start digesting a given element; returns a Future for its digests
+
+        Empty files get precomputed digests and small files are digested
+        in-process. With a file pool, medium files are digested whole by one
+        pool process each; the rest go to the digest-parallel engine.
+    """
+    if file_size == 0:
+        return _completed({name: EMPTY_DIGESTS[name] for name in control_data['selected_digests']})
+    if file_size is not None and file_size <= control_data['inline_max_size']:
+        return _completed(digest_file_inline(control_data, element))
+    if (control_data['file_pool'] and file_size is not None and
+            file_size <= control_data['file_pool_max_size']):
+        return control_data['file_pool'].submit(element, file_size)
+    future = control_data['digest_engine'].submit(element, file_size)
+    future.digest_engine = control_data['digest_engine']
+    return future
+
+
+def wait_file(control_data, future):
+    """ Wait for a submitted element's digests """
+    if future.done():
+        return future.result()
+    return future.digest_engine.wait(future)
+
+
+def poll_files(control_data):
+    """ Let the engines hand back any finished results """
+    control_data['digest_engine'].poll()
+    if control_data['file_pool']:
+        control_data['file_pool'].poll()
+
+
+def digest_file(control_data, element, file_size=None):
+    """ Digest a given element """
+    return wait_file(control_data, submit_file(control_data, element, file_size))
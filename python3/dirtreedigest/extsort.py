@@ -0,0 +1,155 @@
+"""
+
+    Copyright (c) 2017-2021 Martin F. Falatic
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+"""
+
+import heapq
+import math
+import os
+import pickle
+import tempfile
+
+# Records are pickled to spool files this many at a time (at most)
+SPOOL_BATCH_ROWS = 4096
+
+# Largest file buffer a spool reads or writes through
+SPOOL_BUFFER_SIZE = 1024 * 1024
+
+# Rough in-memory cost of one buffered record (a tuple of a few strings), for sizing sort runs
+RECORD_BYTES = 400
+
+# Most sorted runs merged at once: each has a file open, with a buffer and a batch of records
+MERGE_FAN_IN = 64
+
+HASH_MASK = (1 << 64) - 1
+
+
+class Spool(object):
+    """ Records written once to a temporary file, then read back in order
+
+        Memory held is about batch_rows records and a buffer_size file
+        buffer, while writing (until close) and again while reading.
+    """
+
+    def __init__(self, tempdir, batch_rows=None, buffer_size=SPOOL_BUFFER_SIZE):
+        (fd, self.filename) = tempfile.mkstemp(dir=tempdir, suffix='.spool')
+        self.fileh = os.fdopen(fd, 'wb', buffering=buffer_size)
+        self.batch_rows = batch_rows or SPOOL_BATCH_ROWS
+        self.buffer_size = buffer_size
+        self.batch = []
+        self.rows = 0
+
+    def write(self, record):
+        self.batch.append(record)
+        self.rows += 1
+        if len(self.batch) >= self.batch_rows:
+            pickle.dump(self.batch, self.fileh, pickle.HIGHEST_PROTOCOL)
+            self.batch = []
+
+    def close(self):
+        """ Finish writing, letting go of the file until the records are read back """
+        if self.fileh:
+            if self.batch:
+                pickle.dump(self.batch, self.fileh, pickle.HIGHEST_PROTOCOL)
+            self.batch = None
+            self.fileh.close()
+            self.fileh = None
+
+    def __iter__(self):
+        """ Finish writing and yield the records back (once); the file goes when they're done """
+        self.close()
+        try:
+            with open(self.filename, 'rb', buffering=self.buffer_size) as fileh:
+                while True:
+                    try:
+                        batch = pickle.load(fileh)
+                    except EOFError:
+                        break
+                    yield from batch
+        finally:
+            os.remove(self.filename)
+
+
+def merge_sizes(run_rows):
+    """ (batch_rows, buffer_size) for the runs of a sort holding run_rows records in memory
+
+        A merge reads MERGE_FAN_IN runs at once, so each gets that share of
+        the memory a run took to sort, half for records and half for its
+        file buffer.
+    """
+    share = run_rows * RECORD_BYTES // MERGE_FAN_IN // 2
+    return (max(1, min(SPOOL_BATCH_ROWS, share // RECORD_BYTES)), max(4096, min(SPOOL_BUFFER_SIZE, share)))
+
+
+def external_sort(records, tempdir, run_rows, key=None):
+    """ Yield records in sorted order, holding at most run_rows of them in memory
+
+        Sorted runs are spooled to tempdir and merged, at most MERGE_FAN_IN
+        at a time, in as many passes as it takes. The sort is stable:
+        records that compare equal come out in the order they went in.
+    """
+    (batch_rows, buffer_size) = merge_sizes(run_rows)
+
+    def spool(sorted_records):
+        run = Spool(tempdir, batch_rows, buffer_size)
+        for sorted_record in sorted_records:
+            run.write(sorted_record)
+        run.close()
+        return run
+
+    runs = []
+    buffer = []
+    for record in records:
+        buffer.append(record)
+        if len(buffer) >= run_rows:
+            buffer.sort(key=key)
+            runs.append(spool(buffer))
+            buffer = []
+    buffer.sort(key=key)
+    if not runs:
+        yield from buffer
+        return
+    if buffer:
+        runs.append(spool(buffer))
+        buffer = None
+    while len(runs) > MERGE_FAN_IN:
+        # Neighbouring runs are merged, and ties go to the earlier run, which keeps it stable
+        runs = [
+            spool(heapq.merge(*runs[start:start + MERGE_FAN_IN], key=key))
+            if len(runs) - start > 1 else runs[start]
+            for start in range(0, len(runs), MERGE_FAN_IN)]
+    yield from heapq.merge(*runs, key=key)
+
+
+class BloomFilter(object):
+    """ Set membership with no false negatives and a small rate of false positives """
+
+    def __init__(self, capacity, bits_per_key=10):
+        self.bits = max(64, capacity * bits_per_key)
+        self.hashes = max(1, round(bits_per_key * math.log(2)))
+        self.array = bytearray((self.bits + 7) // 8)
+
+    def _positions(self, key):
+        key_hash = hash(key) & HASH_MASK
+        (start, step) = (key_hash & 0xffffffff, (key_hash >> 32) | 1)
+        return ((start + i * step) % self.bits for i in range(self.hashes))
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.array[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        return all(self.array[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
@@ -0,0 +1,225 @@
+"""
+
+    Copyright (c) 2017-2021 Martin F. Falatic
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+"""
+
+import argparse
+import json
+import logging
+import os
+import shlex
+import sys
+import tempfile
+
+import dirtreedigest.__config__ as dtconfig
+import dirtreedigest.benchmark as dtbench
+import dirtreedigest.digester as dtdigester
+import dirtreedigest.utils as dtutils
+
+NOOP_DIGESTS = ','.join(f'noop{i}' for i in range(8))
+
+
+def int_list(value):
+    """ argparse type: comma-separated integers """
+    return [int(item) for item in value.split(',') if item]
+
+
+def size_list(value):
+    """ argparse type: comma-separated block sizes, as given (MB, or with a K or M suffix) """
+    sizes = [item.strip() for item in value.split(',') if item.strip()]
+    for size in sizes:
+        dtutils.parse_size(size)
+    return sizes
+
+
+def validate_args():
+    """ Validate command-line arguments """
+    control_data = dtconfig.CONTROL_DATA
+    parser = argparse.ArgumentParser(
+        epilog='Tree profiles: {}; metrics: {}'.format(
+            ', '.join(sorted(dtbench.TREE_PROFILES)), ', '.join(sorted(dtbench.THRESHOLDS))))
+    parser.add_argument('--trees', dest='trees', metavar='PROFILE1[,PROFILE2...]',
+                        default=','.join(dtbench.TREE_PROFILES), type=str, action='store',
+                        help='synthetic trees to run on')
+    parser.add_argument('--scale', dest='scale', metavar='FACTOR',
+                        default=1.0, type=float, action='store',
+                        help='scale the trees\' file counts (or, for huge, file sizes)')
+    parser.add_argument('--seed', dest='seed', metavar='N',
+                        default=0, type=int, action='store',
+                        help='seed for generating tree contents')
+    parser.add_argument('--workdir', dest='workdir', metavar='DIR',
+                        default=None, type=str, action='store',
+                        help='where trees are generated and kept for later runs (default: a temporary directory)')
+    parser.add_argument('--shm', dest='shm', metavar='on|off[,...]',
+                        default='on', type=str, action='store',
+                        help='shared memory modes to run')
+    parser.add_argument('--low-impact', dest='low_impact', metavar='on|off[,...]',
+                        default='off', type=str, action='store',
+                        help='low-impact read modes to run')
+    parser.add_argument('--cold', dest='cold',
+                        action='store_true',
+                        help='evict each tree from the page cache and age its atimes before every run, '
+                             'and record page cache growth and atimes touched')
+    parser.add_argument('--buffers', dest='buffers', metavar='N1[,N2...]',
+                        default=[control_data['max_buffers']], type=int_list, action='store',
+                        help='buffer counts to run')
+    parser.add_argument('--blocksize', dest='blocksize', metavar='SIZE1[,SIZE2...]',
+                        default=[str(control_data['max_block_size_mb'])], type=size_list, action='store',
+                        help='block sizes to run, in MB or with a K or M suffix')
+    parser.add_argument('--digests', dest='digest_sets', metavar='DIGEST1[,DIGEST2...]',
+                        default=None, type=str, action='append',
+                        help='a digest set to run (repeatable; "noop" for noop0..noop7)')
+    parser.add_argument('--args', dest='extra_args', metavar='"ARGS"',
+                        default='', type=str, action='store',
+                        help='more digester arguments for every run')
+    parser.add_argument('--repeat', dest='repeat', metavar='N',
+                        default=1, type=int, action='store',
+                        help='runs per case (the fastest is kept)')
+    parser.add_argument('--output', dest='output', metavar='FILE',
+                        default=None, type=str, action='store',
+                        help='results file (default: dtbench.TIMESTAMP.json)')
+    parser.add_argument('--baseline', dest='baseline', metavar='FILE',
+                        default=None, type=str, action='store',
+                        help='earlier results to check for regressions against')
+    parser.add_argument('--threshold', dest='thresholds', metavar='METRIC=PCT',
+                        default=[], type=str, action='append',
+                        help='how many percent worse than the baseline a metric may get (repeatable)')
+    parser.add_argument('--debug', dest='debug',
+                        action='store_true',
+                        help='more debugging to the console')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO,
+        format='%(levelname)s:%(name)s:%(message)s')
+    logger = logging.getLogger('_main_')
+
+    args.trees = args.trees.split(',')
+    unknown = set(args.trees) - set(dtbench.TREE_PROFILES)
+    if unknown:
+        logger.error('Unknown tree profile(s): %s', ', '.join(sorted(unknown)))
+        return None
+    if not args.scale > 0:
+        logger.error('Scale must be > 0')
+        return None
+    shm_modes = {'on': True, 'off': False}
+    if not set(args.shm.split(',')) <= set(shm_modes):
+        logger.error('Shared memory modes must be on and/or off')
+        return None
+    args.shm = [shm_modes[mode] for mode in args.shm.split(',')]
+    if not set(args.low_impact.split(',')) <= set(shm_modes):
+        logger.error('Low-impact modes must be on and/or off')
+        return None
+    args.low_impact = [shm_modes[mode] for mode in args.low_impact.split(',')]
+    if not args.buffers or not all(2 <= count <= 32 for count in args.buffers):
+        logger.error('Buffer counts must be >= 2 and <= 32')
+        return None
+    block_sizes = [dtutils.parse_size(size) for size in args.blocksize]
+    if not block_sizes or not all(64 * 1024 <= size < 1024 * 1024 * 1024 for size in block_sizes):
+        logger.error('Block sizes must be >= 64KB and < 1024 MB')
+        return None
+    args.digest_sets = [
+        NOOP_DIGESTS if digests == 'noop' else digests
+        for digests in args.digest_sets or [','.join(control_data['default_digests'])]]
+    for digests in args.digest_sets:
+        unknown = set(digests.split(',')) - set(dtdigester.DIGEST_FUNCTIONS)
+        if unknown:
+            logger.error('Unknown digest(s): %s', ', '.join(sorted(unknown)))
+            return None
+    if args.repeat < 1:
+        logger.error('Repeat count must be >= 1')
+        return None
+    thresholds = {}
+    for threshold in args.thresholds:
+        (metric, _, pct) = threshold.partition('=')
+        try:
+            thresholds[metric] = float(pct)
+        except ValueError:
+            metric = None
+        if metric not in dtbench.THRESHOLDS:
+            logger.error('Thresholds must be METRIC=PCT, for metrics %s', ', '.join(sorted(dtbench.THRESHOLDS)))
+            return None
+    args.thresholds = thresholds
+    args.extra_args = shlex.split(args.extra_args)
+    if not args.output:
+        args.output = f'dtbench.{dtutils.datetime_as_str()}.json'
+    return args
+
+
+def run_benchmarks(args, workdir):
+    """ Run every case on every tree; returns the results """
+    logger = logging.getLogger('_main_')
+    results = dtbench.new_results(args.scale, args.seed)
+    rundir = os.path.join(workdir, 'runs')
+    os.makedirs(rundir, exist_ok=True)
+    cases = dtbench.expand_matrix(
+        args.shm, args.buffers, args.blocksize, args.digest_sets, args.extra_args, args.low_impact)
+    for tree in args.trees:
+        start_time = dtutils.curr_time_secs()
+        (root, manifest) = dtbench.ensure_tree(workdir, tree, args.scale, args.seed)
+        logger.info(
+            'Tree %s: %s (%d files, %d dirs, %d bytes) ready in %.1fs',
+            tree, root, manifest['files'], manifest['dirs'], manifest['bytes'],
+            dtutils.curr_time_secs() - start_time)
+        for case_args in cases:
+            case = dtbench.run_case(tree, root, case_args, rundir, args.repeat, args.cold)
+            case['tree_files'] = manifest['files']
+            case['tree_bytes'] = manifest['bytes']
+            results['cases'].append(case)
+    return results
+
+
+def main():
+    """ Main entry point """
+    package_data = dtconfig.PACKAGE_DATA
+
+    headline = f"{package_data['name']} Benchmarks {package_data['version']}"
+
+    print()
+    print(headline)
+    print()
+
+    args = validate_args()
+    if not args:
+        return False
+    logger = logging.getLogger('_main_')
+
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+        results = run_benchmarks(args, args.workdir)
+    else:
+        with tempfile.TemporaryDirectory(prefix='dtbench-') as workdir:
+            results = run_benchmarks(args, workdir)
+    with open(args.output, 'w', encoding='utf-8') as fileh:
+        json.dump(results, fileh, indent=2)
+    logger.info('Results: %s', args.output)
+
+    failed = [case['id'] for case in results['cases'] if case['returncode']]
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as fileh:
+            baseline = json.load(fileh)
+        regressions = dtbench.compare_to_baseline(results, baseline, args.thresholds)
+        for (case_id, metric, old, new, worse) in regressions:
+            logger.warning('REGRESSION: %s: %s %.3f -> %.3f (%.1f%% worse)', case_id, metric, old, new, worse)
+        logger.info('%d regression(s) against %s', len(regressions), args.baseline)
+        if regressions:
+            return False
+    return not failed
+
+
+def cli():
+    """ Console entry point: exit status 1 if any run failed or regressed """
+    sys.exit(0 if main() else 1)
@@ -55,6 +55,21 @@ def validate_args(headline):
     parser.add_argument('--nocase', dest='nocase',
                         action='store_true',
                         help='case insensitive matching')
+    parser.add_argument('--parsers', dest='parsers', metavar='N',
+                        default=control_data['report_parsers'], type=int, action='store',
+                        help='parse large text reports in chunks with N processes (0 = in-process)')
+    parser.add_argument('--external', dest='external', metavar='MB',
+                        default=control_data['compare_memory_mb'], type=int, action='store',
+                        help='compare through on-disk sorts using about MB of memory (0 = all in memory)')
+    parser.add_argument('--tempdir', dest='temp_dir', metavar='DIR',
+                        default=control_data['temp_dir'], type=str, action='store',
+                        help='directory for the on-disk sorts')
+    parser.add_argument('--bloom', dest='bloom',
+                        action='store_true',
+                        help='prefilter the on-disk digest join with Bloom filters')
+    parser.add_argument('--full', dest='full',
+                        action='store_true',
+                        help='compare every file, even under directories whose digests match')
     parser.add_argument('--debug', dest='debug',
                         action='store_true',
                         help='more debugging to the logfile')
@@ -124,6 +139,26 @@ def validate_args(headline):
         control_data['ignore_path_case'] = True
     logger.info('ignore_path_case: %s', control_data['ignore_path_case'])
 
+    if not 0 <= args.parsers <= control_data['max_concurrent_jobs']:
+        logger.error('Number of parsers must be >= 0 and <= %d', control_data['max_concurrent_jobs'])
+        return False
+    control_data['report_parsers'] = args.parsers
+    logger.info('report_parsers: %d', control_data['report_parsers'])
+
+    if args.external and args.external < 16:
+        logger.error('External compare memory must be >= 16MB')
+        return False
+    control_data['compare_memory_mb'] = args.external
+    control_data['temp_dir'] = args.temp_dir
+    control_data['bloom_filter'] = args.bloom
+    if control_data['compare_memory_mb']:
+        logger.info('compare_memory: %d MB', control_data['compare_memory_mb'])
+        logger.info('temp_dir: %s', control_data['temp_dir'])
+        logger.info('bloom_filter: %s', control_data['bloom_filter'])
+
+    control_data['full_compare'] = args.full
+    logger.info('full_compare: %s', control_data['full_compare'])
+
     return True
 
 
@@ -167,7 +202,10 @@ def main():
     # start_time = dtutils.curr_time_secs()
     logger.debug('MAINLINE starts')
 
-    comparator = dtcompare.Comparator(control_data=control_data)
+    if control_data['compare_memory_mb']:
+        comparator = dtcompare.ExternalComparator(control_data=control_data)
+    else:
+        comparator = dtcompare.Comparator(control_data=control_data)
 
     comparator.compare(
         file_l=control_data['file_l'],
@@ -191,6 +229,11 @@ def main():
         '#{}'.format('-' * 78),
     ]
     dtutils.outfile_write(control_data['outfile_name'], 'a', footer)
+    peak_rss = dtutils.peak_rss_bytes()
+    if peak_rss is not None:
+        elements = comparator.elements_l + comparator.elements_r
+        logger.info('Peak RSS: %s MB (%d bytes per element)', f'{peak_rss / (1024 * 1024):,.1f}',
+                    peak_rss // max(elements, 1))
     logger.debug('MAINLINE ends')
     logger.info('Log ends')
 
@@ -0,0 +1,152 @@
+"""
+
+    Copyright (c) 2017-2021 Martin F. Falatic
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+"""
+
+import argparse
+import logging
+import os
+
+import dirtreedigest.__config__ as dtconfig
+import dirtreedigest.digester as dtdigester
+import dirtreedigest.thdx as dtthdx
+import dirtreedigest.utils as dtutils
+import dirtreedigest.writer as dtwriter
+
+
+def validate_args():
+    """ Validate command-line arguments """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('infile', nargs='?', metavar='INFILE',
+                        default=None, type=str, action='store',
+                        help='report to convert (.thd text or .thdx binary)')
+    parser.add_argument('outfile', nargs='?', metavar='OUTFILE',
+                        default=None, type=str, action='store',
+                        help='converted report (default: INFILE with the other extension)')
+    parser.add_argument('--debug', dest='debug',
+                        action='store_true',
+                        help='more debugging to the console')
+    args = parser.parse_args()
+    if not args.infile:
+        parser.print_help()
+        return None
+    return args
+
+
+def element_line(elem):
+    """ A report line for an element as read by iter_dtd_report """
+    return '{};{{{}}};{};{};{};{};{};{};{}'.format(
+        elem['type'],
+        ', '.join('{}: {}'.format(i, elem['digests'][i]) for i in sorted(elem['digests'])),
+        elem['atime'], elem['mtime'], elem['ctime'],
+        elem['attr_std'], elem['attr_win'],
+        elem['size'],
+        elem['full_name'])
+
+
+def thd_to_thdx(infile, outfile, logger):
+    """ Convert a text report to the binary format """
+    header = {'basepath': '', 'summary': None, 'tree_digests': None, 'stage_times': None, 'stage_lines': None}
+    elements = dtutils.iter_dtd_report(infile, logger, header, all_types=True)
+    first = next(elements, None)
+    digest_widths = {}
+    if first:
+        for (digest_name, digest_value) in first['digests'].items():
+            if digest_name in dtdigester.DIGEST_FUNCTIONS:
+                digest_widths[digest_name] = dtdigester.DIGEST_FUNCTIONS[digest_name]['len'] // 2
+            else:
+                digest_widths[digest_name] = len(digest_value) // 2
+    writer = dtthdx.ThdxWriter(outfile, header['basepath'], digest_widths)
+    if first:
+        for elem in _chain(first, elements):
+            writer.write(
+                elem['type'],
+                elem['digests'],
+                int(elem['atime'], 16), int(elem['mtime'], 16), int(elem['ctime'], 16),
+                int(elem['attr_std'], 16), int(elem['attr_win'], 16),
+                int(elem['size'], 16),
+                elem['full_name'])
+    if header['stage_lines']:
+        header['stage_times'] = dtutils.parse_stage_table(header['stage_lines'])
+    writer.close(header['summary'], header['tree_digests'], header['stage_times'], header['stage_lines'])
+    return writer.rows
+
+
+def thdx_to_thd(infile, outfile, logger):
+    """ Convert a binary report to the text format """
+    header = {'basepath': '', 'summary': None, 'tree_digests': None, 'stage_times': None, 'stage_lines': None}
+    elements = dtutils.iter_dtd_report(infile, logger, header, all_types=True)
+    first = next(elements, None)  # Reads the header
+    rows = 0
+    with open(outfile, 'w', encoding='utf-8') as fileh:
+        fileh.write('\n'.join(dtwriter.header_lines(header['basepath'])) + '\n')
+        if first:
+            for elem in _chain(first, elements):
+                fileh.write(element_line(elem) + '\n')
+                rows += 1
+        if header['summary']:
+            stage_lines = header['stage_lines']
+            if not stage_lines and header['stage_times']:
+                stage_lines = dtutils.stage_table(header['stage_times'])
+            fileh.write('\n'.join(
+                dtwriter.footer_lines(header['summary'], header['tree_digests'], stage_lines)) + '\n')
+    return rows
+
+
+def _chain(first, rest):
+    """ Put back an element taken from the front of a generator """
+    yield first
+    yield from rest
+
+
+def main():
+    """ Main entry point """
+    package_data = dtconfig.PACKAGE_DATA
+
+    headline = f"{package_data['name']} Converter {package_data['version']}"
+
+    print()
+    print(headline)
+    print()
+
+    args = validate_args()
+    if not args:
+        return False
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO,
+        format='%(levelname)s:%(name)s:%(message)s')
+    logger = logging.getLogger('_main_')
+
+    to_text = dtthdx.is_thdx(args.infile)
+    outfile = args.outfile
+    if not outfile:
+        (root, ext) = os.path.splitext(args.infile)
+        outfile = root + ('.thd' if to_text else '.' + dtthdx.EXTENSION)
+    if os.path.abspath(outfile) == os.path.abspath(args.infile):
+        logger.error('Output would overwrite the input: %s', outfile)
+        return False
+
+    start_time = dtutils.curr_time_secs()
+    if to_text:
+        rows = thdx_to_thd(args.infile, outfile, logger)
+    else:
+        rows = thd_to_thdx(args.infile, outfile, logger)
+    delta_time = dtutils.curr_time_secs() - start_time
+    logger.info(
+        'WROTE : %s (%d elements, %d -> %d bytes) in %.3fs',
+        outfile, rows, os.path.getsize(args.infile), os.path.getsize(outfile), delta_time)
+    return True
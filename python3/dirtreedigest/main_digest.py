@@ -22,9 +22,14 @@ import os
 import sys
 
 import dirtreedigest.__config__ as dtconfig
+import dirtreedigest.cache as dtcache
+import dirtreedigest.calibrate as dtcalibrate
 import dirtreedigest.digester as dtdigester
+import dirtreedigest.progress as dtprogress
+import dirtreedigest.thdx as dtthdx
 import dirtreedigest.utils as dtutils
 import dirtreedigest.walker as dtwalker
+import dirtreedigest.writer as dtwriter
 
 
 def validate_args(headline):
@@ -55,21 +60,98 @@ def validate_args(headline):
     parser.add_argument('--tstamp', dest='output_tstamp', metavar='TIMESTAMP',
                         default=None, type=str, action='store',
                         help='alternate output timestamp')
-    parser.add_argument('--blocksize', dest='blocksize', metavar='MBYTES',
-                        default=control_data['max_block_size_mb'], type=int, action='store',
-                        help='block size in MB')
+    parser.add_argument('--flush', dest='flush_secs', metavar='SECS',
+                        default=control_data['report_flush_secs'], type=float, action='store',
+                        help='seconds between report flushes')
+    parser.add_argument('--fsync', dest='fsync',
+                        default=control_data['report_fsync'], choices=dtwriter.FSYNC_POLICIES,
+                        help='fsync the report on every flush, only at close, or never')
+    parser.add_argument('--blocksize', dest='blocksize', metavar='SIZE',
+                        default=str(control_data['max_block_size_mb']), type=dtutils.parse_size, action='store',
+                        help='largest block size, in MB or with a K or M suffix')
+    parser.add_argument('--minblock', dest='minblock', metavar='SIZE',
+                        default='{}K'.format(control_data['min_block_size_kb']), type=dtutils.parse_size,
+                        action='store',
+                        help='smallest block size, in MB or with a K or M suffix (= --blocksize for fixed blocks)')
     parser.add_argument('--buffers', dest='buffers', metavar='N',
                         default=control_data['max_buffers'], type=int, action='store',
-                        help='number of buffers')
+                        help='most buffers in use at once')
+    parser.add_argument('--buffer-memory', dest='buffer_memory', metavar='MBYTES',
+                        default=control_data['buffer_memory_mb'], type=int, action='store',
+                        help='most memory in MB for buffers (0 = buffers x block size)')
+    parser.add_argument('--inline', dest='inline', metavar='KBYTES',
+                        default=control_data['inline_max_size_kb'], type=int, action='store',
+                        help='max file size in KB to digest in-process (0 = empty files only)')
+    parser.add_argument('--pack', dest='pack',
+                        action='store_true',
+                        help='pack cheap digests together onto workers, using the saved calibration table')
+    parser.add_argument('--calibrate', dest='calibrate',
+                        action='store_true',
+                        help='measure every selected digest\'s throughput and save it (implies --pack)')
+    parser.add_argument('--calibration', dest='calibration_file', metavar='FILE',
+                        default=None, type=str, action='store',
+                        help='calibration table to use (implies --pack; default {})'.format(
+                            dtcalibrate.default_calibration_file().replace('%', '%%')))
+    parser.add_argument('--engine', dest='engine',
+                        default=control_data['engine'], choices=['processes', 'threads'],
+                        help='digest in worker processes or on an in-process thread pool')
+    parser.add_argument('--filepool', dest='filepool', metavar='N',
+                        default=control_data['file_pool_size'], type=int, action='store',
+                        help='processes digesting whole files in parallel (0 = off)')
+    parser.add_argument('--filepool-max', dest='filepool_max', metavar='MBYTES',
+                        default=control_data['file_pool_max_size_mb'], type=int, action='store',
+                        help='largest file in MB sent to the file pool; larger files use --engine')
+    parser.add_argument('--prefetch', dest='prefetch', metavar='N',
+                        default=control_data['pipeline_depth'], type=int, action='store',
+                        help='number of files to digest concurrently (1 = no pipelining)')
+    parser.add_argument('--walkers', dest='walkers', metavar='N',
+                        default=control_data['walk_threads'], type=int, action='store',
+                        help='threads scanning directories ahead of the walk (0 = none)')
+    parser.add_argument('--cache', dest='cache',
+                        action='store_true',
+                        help='reuse digests of unchanged files from a persistent cache')
+    parser.add_argument('--cachefile', dest='cache_file', metavar='FILE',
+                        default=None, type=str, action='store',
+                        help='cache database to use (implies --cache; default {})'.format(
+                            dtcache.default_cache_file().replace('%', '%%')))
+    parser.add_argument('--cache-age', dest='cache_age', metavar='DAYS',
+                        default=control_data['cache_max_age_days'], type=int, action='store',
+                        help='drop cache entries unused for this many days')
+    parser.add_argument('--cache-max', dest='cache_max', metavar='MBYTES',
+                        default=control_data['cache_max_size_mb'], type=int, action='store',
+                        help='trim the least recently used cache entries beyond this size')
+    parser.add_argument('--thdx', dest='thdx',
+                        action='store_true',
+                        help='also write a binary columnar report (.thdx)')
     parser.add_argument('--noshm', dest='noshm',
                         action='store_true',
                         help='don\'t use shared memory')
+    parser.add_argument('--mmap', dest='mmap',
+                        action='store_true',
+                        help='memory-map input files instead of reading them')
+    parser.add_argument('--low-impact', dest='low_impact',
+                        action='store_true',
+                        help='leave access times and the page cache alone (O_NOATIME, posix_fadvise)')
     parser.add_argument('--nocase', dest='nocase',
                         action='store_true',
                         help='case insensitive matching')
     parser.add_argument('--debug', dest='debug',
                         action='store_true',
                         help='more debugging to the logfile')
+    parser.add_argument('--progress', dest='progress_secs', metavar='SECS',
+                        default=control_data['progress_secs'], type=float, action='store',
+                        help='report progress every SECS seconds (0 = never)')
+    parser.add_argument('--progress-format', dest='progress_format',
+                        default=control_data['progress_format'], choices=dtprogress.PROGRESS_FORMATS,
+                        help='tty: a status line on the terminal; lines: PROGRESS key=value lines on stdout; '
+                             'auto: tty if there is one')
+    parser.add_argument('--prescan', dest='prescan',
+                        action='store_true',
+                        help='count the tree\'s files and bytes alongside the run for progress percentages and ETA '
+                             '(with --update, the old report\'s totals are used otherwise)')
+    parser.add_argument('--profile', dest='profile',
+                        action='store_true',
+                        help='run each process under cProfile, saving TITLE.TIMESTAMP.PROCESS.prof files')
     parser.add_argument('--xfiles', dest='excluded_files', metavar='FILE1[,FILE2...]',
                         default=None, type=str, action='append',
                         help='excluded files')
@@ -119,6 +201,21 @@ def validate_args(headline):
         control_data['logfile_ext'],
     )
 
+    control_data['thdx_name'] = None
+    if args.thdx:
+        control_data['thdx_name'] = '{}.{}.{}'.format(
+            output_title,
+            output_tstamp,
+            dtthdx.EXTENSION,
+        )
+
+    control_data['profile_prefix'] = None
+    if args.profile:
+        control_data['profile_prefix'] = '{}.{}'.format(
+            output_title,
+            output_tstamp,
+        )
+
     control_data['update_file'] = args.update_file
 
     dtutils.start_logging(
@@ -140,12 +237,33 @@ def validate_args(headline):
         logger.error('Root dir is not a directory / does not exist!')
         return False
 
-    if not 1 <= args.blocksize < 1024:
-        logger.error('Block size must be >= 1MB and < 1024 MB')
+    if not args.flush_secs > 0:
+        logger.error('Flush interval must be > 0 seconds')
+        return False
+    control_data['report_flush_secs'] = args.flush_secs
+    control_data['report_fsync'] = args.fsync
+    logger.info('report_flush_secs: %.1f fsync: %s', control_data['report_flush_secs'], control_data['report_fsync'])
+
+    if not 64 * 1024 <= args.blocksize < 1024 * 1024 * 1024:
+        logger.error('Block size must be >= 64KB and < 1024 MB')
+        return False
+    control_data['max_block_size'] = args.blocksize
+    control_data['max_block_size_mb'] = args.blocksize / 1024 / 1024
+    logger.info('max_block_size: %d KB', control_data['max_block_size'] // 1024)
+
+    if not 4 * 1024 <= args.minblock <= args.blocksize:
+        logger.error('Smallest block size must be >= 4KB and <= block size')
+        return False
+    control_data['min_block_size'] = args.minblock
+    control_data['min_block_size_kb'] = args.minblock // 1024
+    logger.info('min_block_size: %d KB', control_data['min_block_size_kb'])
+
+    if not 0 <= args.inline * 1024 < args.blocksize:
+        logger.error('Inline size must be >= 0KB and < block size')
         return False
-    control_data['max_block_size_mb'] = args.blocksize
-    control_data['max_block_size'] = args.blocksize * 1024 * 1024
-    logger.info('max_block_size: %d MB', control_data['max_block_size_mb'])
+    control_data['inline_max_size_kb'] = args.inline
+    control_data['inline_max_size'] = args.inline * 1024
+    logger.info('inline_max_size: %d KB', control_data['inline_max_size_kb'])
 
     if not 2 <= args.buffers <= 32:
         logger.error('Number of buffers must be >= 2 and <= 32')
@@ -153,11 +271,81 @@ def validate_args(headline):
     control_data['max_buffers'] = args.buffers
     logger.info('max_buffers: %d', control_data['max_buffers'])
 
+    if args.buffer_memory and args.buffer_memory * 1024 * 1024 < args.blocksize:
+        logger.error('Buffer memory must be 0 or >= block size')
+        return False
+    control_data['buffer_memory_mb'] = args.buffer_memory
+    control_data['buffer_memory'] = args.buffer_memory * 1024 * 1024 or args.buffers * args.blocksize
+    logger.info('buffer_memory: %d MB', control_data['buffer_memory'] // 1024 // 1024)
+
+    if not 1 <= args.prefetch <= 1024:
+        logger.error('Prefetch depth must be >= 1 and <= 1024')
+        return False
+    control_data['pipeline_depth'] = args.prefetch
+
+    if not 0 <= args.filepool <= control_data['max_concurrent_jobs']:
+        logger.error('File pool size must be >= 0 and <= %d', control_data['max_concurrent_jobs'])
+        return False
+    if args.filepool_max < 1:
+        logger.error('File pool max size must be >= 1MB')
+        return False
+    control_data['file_pool_size'] = args.filepool
+    control_data['file_pool_max_size_mb'] = args.filepool_max
+    control_data['file_pool_max_size'] = args.filepool_max * 1024 * 1024
+    if control_data['file_pool_size']:
+        # Keep every pool process busy, with a file queued behind each one
+        control_data['pipeline_depth'] = max(control_data['pipeline_depth'], 2 * control_data['file_pool_size'])
+        logger.info('file_pool_size: %d', control_data['file_pool_size'])
+        logger.info('file_pool_max_size: %d MB', control_data['file_pool_max_size_mb'])
+    logger.info('pipeline_depth: %d', control_data['pipeline_depth'])
+
+    if not 0 <= args.walkers <= 64:
+        logger.error('Number of walker threads must be >= 0 and <= 64')
+        return False
+    control_data['walk_threads'] = args.walkers
+    logger.info('walk_threads: %d', control_data['walk_threads'])
+
+    if args.cache or args.cache_file:
+        if args.cache_age < 1 or args.cache_max < 1:
+            logger.error('Cache age must be >= 1 day and cache size >= 1MB')
+            return False
+        control_data['cache_file'] = args.cache_file or dtcache.default_cache_file()
+        control_data['cache_max_age_days'] = args.cache_age
+        control_data['cache_max_size_mb'] = args.cache_max
+        logger.info('cache_file: %s', control_data['cache_file'])
+        logger.info('cache_max_age_days: %d cache_max_size: %d MB',
+                    control_data['cache_max_age_days'], control_data['cache_max_size_mb'])
+
+    control_data['engine'] = args.engine
+    logger.info('engine: %s', control_data['engine'])
+
+    if args.pack or args.calibrate or args.calibration_file:
+        control_data['calibration_file'] = args.calibration_file or dtcalibrate.default_calibration_file()
+        control_data['calibrate'] = bool(args.calibrate)
+        logger.info('calibration_file: %s calibrate: %s', control_data['calibration_file'], control_data['calibrate'])
+
     control_data['shm_mode'] = True
     if args.noshm or not dtutils.shared_memory_available():
         control_data['shm_mode'] = False
     logger.info('shm_mode: %s', control_data['shm_mode'])
 
+    control_data['mmap_mode'] = bool(args.mmap)
+    logger.info('mmap_mode: %s', control_data['mmap_mode'])
+
+    control_data['low_impact'] = bool(args.low_impact)
+    logger.info('low_impact: %s', control_data['low_impact'])
+
+    logger.info('profile_prefix: %s', control_data['profile_prefix'])
+
+    if args.progress_secs < 0:
+        logger.error('Progress interval must be >= 0')
+        return False
+    control_data['progress_secs'] = args.progress_secs
+    control_data['progress_format'] = args.progress_format
+    control_data['progress_prescan'] = bool(args.prescan)
+    logger.info('progress_secs: %s progress_format: %s progress_prescan: %s',
+                control_data['progress_secs'], control_data['progress_format'], control_data['progress_prescan'])
+
     control_data['ignore_path_case'] = False
     if args.nocase:
         control_data['ignore_path_case'] = True
@@ -211,56 +399,51 @@ def main():
     if not validate_args(headline):
         return False
 
-    logger = logging.getLogger('_main_')
+    return dtutils.run_profiled(dtutils.profile_name(control_data['profile_prefix'], 'main'), digest_tree, control_data)
 
-    header1 = [
-        '#{}'.format('-' * 78),
-        '#',
-        '#  Base path: {}'.format(control_data['root_dir']),
-        '#',
-        '#{}'.format('-' * 78),
-    ]
-    header2 = [
-        '#{}'.format('-' * 78),
-        '',
-    ]
+
+def digest_tree(control_data):
+    """ Digest the tree and write the reports, once the arguments are in control_data """
+    logger = logging.getLogger('_main_')
 
     logger.debug('Logging out: %s', control_data['logfile_name'])
     logger.debug('Main output: %s', control_data['outfile_name'])
 
-    outfile_header = '#         Digests               |'
-    outfile_header += 'accessT |modifyT |createT |attr|watr|'
-    outfile_header += '   size   |relative name'
     dtutils.outfile_write(
         control_data['outfile_name'],
         'w',
-        header1 + [outfile_header] + header2,
+        dtwriter.header_lines(control_data['root_dir']),
     )
-    altfile_header = '#        {} signature          |'
-    altfile_header += 'accessT |modifyT |createT |watr|'
-    altfile_header += '   size   |relative name'
     if control_data['altfile_digest']:
         logger.info('Alt  output: %s', control_data['altfile_name'])
         dtutils.outfile_write(
             control_data['altfile_name'],
             'w',
-            header1 + [altfile_header.format(control_data['altfile_digest'])] + header2,
+            dtwriter.header_lines(
+                control_data['root_dir'], dtwriter.ALT_COLUMNS.format(control_data['altfile_digest'])),
         )
+    if control_data['thdx_name']:
+        logger.info('Binary output: %s', control_data['thdx_name'])
 
     start_time = dtutils.curr_time_secs()
+    start_cpu_time = dtutils.cpu_time_secs()
     logger.debug('MAINLINE starts - max_block_size=%d', control_data['max_block_size'])
     logger.debug('-;%s', dtdigester.fill_digest_str(control_data=control_data))
 
-    control_data['update_elements'] = {}
+    control_data['update_report'] = None
     if control_data['update_file']:
         file_u = control_data['update_file']
-        (basepath_u, elements_u) = dtutils.read_dtd_report(file_u, logger)
-        if not elements_u:
+        update_report = dtutils.ReportCursor(dtutils.iter_dtd_report(file_u, logger), logger)
+        if not update_report.current:
             logger.warning('Update file had no data')
-        if not set(control_data['selected_digests']) >= set(elements_u[0]['digests'].keys()):
+        elif not set(control_data['selected_digests']) >= set(update_report.current['digests'].keys()):
             logger.error('Update file digests are not a subset of current digests!')
+            update_report.close()
             return False
-        control_data['update_elements'] = {x['full_name']: x for x in elements_u}
+        control_data['update_report'] = update_report
+
+    if control_data['calibration_file'] and control_data['engine'] == 'processes':
+        control_data['worker_digests'] = dtcalibrate.plan_workers(control_data)
 
     walk_item = dtwalker.Walker()
     try:
@@ -284,20 +467,72 @@ def main():
         control_data['counts']['bytes_read'] / 1024 / 1024 / delta_walk_time,
         control_data['counts']['bytes_read'],
     )
-    footer = [
-        '',
-        '#{}'.format('-' * 78),
-        '#',
-        '#  Processed: {:,d} file(s), {:,d} folder(s) ({:,d} ignored, {:,d} errors) comprising {:,d} bytes'.format(
-            control_data['counts']['files'],
-            control_data['counts']['dirs'],
-            control_data['counts']['ignored'],
-            control_data['counts']['errors'],
-            control_data['counts']['bytes_read'],
-        ),
-        '#',
-        '#{}'.format('-' * 78),
-    ]
+    walk_stats = control_data['walk_stats']
+    logger.info(
+        'walk: dirs= %d entries= %d rate= %.1f entries/s stat_latency= %.1f us',
+        walk_stats['dirs'],
+        walk_stats['entries'],
+        walk_stats['entries'] / delta_walk_time,
+        1000000.0 * walk_stats['stat_time'] / max(walk_stats['stat_calls'], 1),
+    )
+    logger.info(
+        'copy_ratio= %.2f bytes copied per byte hashed (bytes_copied= %d)',
+        control_data['counts']['bytes_copied'] / max(control_data['counts']['bytes_read'], 1),
+        control_data['counts']['bytes_copied'],
+    )
+    logger.info('hole_bytes= %d (in sparse files: hashed as zeros, not read)', control_data['counts']['hole_bytes'])
+    if control_data['cache_file']:
+        logger.info('cache_hits= %d', control_data['counts']['cache_hits'])
+    queue_messages = control_data['counts']['queue_messages'] + sum(
+        proc_stats.get('messages', 0) for proc_stats in control_data['proc_stats'])
+    logger.info(
+        'queue_msgs= %d (%.2f per MB hashed)',
+        queue_messages,
+        queue_messages / max(control_data['counts']['bytes_read'] / 1024 / 1024, 1e-6),
+    )
+    parent_stats = dtutils.cpu_stats(start_time, start_cpu_time)
+    parent_stats['proc'] = '---Main'
+    busy_time = 0.0
+    for proc_stats in [parent_stats] + sorted(control_data['proc_stats'], key=lambda k: k['proc']):
+        busy_time += proc_stats['cpu_time']
+        logger.info(
+            'cpu_time= %.3fs wall_time= %.3fs busy= %.1f%% %s',
+            proc_stats['cpu_time'],
+            proc_stats['wall_time'],
+            proc_stats['busy_pct'],
+            proc_stats['proc'],
+        )
+        if 'blocks' in proc_stats:
+            logger.info(
+                '    files= %d blocks= %d bytes= %d msgs= %d wait_time= %.3fs %s',
+                proc_stats['files'],
+                proc_stats['blocks'],
+                proc_stats['bytes'],
+                proc_stats['messages'],
+                proc_stats['wait_time'],
+                ' '.join(f'{key}= {proc_stats[key]:.3f}s' for key in ['read_time', 'hash_time'] if key in proc_stats)
+                + (f" digest= {proc_stats['digest']}" if 'digest' in proc_stats else ''),
+            )
+        if 'buffer_peak' in proc_stats:
+            logger.info(
+                '    buffer_peak= %d KB buffer_allocs= %d buffers_busy= %d',
+                proc_stats['buffer_peak'] // 1024,
+                proc_stats['buffer_allocs'],
+                proc_stats['buffers_busy'],
+            )
+    logger.info(
+        'cpu_busy= %.3fs of %.3fs wall (%.2f cores busy across %d processes)',
+        busy_time,
+        delta_time,
+        busy_time / delta_time,
+        len(control_data['proc_stats']) + 1,
+    )
+    stage_lines = dtutils.stage_table(control_data['stage_times'], delta_walk_time)
+    logger.info('stage times (summed over all processes and threads):')
+    for line in stage_lines:
+        logger.info('    %s', line)
+    footer = dtwriter.footer_lines(
+        dtwriter.summary_line(control_data['counts']), control_data['tree_digests'], stage_lines)
     dtutils.outfile_write(control_data['outfile_name'], 'a', footer)
     if control_data['altfile_digest']:
         dtutils.outfile_write(control_data['altfile_name'], 'a', footer)
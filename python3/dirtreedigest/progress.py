@@ -0,0 +1,238 @@
+"""
+
+    Copyright (c) 2017-2021 Martin F. Falatic
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Live progress of a digester run
+
+    The walker only bumps a few counters per file; a background thread
+    reports on them every so often, either as a status line redrawn in
+    place on a terminal or as key=value lines for other programs to read.
+    Totals for percentages and ETAs are estimated alongside the run, from
+    a quick pre-scan of the tree or from the report being updated.
+
+"""
+
+import logging
+import os
+import stat
+import sys
+import threading
+
+import dirtreedigest.utils as dtutils
+
+PROGRESS_FORMATS = ['auto', 'tty', 'lines']
+
+
+def prescan_totals(root_dir, ignored_dir_pats, ignored_file_pats):
+    """ Count the regular files under root_dir and their bytes, as the walk will find them
+        Returns (files, bytes)
+    """
+    files = 0
+    total_bytes = 0
+    dirs = [root_dir]
+    while dirs:
+        try:
+            with os.scandir(dirs.pop()) as dir_iter:
+                entries = list(dir_iter)
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                stats = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if stat.S_ISDIR(stats.st_mode):
+                if not dtutils.name_is_matched(entry.name, ignored_dir_pats):
+                    dirs.append(entry.path)
+            elif stat.S_ISREG(stats.st_mode) and not dtutils.name_is_matched(entry.name, ignored_file_pats):
+                files += 1
+                total_bytes += stats.st_size
+    return (files, total_bytes)
+
+
+def report_totals(filename):
+    """ The files and bytes an earlier report recorded
+        Returns (files, bytes)
+    """
+    logger = logging.getLogger('progress')
+    files = 0
+    total_bytes = 0
+    for elem in dtutils.iter_dtd_report(filename, logger):
+        if elem['type'] == 'F':
+            files += 1
+            total_bytes += int(elem['size'], 16)
+    return (files, total_bytes)
+
+
+def format_duration(secs):
+    """ H:MM:SS """
+    secs = int(secs + 0.5)
+    return '{}:{:02d}:{:02d}'.format(secs // 3600, secs // 60 % 60, secs % 60)
+
+
+def format_bytes(count):
+    """ Bytes in the largest unit that keeps the number at or above 1 """
+    value = float(count)
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if value < 1024 or unit == 'TB':
+            break
+        value /= 1024
+    return f'{value:.1f} {unit}'
+
+
+class ProgressReporter(object):
+    """ Reports a run's progress every interval seconds from a background thread
+
+        Call add() for each file as it's finished, start() and stop() around
+        the walk. Files whose digests were reused (from the update baseline
+        or the cache) count towards the totals but not the rates, which are
+        for hashing. estimate is a function returning (files, bytes) to be run
+        on its own thread, or None to go without totals. With fmt 'tty' the
+        status is redrawn in place (on stderr by default); with 'lines' each
+        report is a line of key=value pairs (on stdout by default), such as:
+
+            PROGRESS elapsed_s=12.0 files=120 files_total=1000 bytes=... bytes_total=... bytes_reused=...
+              files_reused=0 files_per_s=10.0 mb_per_s=3.2 bytes_remaining=... eta_s=108 done=0
+    """
+
+    def __init__(self, interval, fmt='auto', estimate=None, stream=None):
+        self.logger = logging.getLogger('progress')
+        self.interval = interval
+        if fmt == 'auto':
+            fmt = 'tty' if (stream or sys.stderr).isatty() else 'lines'
+        self.fmt = fmt
+        self.stream = stream or (sys.stderr if fmt == 'tty' else sys.stdout)
+        self.estimate = estimate
+        self.files = 0  # Only the walker's thread changes these
+        self.bytes = 0
+        self.files_reused = 0
+        self.bytes_reused = 0
+        self.files_total = None
+        self.bytes_total = None
+        self.start_time = None
+        self.stopping = threading.Event()
+        self.thread = None
+        self.estimate_thread = None
+
+    def add(self, size, reused=False):
+        """ Count a finished file (reused: its digests weren't computed this run) """
+        self.files += 1
+        self.bytes += size
+        if reused:
+            self.files_reused += 1
+            self.bytes_reused += size
+
+    def start(self):
+        """ Start the clock, the reports and the estimate (if any) """
+        self.start_time = dtutils.curr_time_secs()
+        if self.estimate:
+            self.estimate_thread = threading.Thread(target=self._estimate, name='progress-estimate', daemon=True)
+            self.estimate_thread.start()
+        self.thread = threading.Thread(target=self._run, name='progress', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ Stop reporting, after one last report """
+        if not self.thread:
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+        self._emit(done=True)
+
+    def status(self):
+        """ Progress so far: a dict of the values reported """
+        elapsed = max(dtutils.curr_time_secs() - self.start_time, 1e-6)
+        (files, done_bytes) = (self.files, self.bytes)
+        (reused_files, reused_bytes) = (self.files_reused, self.bytes_reused)
+        (hashed_files, hashed_bytes) = (files - reused_files, done_bytes - reused_bytes)
+        (files_total, bytes_total) = (self.files_total, self.bytes_total)
+        status = {
+            'elapsed_s': elapsed,
+            'files': files,
+            'files_total': files_total,
+            'bytes': done_bytes,
+            'bytes_total': bytes_total,
+            'bytes_reused': reused_bytes,
+            'files_reused': reused_files,
+            'files_per_s': hashed_files / elapsed,
+            'mb_per_s': hashed_bytes / 1024 / 1024 / elapsed,
+            'bytes_remaining': None,
+            'eta_s': None,
+        }
+        if bytes_total is not None:
+            # Estimates may be off (the tree changes, or the update baseline is old): never go below zero
+            status['bytes_remaining'] = max(bytes_total - done_bytes, 0)
+            if bytes_total > 0 and hashed_bytes > 0:  # At the hashing rate: reused bytes come almost free
+                status['eta_s'] = status['bytes_remaining'] * elapsed / hashed_bytes
+            elif files_total and hashed_files:
+                status['eta_s'] = max(files_total - files, 0) * elapsed / hashed_files
+        return status
+
+    def format_line(self, status, done=False):
+        """ One report, in the reporter's format """
+        if self.fmt == 'lines':
+            fields = ['elapsed_s', 'files', 'files_total', 'bytes', 'bytes_total', 'bytes_reused', 'files_reused',
+                      'files_per_s', 'mb_per_s', 'bytes_remaining', 'eta_s']
+            values = []
+            for key in fields:
+                value = status[key]
+                if value is None:
+                    value = '-'
+                elif isinstance(value, float):
+                    value = f'{value:.1f}' if key != 'eta_s' else f'{value:.0f}'
+                values.append(f'{key}={value}')
+            return 'PROGRESS {} done={}\n'.format(' '.join(values), int(done))
+        parts = [f"{status['files']:,d}"]
+        if status['files_total'] is not None:
+            parts[0] += f"/{status['files_total']:,d}"
+        parts[0] += ' files'
+        done_bytes = format_bytes(status['bytes'])
+        if status['bytes_total'] is not None:
+            done_bytes += ' of ' + format_bytes(status['bytes_total'])
+            if status['bytes_total']:
+                done_bytes += ' ({:.0f}%)'.format(min(100.0, 100.0 * status['bytes'] / status['bytes_total']))
+        if status['bytes_reused']:
+            done_bytes += ', {} reused'.format(format_bytes(status['bytes_reused']))
+        parts.append(done_bytes)
+        parts.append(f"{status['files_per_s']:.0f} files/s")
+        parts.append(f"{status['mb_per_s']:.1f} MB/s")
+        if done:
+            parts.append('in ' + format_duration(status['elapsed_s']))
+        elif status['eta_s'] is not None:
+            parts.append('ETA ' + format_duration(status['eta_s']))
+        return '\r{}\x1b[K{}'.format(' | '.join(parts), '\n' if done else '')
+
+    def _emit(self, done=False):
+        try:
+            self.stream.write(self.format_line(self.status(), done))
+            self.stream.flush()
+        except (OSError, ValueError):  # Closed or broken pipe: not worth stopping the run for
+            pass
+
+    def _run(self):
+        """ Reporting thread """
+        while not self.stopping.wait(self.interval):
+            self._emit()
+
+    def _estimate(self):
+        """ Estimating thread """
+        try:
+            (files_total, bytes_total) = self.estimate()
+        except (OSError, ValueError) as err:
+            self.logger.warning('No progress estimate: %s', err)
+            return
+        (self.files_total, self.bytes_total) = (files_total, bytes_total)
+        self.logger.debug('Progress estimate: %d files, %d bytes', files_total, bytes_total)
@@ -20,7 +20,11 @@
 
 """
 
+import collections
+import errno
 import logging  # For constants - do not log directly from here
+import mmap
+import multiprocessing
 import os
 import queue
 
@@ -31,122 +35,531 @@ if dtutils.shared_memory_available():
 else:
     shared_memory = None
 
+# Blocks should take about this long at the run's slowest stage
+BLOCK_TARGET_SECS = 0.02
 
-def reader_process(debug_queue, cmd_queue, results_queue, shm_mode, max_block_size):
+# How far each file's measured throughput moves the running estimate
+RATE_WEIGHT = 0.25
+
+# Evened-out block sizes are rounded up to a multiple of this
+BLOCK_ALIGN = 4096
+
+# Free buffers unused for this long are given back
+BUFFER_IDLE_SECS = 5.0
+
+
+def read_block_into(file_obj, file_map, offset, block_view):
+    """ Fill block_view with file data starting at offset, without intermediate copies
+        Returns the number of bytes read, which is only short if the file was truncated
+    """
+    if file_map is not None:
+        count = max(0, min(len(block_view), len(file_map) - offset))
+        with memoryview(file_map) as map_view:
+            block_view[:count] = map_view[offset:offset + count]
+        return count
+    total = 0
+    while total < len(block_view):
+        with block_view[total:] as view:
+            count = file_obj.readinto(view)
+        if not count:
+            break
+        total += count
+    return total
+
+
+def open_element(element, low_impact=False):
+    """ Open a file for digesting, unbuffered
+
+        With low_impact, the file is opened with O_NOATIME where there is
+        one and it's allowed (for the file's owner or root, else it's opened
+        as usual), so reading doesn't touch its access time, and the kernel
+        is told that reads will be sequential.
+    """
+    if not low_impact:
+        return open(element, 'rb', buffering=0)
+    flags = os.O_RDONLY | getattr(os, 'O_BINARY', 0)
+    noatime = getattr(os, 'O_NOATIME', 0)
+    try:
+        fd = os.open(element, flags | noatime)
+    except PermissionError:
+        if not noatime:
+            raise
+        fd = os.open(element, flags)
+    file_obj = os.fdopen(fd, 'rb', buffering=0)
+    _advise(file_obj.fileno(), 0, 0, 'SEQUENTIAL')
+    return file_obj
+
+
+def _advise(fd, offset, length, advice):
+    """ posix_fadvise, where there is one: it's only advice, so failures don't matter """
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, offset, length, getattr(os, 'POSIX_FADV_' + advice))
+        except OSError:
+            pass
+
+
+def advise_read(file_obj, file_map, offset, count, next_count=0):
+    """ Low-impact mode: drop a block just read from the page cache, and prefetch the next one
+
+        The block's pages are dropped whether or not this read brought
+        them in. A mapped file's pages are unmapped first, or they'd stay.
+    """
+    if file_map is not None and hasattr(file_map, 'madvise') and count:
+        start = offset - offset % mmap.PAGESIZE
+        try:
+            file_map.madvise(mmap.MADV_DONTNEED, start, offset + count - start)
+        except (OSError, ValueError):
+            pass
+    _advise(file_obj.fileno(), offset, count, 'DONTNEED')
+    if next_count:
+        _advise(file_obj.fileno(), offset + count, next_count, 'WILLNEED')
+
+
+def is_sparse(file_obj):
+    """ Whether a file may have holes: fewer bytes allocated to it than its size """
+    if not hasattr(os, 'SEEK_DATA'):
+        return False
+    stats = os.fstat(file_obj.fileno())
+    return getattr(stats, 'st_blocks', None) is not None and stats.st_blocks * 512 < stats.st_size
+
+
+def next_extent(fd, offset, size):
+    """ How far the hole or the data at offset goes: returns (is_hole, end) """
+    try:
+        data_start = os.lseek(fd, offset, os.SEEK_DATA)
+        if data_start > offset:
+            return (True, min(data_start, size))
+        return (False, min(os.lseek(fd, offset, os.SEEK_HOLE), size))
+    except OSError as err:
+        if err.errno == errno.ENXIO:  # No more data: a hole to the end
+            return (True, size)
+        return (False, size)  # No hole support after all: read it all
+
+
+class Extents(object):
+    """ Tracks whether a file is in a hole or in data, so only the data need be read
+
+        limit() cuts a block down to the end of the current hole or data
+        run, and sets hole to say which it is. Files without holes (or
+        on systems that can't find them) are all data, at no extra cost.
+        Finding a run moves the file position, so it's put back for data.
+    """
+
+    def __init__(self, file_obj, file_size):
+        self.file_obj = file_obj
+        self.size = file_size
+        self.sparse = file_size > 0 and is_sparse(file_obj)
+        self.hole = False
+        self.end = 0
+
+    def limit(self, offset, count):
+        """ How many of count bytes from offset are all hole or all data (hole says which) """
+        if not self.sparse:
+            return count
+        if offset >= self.end:
+            (self.hole, self.end) = next_extent(self.file_obj.fileno(), offset, self.size)
+            if self.end <= offset:  # Shouldn't happen, but never stall
+                (self.hole, self.end) = (False, self.size)
+            if not self.hole:
+                self.file_obj.seek(offset)
+        return min(count, self.end - offset)
+
+
+class BlockSizer(object):
+    """ Chooses each file's block size from its size and the throughput measured so far
+
+        Blocks are sized to take about BLOCK_TARGET_SECS at the rate of the
+        slowest stage (reading, or the slowest digest): long enough that
+        per-block messages don't matter, short enough to keep the stages
+        overlapping. The size is a power of two within min_block_size and
+        max_block_size (which is used until there's a measurement), then
+        evened out over the file so its last block isn't a sliver.
+    """
+
+    def __init__(self, min_block_size, max_block_size):
+        self.min_block_size = min_block_size
+        self.max_block_size = max_block_size
+        self.rate = None  # Bytes per second through the slowest stage
+
+    def record(self, file_bytes, secs):
+        """ Take in a file's size and the time its slowest stage spent on it """
+        if file_bytes < self.min_block_size or secs <= 0:
+            return  # Mostly overheads: says little about throughput
+        rate = file_bytes / secs
+        self.rate = rate if self.rate is None else self.rate + RATE_WEIGHT * (rate - self.rate)
+
+    def target_size(self):
+        """ The block size for big files """
+        if self.rate is None:
+            return self.max_block_size
+        size = 1 << (max(int(self.rate * BLOCK_TARGET_SECS), 1).bit_length() - 1)
+        return min(max(size, self.min_block_size), self.max_block_size)
+
+    def block_size(self, file_size=None):
+        """ The block size for a file of file_size bytes (if known) """
+        block_size = self.target_size()
+        if not file_size:
+            return block_size
+        blocks = -(-file_size // block_size)
+        even_size = -(-file_size // blocks)
+        return min(-(-even_size // BLOCK_ALIGN) * BLOCK_ALIGN, block_size)
+
+
+class BufferRing(object):
+    """ Up to slots buffers, each allocated only once it's needed, at the size it's needed
+
+        Buffers are powers of two of at least min_size bytes. A request that
+        no free buffer is big enough for replaces one, first dropping other
+        free buffers (largest first) if that would go over budget bytes; if
+        it still won't fit, acquire() returns None and the caller waits for a
+        busy buffer to come back. Free buffers unused for a while can be
+        dropped with trim(). create(size) makes a segment (which has .size)
+        and destroy(segment) gets rid of one.
+    """
+
+    def __init__(self, slots, budget, min_size, create, destroy):
+        self.segments = [None] * slots
+        self.last_used = [0.0] * slots
+        self.free = list(range(slots))
+        self.budget = budget
+        self.min_size = min_size
+        self.create = create
+        self.destroy = destroy
+        self.allocated = 0
+        self.peak = 0
+        self.allocations = 0
+
+    def size(self, slot):
+        """ Bytes allocated to a slot """
+        return self.segments[slot].size if self.segments[slot] else 0
+
+    def acquire(self, size):
+        """ Take a free buffer of at least size bytes: returns its slot, or None if none can be had yet """
+        if not self.free:
+            return None
+        fits = [slot for slot in self.free if self.size(slot) >= size]
+        if fits:
+            slot = min(fits, key=self.size)
+        else:
+            want = max(self.min_size, 1 << (size - 1).bit_length())
+            if want > self.budget:
+                want = size
+            slot = min(self.free, key=self.size)  # An empty slot, else the smallest to replace
+            excess = self.allocated - self.size(slot) + want - self.budget
+            dropping = []
+            for other in sorted(self.free, key=self.size, reverse=True):
+                if excess <= 0 or not self.segments[other]:
+                    break
+                if other != slot:
+                    dropping.append(other)
+                    excess -= self.size(other)
+            if excess > 0:
+                return None
+            for other in dropping + [slot]:
+                self._drop(other)
+            self.segments[slot] = self.create(want)
+            self.allocated += self.size(slot)
+            self.peak = max(self.peak, self.allocated)
+            self.allocations += 1
+        self.free.remove(slot)
+        return slot
+
+    def release(self, slot):
+        """ Hand a buffer back """
+        self.free.append(slot)
+        self.last_used[slot] = dtutils.curr_time_secs()
+
+    def trim(self, idle_secs):
+        """ Drop free buffers unused for idle_secs """
+        now = dtutils.curr_time_secs()
+        for slot in self.free:
+            if self.segments[slot] and now - self.last_used[slot] >= idle_secs:
+                self._drop(slot)
+
+    def close(self):
+        """ Drop every buffer (busy ones too) """
+        for slot in range(len(self.segments)):
+            self._drop(slot)
+
+    def _drop(self, slot):
+        if self.segments[slot]:
+            self.allocated -= self.size(slot)
+            self.destroy(self.segments[slot])
+            self.segments[slot] = None
+
+
+def _create_segment(size):
+    return shared_memory.SharedMemory(create=True, size=size)
+
+
+def _destroy_segment(segment):
+    segment.close()
+    segment.unlink()  # Workers that still have it mapped keep it until they move on
+
+
+def reader_process(debug_queue, cmd_queue, results_queue, worker_cmd_queues, buffer_sems, shm_mode,
+                   buffer_budget, min_buffer_size, mmap_mode=False, low_impact=False, log_level=logging.INFO):
     """ This is run as a subprocess, potentially with spawn()
         be careful with vars!
+
+        Elements queued with INIT are read in order, in blocks of the size
+        given with each; the next one is opened as soon as the current one
+        reaches EOF, so reading runs ahead of the workers whenever there are
+        free buffers. Shared memory buffers come from a BufferRing, one per
+        semaphore at most, and are created (and named in each PROCESS) here.
+        Blocks go straight to the workers, each of which releases the
+        buffer's semaphore once it has digested it; a buffer is reused after
+        every worker has done so. Holes in sparse files aren't read at all:
+        their blocks come from a shared buffer of zeros (or are sent as zeros
+        without shared memory), which workers don't release, and the hole
+        bytes are counted. With low_impact, files are opened as open_element
+        does and each block read is dropped from the page cache (see
+        advise_read). Opening, reading and waiting (for commands or buffers)
+        are timed, and go back with the quit stats as stage times.
     """
     pid = os.getpid()
-    buf_refs = {}
-    buf_names = set()
+    debug = log_level <= logging.DEBUG
+    total_jobs = len(worker_cmd_queues)
+    counters = {
+        'blocks': 0,
+        'bytes': 0,
+        'files': 0,
+        'messages': 0,
+        'waits': 0,
+        'wait_time': 0.0,
+        'open_time': 0.0,
+        'read_time': 0.0,
+        'hole_bytes': 0,
+    }
+    start_wall = dtutils.curr_time_secs()
+    start_cpu = dtutils.cpu_time_secs()
+    ring = None
+    if shm_mode:
+        ring = BufferRing(len(buffer_sems), buffer_budget, min_buffer_size, _create_segment, _destroy_segment)
+    zero_segments = []  # Zeros for holes, biggest last; each kept until quit, as workers may yet attach to it
+    busy_bufs = collections.deque()  # [buf_index, acks still to collect], oldest first
+    starved = False  # Whether the ring couldn't supply the last buffer asked for
+    pending = collections.deque()
     file_obj = None
+    file_map = None
+    extents = None
+    file_id = None
     element = ''
+    max_block_size = 0
     bytes_read = 0
+    bytes_copied = 0
+    hole_bytes = 0
+    file_read_time = 0.0
     chunk = 0
     file_size = 0
     found_eof = False
+
+    def send(target_queue, record):
+        target_queue.put(record)
+        counters['messages'] += 1
+
+    def zero_segment(size):
+        """ The name of a shared buffer of at least size zeros """
+        if not zero_segments or zero_segments[-1].size < size:
+            zero_segments.append(_create_segment(max(min_buffer_size, 1 << (size - 1).bit_length())))
+        return zero_segments[-1].name
+
+    def reclaim_buffers(timeout=None):
+        """ Collect worker releases for the oldest busy buffers
+            Waits up to timeout for the oldest one, if given
+        """
+        while busy_bufs:
+            busy = busy_bufs[0]
+            block = timeout is not None
+            while busy[1] and buffer_sems[busy[0]].acquire(block, timeout if block else None):
+                busy[1] -= 1
+            if busy[1]:
+                return
+            ring.release(busy_bufs.popleft()[0])
+            timeout = None
+
     while True:
         try:
+            file_open = file_obj and not file_obj.closed
+            if shm_mode:
+                reclaim_buffers()
+                if file_open and starved and busy_bufs:
+                    # Everything is with the workers: sleep until they release the oldest buffer
+                    wait_start = dtutils.curr_time_secs()
+                    reclaim_buffers(timeout=dtutils.QUEUE_WAIT_SECS)
+                    counters['wait_time'] += dtutils.curr_time_secs() - wait_start
+                    counters['waits'] += 1
+            # Only poll while there is a file to read; otherwise sleep until the parent sends something
             try:
-                cqi = cmd_queue.get_nowait()
-                cmd = cqi.get('cmd', None)
+                if file_open or pending:
+                    cqi = cmd_queue.get_nowait()
+                else:
+                    if shm_mode:
+                        ring.trim(BUFFER_IDLE_SECS)
+                    wait_start = dtutils.curr_time_secs()
+                    try:
+                        cqi = cmd_queue.get(timeout=dtutils.QUEUE_WAIT_SECS)
+                    finally:
+                        counters['wait_time'] += dtutils.curr_time_secs() - wait_start
+                        counters['waits'] += 1
+                cmd = cqi[0]
             except queue.Empty:
                 cmd = None
             if cmd == dtutils.Cmd.INIT:
-                add_buf_names = cqi.get('buf_names', [])
-                element = cqi.get('element', None)
-                debug_queue.put((
-                    logging.DEBUG,
-                    f"READER: Init {add_buf_names} for element {element}"))
-                buf_names.update(add_buf_names)
-                for buf_name in buf_names:
-                    if shm_mode and buf_name not in buf_refs:
-                        buf_refs[buf_name] = shared_memory.SharedMemory(buf_name)
-                bytes_read = 0
-                found_eof = False
-                chunk = 0
-                if element:
-                    errors = None
-                    file_size = os.path.getsize(element)
-                    try:
-                        file_obj = open(element, 'rb')
-                    except IOError as err:
-                        errors = err
-                        debug_queue.put((
-                            logging.ERROR,
-                            f"READER: Problem opening \"{element}\": {err}"))
-                    results_queue.put({
-                        'errors': errors,
-                        'element': element,
-                    })
-            elif cmd == dtutils.Cmd.FREE:
-                add_buf_names = cqi.get('buf_names', [])
-                debug_queue.put((
-                    logging.DEBUG,
-                    f"READER: Free {add_buf_names}"))
-                buf_names.update(add_buf_names)
+                if debug:
+                    debug_queue.put((
+                        logging.DEBUG,
+                        f"READER: Init {cqi[1]} for element {cqi[2]} in blocks of {cqi[3]} bytes"))
+                pending.append(cqi[1:])
             elif cmd == dtutils.Cmd.QUIT:
-                # for buf in buf_refs:
-                #     del(buf)
+                if file_map:
+                    file_map.close()
                 if file_obj:
                     file_obj.close()
+                counters['messages'] += 1  # The stats message itself
+                stats = dtutils.cpu_stats(start_wall, start_cpu)
+                stats.update(counters)
+                stats['proc'] = multiprocessing.current_process().name
+                stats['stage_times'] = {
+                    'open': [counters['open_time'], counters['files']],
+                    'read': [counters['read_time'], counters['blocks']],
+                    'wait.reader': [counters['wait_time'], counters['waits']],
+                }
+                if ring:
+                    reclaim_buffers()  # Collect the releases that came in since the last file: none should be left
+                    stats['buffers_busy'] = len(busy_bufs)
+                    stats['buffer_peak'] = ring.peak
+                    stats['buffer_allocs'] = ring.allocations
+                    ring.close()
+                for segment in zero_segments:
+                    _destroy_segment(segment)
                 debug_queue.put((
                     logging.INFO,
                     "READER: Quit"))
+                results_queue.put((dtutils.Cmd.QUIT.value, stats))
                 break
             elif cmd:
                 debug_queue.put((
                     logging.WARNING,
                     'reader_process() invalid command -- pid={} cmd={}'.format(pid, cmd)))
             else:  # Steady state
+                if not file_open and pending:
+                    (file_id, element, max_block_size) = pending.popleft()
+                    bytes_read = 0
+                    bytes_copied = 0
+                    hole_bytes = 0
+                    file_read_time = 0.0
+                    found_eof = False
+                    chunk = 0
+                    counters['files'] += 1
+                    open_start = dtutils.curr_time_secs()
+                    try:
+                        file_size = os.path.getsize(element)
+                        file_obj = open_element(element, low_impact)
+                        if mmap_mode and file_size > 0:
+                            file_map = mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+                    except (IOError, ValueError) as err:
+                        if file_obj:
+                            file_obj.close()
+                        debug_queue.put((
+                            logging.ERROR,
+                            f"READER: Problem opening \"{element}\": {err}"))
+                        send(results_queue, (dtutils.Cmd.DONE.value, file_id, str(err), 0, 0, 0.0, 0))
+                    else:
+                        extents = Extents(file_obj, file_size)
+                        for worker_cmd_queue in worker_cmd_queues:
+                            send(worker_cmd_queue, (dtutils.Cmd.INIT.value, file_id))
+                        found_eof = (file_size == 0)
+                    finally:
+                        counters['open_time'] += dtutils.curr_time_secs() - open_start
                 if file_obj and not file_obj.closed:
                     block_size = min(max_block_size, file_size - bytes_read)
-                    if (buf_names or not shm_mode) and file_size == 0:
-                        found_eof = (bytes_read == file_size)
-                        results_queue.put({
-                            'chunk': chunk,
-                            'block_size': block_size,
-                            'buf_name': None,  # Shared memory mode
-                            'buf_block': b'',  # Non-shared memory mode
-                            'found_eof': found_eof,
-                            'mbps': 0.0,
-                            'element': element,
-                        })
-                    while (buf_names or not shm_mode) and block_size > 0:
-                        start_time = dtutils.curr_time_secs()
+                    starved = False
+                    while block_size > 0:
                         buf_block = None
-                        if shm_mode:
-                            buf_name = buf_names.pop()
-                            debug_queue.put((
-                                logging.DEBUG,
-                                f"READER: Reading chunk {chunk} of {block_size} bytes into {buf_name}"))
-                            buf = buf_refs[buf_name]
-                            buf.buf[:block_size] = file_obj.read(block_size)
+                        block_size = extents.limit(bytes_read, block_size)
+                        if extents.hole:
+                            buf_index = None
+                            start_time = dtutils.curr_time_secs()
+                            if debug:
+                                debug_queue.put((
+                                    logging.DEBUG,
+                                    f"READER: Hole at chunk {chunk} of {block_size} bytes"))
+                            if shm_mode:
+                                buf_block = zero_segment(block_size)
+                            else:
+                                buf_block = bytes(block_size)
+                                bytes_copied += block_size * total_jobs
+                            count = block_size
+                            hole_bytes += block_size
+                            counters['hole_bytes'] += block_size
+                        elif shm_mode:
+                            buf_index = ring.acquire(block_size)
+                            if buf_index is None:
+                                starved = True
+                                break
+                            start_time = dtutils.curr_time_secs()
+                            if debug:
+                                debug_queue.put((
+                                    logging.DEBUG,
+                                    f"READER: Reading chunk {chunk} of {block_size} bytes into {buf_index}"))
+                            buf_ref = ring.segments[buf_index]
+                            with buf_ref.buf[:block_size] as block_view:
+                                count = read_block_into(file_obj, file_map, bytes_read, block_view)
+                            buf_block = buf_ref.name
+                            bytes_copied += count
                         else:
-                            buf_name = None
+                            buf_index = None
+                            start_time = dtutils.curr_time_secs()
+                            if debug:
+                                debug_queue.put((
+                                    logging.DEBUG,
+                                    f"READER: Reading chunk {chunk} of {block_size} bytes"))
+                            if file_map is not None:
+                                buf_block = file_map[bytes_read:bytes_read + block_size]
+                            else:
+                                buf_block = file_obj.read(block_size)
+                            count = len(buf_block)
+                            # Queue mode pickles the block once per worker
+                            bytes_copied += count * (1 + total_jobs)
+                        if count < block_size:
                             debug_queue.put((
-                                logging.DEBUG,
-                                f"READER: Reading chunk {chunk} of {block_size} bytes into {buf_name}"))
-                            buf_block = file_obj.read(block_size)
+                                logging.WARNING,
+                                f"READER: Premature EOF at {bytes_read + count} of {file_size} bytes: {element}"))
+                            block_size = count
+                            file_size = bytes_read + count
+                        if low_impact and not extents.hole:
+                            advise_read(
+                                file_obj, file_map, bytes_read, count,
+                                min(max_block_size, file_size - bytes_read - count))
                         bytes_read += block_size
                         found_eof = (bytes_read == file_size)
-                        end_time = dtutils.curr_time_secs()
-                        delta_time = end_time - start_time if end_time - start_time > 0 else 0.000001
-                        mbps = block_size / 1024 / 1024 / delta_time
-                        results_queue.put({
-                            'chunk': chunk,
-                            'block_size': block_size,
-                            'buf_name': buf_name,  # Shared memory mode
-                            'buf_block': buf_block,  # Non-shared memory mode
-                            'found_eof': found_eof,
-                            'mbps': mbps,
-                            'element': element,
-                        })
+                        read_time = dtutils.curr_time_secs() - start_time
+                        counters['read_time'] += read_time
+                        file_read_time += read_time
+                        if block_size > 0:
+                            counters['blocks'] += 1
+                            counters['bytes'] += block_size
+                            for worker_cmd_queue in worker_cmd_queues:
+                                send(worker_cmd_queue, (dtutils.Cmd.PROCESS.value, buf_index, block_size, buf_block))
+                            if buf_index is not None:
+                                busy_bufs.append([buf_index, total_jobs])
+                        elif buf_index is not None:
+                            ring.release(buf_index)
                         chunk += 1
                         block_size = min(max_block_size, file_size - bytes_read)
                         if not shm_mode:
                             break
                     if found_eof:  # Makes sure the file always gets closed
+                        for worker_cmd_queue in worker_cmd_queues:
+                            send(worker_cmd_queue, (dtutils.Cmd.RESULT.value,))
+                        send(results_queue, (
+                            dtutils.Cmd.DONE.value, file_id, None, bytes_read, bytes_copied, file_read_time,
+                            hole_bytes))
+                        if file_map:
+                            file_map.close()
+                            file_map = None
                         file_obj.close()
         except KeyboardInterrupt:
             break
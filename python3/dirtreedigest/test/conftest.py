@@ -0,0 +1,47 @@
+import logging
+import os
+import subprocess
+import sys
+
+import pytest
+import dirtreedigest.utils as dtutils
+
+# Runs the digester in a fresh interpreter, like dirtreebench. Files named *.unreadable fail to open,
+# as they would without permission (which root doesn't lack), in whichever process opens them.
+RUN_DIGEST = '''
+import sys
+import dirtreedigest.main_digest as main_digest
+import dirtreedigest.reader as dtreader
+open_element = dtreader.open_element
+def failing_open(element, *args):
+    if element.endswith('.unreadable'):
+        raise PermissionError(13, 'Permission denied', element)
+    return open_element(element, *args)
+dtreader.open_element = failing_open
+sys.exit(1 if main_digest.main() is False else 0)
+'''
+
+
+@pytest.fixture
+def run_digester(tmp_path):
+    """ run(root, *args): digest a tree in a fresh process
+        Returns (the report's elements in order, the log's text)
+    """
+    rundir = tmp_path / 'run'
+    rundir.mkdir()
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))] +
+        ([os.environ['PYTHONPATH']] if os.environ.get('PYTHONPATH') else []))
+
+    def run(root, *args):
+        cmd = [sys.executable, '-c', RUN_DIGEST, str(root), '--title', 'test', '--tstamp', '0'] + list(args)
+        proc = subprocess.run(cmd, cwd=str(rundir), env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        assert proc.returncode == 0, proc.stdout.decode('utf-8', errors='replace')
+        elements = list(dtutils.iter_dtd_report(
+            str(rundir / 'test.0.thd'), logging.getLogger('test'), all_types=True))
+        log_text = (rundir / 'test.0.log').read_text(encoding='utf-8')
+        for filename in os.listdir(str(rundir)):
+            os.remove(str(rundir / filename))
+        return (elements, log_text)
+    return run
@@ -0,0 +1,121 @@
+
+import os
+
+import pytest
+import dirtreedigest.benchmark as dtbench
+
+
+@pytest.mark.parametrize(
+    ('profile', 'scale', 'dirs', 'files'), [
+        ('tiny', 0.02, 2, 200),
+        ('deep', 0.25, 64, 256),
+        ('wide', 0.01, 1, 100),
+        ('huge', 0.001, 1, 4),
+        ('sparse', 0.001, 1, 4),
+    ])
+def test_make_tree(tmp_path, profile, scale, dirs, files):
+    manifest = dtbench.make_tree(str(tmp_path / 'tree'), profile, scale, seed=1)
+    assert (manifest['dirs'], manifest['files']) == (dirs, files)
+    found = [os.path.join(path, name) for (path, _, names) in os.walk(str(tmp_path / 'tree')) for name in names]
+    assert len(found) == files
+    assert sum(os.path.getsize(name) for name in found) == manifest['bytes']
+    dtbench.make_tree(str(tmp_path / 'again'), profile, scale, seed=1)
+    for name in found:
+        relname = os.path.relpath(name, str(tmp_path / 'tree'))
+        with open(name, 'rb') as fileh1, open(str(tmp_path / 'again' / relname), 'rb') as fileh2:
+            assert fileh1.read() == fileh2.read()
+
+
+def test_make_tree_big_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(dtbench, 'DATA_POOL_SIZE', 1024)
+    dtbench.make_tree(str(tmp_path / 'tree'), 'huge', 0.0001, seed=1)  # 6710 bytes each
+    with open(str(tmp_path / 'tree' / 'd0000' / 'f00000'), 'rb') as fileh:
+        data = fileh.read()
+    blocks = [data[pos:pos + 1024] for pos in range(0, len(data), 1024)]
+    assert len(data) == 6710
+    assert len(set(blocks)) == len(blocks)
+
+
+def test_make_tree_sparse_files(tmp_path):
+    dtbench.make_tree(str(tmp_path / 'tree'), 'sparse', 0.001, seed=1)  # 268435 bytes, data every 16777
+    with open(str(tmp_path / 'tree' / 'd0000' / 'f00000'), 'rb') as fileh:
+        data = fileh.read()
+    assert len(data) == 268435
+    assert data[16777:16777 + 8] == (1).to_bytes(8, 'little')
+    assert data[16777 + 1048:2 * 16777] == bytes(16777 - 1048)
+
+
+def test_ensure_tree(tmp_path):
+    (root, manifest) = dtbench.ensure_tree(str(tmp_path), 'wide', 0.001)
+    os.remove(os.path.join(root, 'd0000', 'f00000'))
+    assert dtbench.ensure_tree(str(tmp_path), 'wide', 0.001) == (root, manifest)  # Reused as is
+    os.remove(root + '.json')
+    assert dtbench.ensure_tree(str(tmp_path), 'wide', 0.001) == (root, manifest)
+    assert os.path.exists(os.path.join(root, 'd0000', 'f00000'))
+
+
+def test_expand_matrix():
+    cases = dtbench.expand_matrix([True, False], [2, 4], [16], ['md5', 'noop0,noop1'], ['--walkers', '0'])
+    assert len(cases) == 8
+    assert cases[0] == ['--digests', 'md5', '--buffers', '2', '--blocksize', '16', '--walkers', '0']
+    assert cases[-1] == [
+        '--digests', 'noop0,noop1', '--buffers', '4', '--blocksize', '16', '--noshm', '--walkers', '0']
+    assert len({dtbench.case_id('tiny', args) for args in cases}) == 8
+    cases = dtbench.expand_matrix([True], [2], [16], ['md5'], low_impact_modes=[False, True])
+    assert cases == [
+        ['--digests', 'md5', '--buffers', '2', '--blocksize', '16'],
+        ['--digests', 'md5', '--buffers', '2', '--blocksize', '16', '--low-impact']]
+
+
+def test_chill_tree(tmp_path):
+    (root, manifest) = dtbench.ensure_tree(str(tmp_path), 'wide', 0.001)
+    atimes = dtbench.chill_tree(root)
+    assert len(atimes) == manifest['files']
+    assert dtbench.count_touched(atimes) == 0
+    path = sorted(atimes)[-1]
+    os.utime(path, ns=(atimes[path] + 1, os.stat(path).st_mtime_ns))
+    assert dtbench.count_touched(atimes) == 1
+
+
+def test_compare_to_baseline():
+    baseline = {'cases': [
+        {'id': 'a', 'mb_per_s': 100.0, 'files_per_s': 10.0, 'cpu_s': 1.0, 'peak_rss_mb': 50.0},
+        {'id': 'b', 'mb_per_s': 100.0, 'files_per_s': None, 'cpu_s': None, 'peak_rss_mb': None},
+    ]}
+    results = {'cases': [
+        {'id': 'a', 'mb_per_s': 85.0, 'files_per_s': 9.5, 'cpu_s': 1.2, 'peak_rss_mb': 40.0},
+        {'id': 'b', 'mb_per_s': 95.0, 'files_per_s': 1.0, 'cpu_s': 5.0, 'peak_rss_mb': None},
+        {'id': 'c', 'mb_per_s': 1.0, 'files_per_s': 1.0, 'cpu_s': 9.0, 'peak_rss_mb': 900.0},
+    ]}
+    regressions = dtbench.compare_to_baseline(results, baseline)
+    assert [(case_id, metric) for (case_id, metric, _, _, _) in regressions] == [('a', 'cpu_s'), ('a', 'mb_per_s')]
+    assert regressions[1][2:] == (100.0, 85.0, pytest.approx(15.0))
+    regressions = dtbench.compare_to_baseline(results, baseline, {'mb_per_s': 20.0, 'files_per_s': 1.0})
+    assert [(case_id, metric) for (case_id, metric, _, _, _) in regressions] == [('a', 'cpu_s'), ('a', 'files_per_s')]
+
+
+def test_run_case(tmp_path):
+    (root, manifest) = dtbench.ensure_tree(str(tmp_path), 'wide', 0.002)
+    rundir = tmp_path / 'runs'
+    rundir.mkdir()
+    case = dtbench.run_case('wide', root, ['--digests', 'md5', '--walkers', '0'], str(rundir), repeat=2)
+    assert case['returncode'] == 0
+    assert case['id'] == 'wide --digests md5 --walkers 0'
+    assert (case['files'], case['bytes'], case['errors']) == (manifest['files'], manifest['bytes'], 0)
+    assert len(case['wall_s_runs']) == 2
+    assert case['mb_per_s'] > 0 and case['files_per_s'] > 0
+    assert os.listdir(str(rundir)) == []
+
+
+def test_run_case_cold(tmp_path):
+    (root, manifest) = dtbench.ensure_tree(str(tmp_path), 'wide', 0.002)
+    rundir = tmp_path / 'runs'
+    rundir.mkdir()
+    case = dtbench.run_case(
+        'wide', root, ['--digests', 'md5', '--walkers', '0', '--low-impact'], str(rundir), cold=True)
+    assert case['returncode'] == 0
+    assert case['files'] == manifest['files']
+    assert case['atimes_touched'] is not None
+    if hasattr(os, 'O_NOATIME'):
+        assert case['atimes_touched'] == 0
+    assert 'atimes_touched=' in dtbench.format_case(case)
@@ -0,0 +1,63 @@
+
+import os
+
+import pytest
+import dirtreedigest.cache as dtcache
+
+DIGESTS = {'md5': 'aa' * 16, 'sha1': 'bb' * 20}
+
+
+@pytest.fixture
+def cache(tmp_path):
+    digest_cache = dtcache.DigestCache(str(tmp_path / 'sub' / 'cache.sqlite'), 3600, 1024 * 1024)
+    yield digest_cache
+    digest_cache.conn.close()
+
+
+def test_cache_key(tmp_path):
+    filename = tmp_path / 'file'
+    filename.write_bytes(b'data')
+    stats = os.stat(filename)
+    assert dtcache.cache_key(stats) == (
+        stats.st_dev, stats.st_ino, 4, stats.st_mtime_ns, stats.st_ctime_ns)
+
+
+@pytest.mark.parametrize(
+    ('lookup_key', 'digest_names', 'expected'), [
+        ((1, 2, 3, 4, 5), ['md5', 'sha1'], DIGESTS),
+        ((1, 2, 3, 4, 5), ['md5'], {'md5': DIGESTS['md5']}),
+        ((1, 2, 3, 4, 5), ['md5', 'sha256'], None),
+        ((1, 2, 3, 4, 6), ['md5'], None),  # ctime changed
+        ((1, 2, 4, 4, 5), ['md5'], None),  # size changed
+        (None, ['md5'], None),
+    ])
+def test_lookup(cache, lookup_key, digest_names, expected):
+    cache.store((1, 2, 3, 4, 5), DIGESTS)
+    assert cache.lookup(lookup_key, digest_names) == expected
+    cache.commit()
+    assert cache.lookup(lookup_key, digest_names) == expected
+
+
+def test_racy_mtime_not_stored(cache):
+    mtime_ns = int(cache.now * 1000000000)
+    cache.store((1, 2, 3, mtime_ns, mtime_ns), DIGESTS)
+    assert cache.lookup((1, 2, 3, mtime_ns, mtime_ns), ['md5']) is None
+
+
+def test_evict_by_age(cache):
+    cache.store((1, 2, 3, 4, 5), DIGESTS)
+    assert cache.evict(now=cache.now + 60) == 0
+    assert cache.lookup((1, 2, 3, 4, 5), ['md5'])
+    assert cache.evict(now=cache.now + 7200) == 2
+    assert cache.lookup((1, 2, 3, 4, 5), ['md5']) is None
+
+
+def test_evict_by_size(cache):
+    cache.max_size = 64 * 1024
+    for ino in range(4000):
+        cache.now += 1
+        cache.store((1, ino, 3, 4, 5), DIGESTS)
+    assert cache.evict() > 0
+    assert cache._used_bytes() <= cache.max_size
+    assert cache.lookup((1, 0, 3, 4, 5), ['md5']) is None
+    assert cache.lookup((1, 3999, 3, 4, 5), ['md5']) == {'md5': DIGESTS['md5']}
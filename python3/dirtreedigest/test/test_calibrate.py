@@ -0,0 +1,73 @@
+
+import json
+
+import pytest
+import dirtreedigest.calibrate as dtcalibrate
+
+
+@pytest.mark.parametrize(
+    ('names', 'rates', 'max_workers', 'rval'), [
+        # The most expensive digest sets the pace; cheap ones share workers up to it
+        (['adler32', 'crc32', 'md5', 'sha3_512', 'sha512'],
+         {'crc32': 2000, 'adler32': 4000, 'md5': 600, 'sha512': 800, 'sha3_512': 200}, 8,
+         [['sha3_512'], ['md5', 'sha512', 'crc32', 'adler32']]),
+        (['md5', 'sha1', 'sha256'], {'md5': 500, 'sha1': 500, 'sha256': 500}, 8,
+         [['md5'], ['sha1'], ['sha256']]),
+        # Too few workers: the least loaded takes the rest
+        (['md5', 'sha1', 'sha256'], {'md5': 500, 'sha1': 500, 'sha256': 500}, 2,
+         [['md5', 'sha256'], ['sha1']]),
+        # No rate: a worker to itself
+        (['adler32', 'crc32', 'md5', 'sha1'], {'crc32': 1000, 'adler32': 4000, 'md5': 4000}, 8,
+         [['sha1'], ['crc32'], ['adler32', 'md5']]),
+        (['crc32', 'sha1'], {}, 8,
+         [['crc32'], ['sha1']]),
+    ])
+def test_pack_digests(names, rates, max_workers, rval):
+    assert dtcalibrate.pack_digests(names, rates, max_workers) == rval
+
+
+def test_calibrate():
+    rates = dtcalibrate.calibrate(['noop0', 'crc32'], sample_size=1024, min_secs=0.001)
+    assert sorted(rates) == ['crc32', 'noop0']
+    assert all(rate > 0 for rate in rates.values())
+
+
+def test_calibration_file(tmp_path):
+    filename = str(tmp_path / 'sub' / 'calibration.json')
+    assert dtcalibrate.load_calibration(filename) == {}
+    dtcalibrate.save_calibration(filename, {'md5': 600.0})
+    dtcalibrate.save_calibration(filename, {'sha1': 900.0})
+    assert dtcalibrate.load_calibration(filename) == {'md5': 600.0, 'sha1': 900.0}
+    with open(filename, 'r', encoding='utf-8') as fileh:
+        table = json.load(fileh)
+    assert list(table['hosts']) == [dtcalibrate.host_id()]
+    table['version'] = 0
+    with open(filename, 'w', encoding='utf-8') as fileh:
+        json.dump(table, fileh)
+    assert dtcalibrate.load_calibration(filename) == {}
+
+
+def test_plan_workers(tmp_path):
+    filename = str(tmp_path / 'calibration.json')
+    dtcalibrate.save_calibration(filename, {'crc32': 2000.0, 'adler32': 4000.0, 'sha1': 100.0})
+    control_data = {
+        'calibration_file': filename,
+        'calibrate': False,
+        'selected_digests': ['adler32', 'crc32', 'sha1'],
+        'max_concurrent_jobs': 32,
+    }
+    assert dtcalibrate.plan_workers(control_data) == [['sha1'], ['crc32', 'adler32']]
+
+
+def test_plan_workers_max_jobs(tmp_path):
+    filename = str(tmp_path / 'calibration.json')
+    dtcalibrate.save_calibration(filename, {'md5': 500.0, 'sha1': 500.0, 'sha256': 500.0, 'sha512': 500.0})
+    control_data = {
+        'calibration_file': filename,
+        'calibrate': False,
+        'selected_digests': ['md5', 'sha1', 'sha256', 'sha512'],
+        'max_concurrent_jobs': 3,
+    }
+    workers = dtcalibrate.plan_workers(control_data)
+    assert len(workers) == 3
+    assert sorted(name for names in workers for name in names) == ['md5', 'sha1', 'sha256', 'sha512']
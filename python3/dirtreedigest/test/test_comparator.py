@@ -0,0 +1,204 @@
+
+import logging
+
+import pytest
+import dirtreedigest.comparator as dtcompare
+
+
+def element(full_name, md5, mtime=1, elem_type='F'):
+    return {
+        'type': elem_type,
+        'digests': {'md5': md5},
+        'mtime': '{:08x}'.format(mtime),
+        'size': '0000000010',
+        'full_name': full_name,
+        'file_name': full_name.rpartition('/')[2],
+    }
+
+
+def compare(file_l, file_r, options, caplog):
+    control_data = {'report_parsers': 0, 'notimestamps': False, 'compare_memory_mb': 0,
+                    'temp_dir': None, 'bloom_filter': False, 'full_compare': False}
+    control_data.update(options)
+    if control_data['compare_memory_mb']:
+        comparator = dtcompare.ExternalComparator(control_data)
+    else:
+        comparator = dtcompare.Comparator(control_data)
+    caplog.clear()
+    with caplog.at_level(logging.INFO):
+        comparator.compare(file_l, file_r)
+    assert comparator.best_digest == 'md5'
+    return [record.getMessage() for record in caplog.records if record.name == 'comparator']
+
+
+def write_report(filename, elements):
+    lines = ['#  Base path: /base']
+    for elem in elements:
+        lines.append('{};{{md5: {}}};00000000;{};00000000;81a4;0000;{};{}'.format(
+            elem['type'], elem['digests']['md5'], elem['mtime'], elem['size'], elem['full_name']))
+    filename.write_text('\n'.join(lines) + '\n', encoding='utf-8')
+    return str(filename)
+
+
+@pytest.mark.parametrize(
+    ('keys'), [
+        [1, 2, 3],
+        [5, 5 + 16, 5 + 32, 5],  # All in one probe chain
+    ])
+def test_row_index(keys):
+    index = dtcompare.RowIndex(len(keys))
+    for (row, key) in enumerate(keys):
+        index.add(key, row)
+    for key in set(keys):
+        # Candidates only: rows filed under other keys with the same tag may come along
+        assert {row for (row, other) in enumerate(keys) if other == key} <= set(index.rows(key))
+    assert list(index.rows(1 << 40)) == []
+
+
+def test_row_index_tags():
+    index = dtcompare.RowIndex(2)
+    index.add(7 << 32 | 1, 0)
+    index.add(9 << 32 | 1, 1)
+    assert list(index.rows(7 << 32 | 1)) == [0]
+    assert list(index.rows(9 << 32 | 1)) == [1]
+
+
+def test_report_table():
+    table = dtcompare.ReportTable('md5', 16)
+    table.load([
+        element('a', '--' * 16, elem_type='D'),
+        element('a/x', '00' * 16),
+        element('a/é', '11' * 16, mtime=2 ** 33),
+        element('b', '!' * 32),
+        element('a/x', '22' * 16),  # The later one wins
+    ])
+    assert table.elements == 5
+    assert len(table) == 3
+    assert sorted(table.full_name(row) for row in table.rows()) == ['a/x', 'a/é', 'b']
+    assert table.full_name(table.find_name('a/é')) == 'a/é'
+    assert table.mtimes[table.find_name('a/é')] == 2 ** 33
+    assert table.digest(table.find_name('a/x')) == bytes.fromhex('22' * 16)
+    assert table.digest(table.find_name('b')) == '!' * 32
+    assert table.find_name('a') is None
+    assert table.find_digest(bytes.fromhex('00' * 16)) == []
+    assert table.find_digest('!' * 32) == [table.find_name('b')]
+    assert table.find_digest(bytes(16)) == []
+
+
+@pytest.mark.parametrize(
+    ('options'), [
+        {},
+        {'compare_memory_mb': 1},
+        {'compare_memory_mb': 1, 'bloom_filter': True},
+    ])
+def test_compare(tmp_path, caplog, options):
+    file_l = write_report(tmp_path / 'l.thd', [
+        element('d', '--' * 16, elem_type='D'),
+        element('d/same', 'aa' * 16),
+        element('d/changed', 'bb' * 16),
+        element('d/moved', 'cc' * 16),
+        element('d/deleted', 'dd' * 16),
+    ])
+    file_r = write_report(tmp_path / 'r.thd', [
+        element('d/same', 'aa' * 16),
+        element('d/changed', 'b0' * 16, mtime=5),
+        element('e/moved', 'cc' * 16),
+        element('e/same', 'aa' * 16),
+        element('e/added', 'ee' * 16),
+    ])
+    messages = compare(file_l, file_r, options, caplog)
+    for message in [
+            'MOD   : "d/changed"',
+            'ADD   : "e/added"',
+            'DEL   : "d/deleted"',
+            'COPY  : "e/moved" == "---"',
+            'COPY  : "e/same" == "---"',
+            'MOVE  : "d/moved" == "---"',
+            '------: Found likely source: "e/moved"',
+            'ElemsL: 5',
+            'FilesL: 4',
+            '  Both: 2',
+            'Only L: 2',
+            'Only R: 3']:
+        assert message in messages
+
+
+def test_compare_external_matches(tmp_path, caplog, monkeypatch):
+    monkeypatch.setattr(dtcompare.dtextsort, 'SPOOL_BATCH_ROWS', 7)
+    elements_l = [element(f'd{i % 7}/f{i}', '{:032x}'.format(i % 50), mtime=i % 3) for i in range(300)]
+    elements_r = [element(f'd{i % 5}/f{i}', '{:032x}'.format(i % 70), mtime=i % 4) for i in range(100, 400)]
+    elements_r += [element('d1/f101', '!' * 32), element('d2/f102', '{:032x}'.format(1))]  # Repeated names
+    elements_l += [element('odd', '!' * 32)]
+    file_l = write_report(tmp_path / 'l.thd', elements_l)
+    file_r = write_report(tmp_path / 'r.thd', elements_r)
+    expected = compare(file_l, file_r, {}, caplog)
+    assert len(expected) > 300
+    monkeypatch.setattr(dtcompare.dtextsort, 'RECORD_BYTES', 20000)  # Sort runs of 26 rows
+    for options in [{'compare_memory_mb': 1}, {'compare_memory_mb': 1, 'bloom_filter': True}]:
+        assert compare(file_l, file_r, options, caplog) == expected
+
+
+@pytest.mark.parametrize(
+    ('options'), [
+        {},
+        {'compare_memory_mb': 1},
+        {'compare_memory_mb': 1, 'bloom_filter': True},
+    ])
+def test_compare_skips_subtrees(tmp_path, caplog, options):
+    elements_l = [
+        element('a', '01' * 16, elem_type='D'),
+        element('a/f1', 'aa' * 16),
+        element('a/f2', 'bb' * 16),
+        element('b', '02' * 16, elem_type='D'),
+        element('b/g', 'cc' * 16),
+        element('c/h', 'bb' * 16),
+    ]
+    elements_r = [
+        element('a', '01' * 16, elem_type='D'),
+        element('a/f1', 'aa' * 16, mtime=5),  # Retimed, so compared even though its subtree is skipped
+        element('a/f2', 'bb' * 16),
+        element('b', '03' * 16, elem_type='D'),
+        element('b/g', 'c0' * 16),
+        element('d/f1', 'aa' * 16),
+    ]
+    file_l = write_report(tmp_path / 'l.thd', elements_l)
+    file_r = write_report(tmp_path / 'r.thd', elements_r)
+    expected = compare(file_l, file_r, dict(options, full_compare=True), caplog)
+    assert 'SAME-T: 4s: "a/f1"' in expected
+    messages = compare(file_l, file_r, options, caplog)
+    assert set(messages) - set(expected) == {'Skipped 1 identical subtree(s) holding 1 file(s)'}
+    assert set(expected) - set(messages) == set()
+    for message in [
+            'MOD   : "b/g"',
+            'COPY  : "d/f1" == "---"',
+            '------: Found likely source: "d/f1"',
+            'MOVE  : "c/h" == "---"',
+            'ElemsL: 6',
+            'FilesR: 4',
+            '  Both: 3']:
+        assert message in messages
+
+    # Ignoring timestamps: nothing under "a" is needed
+    expected = compare(file_l, file_r, dict(options, full_compare=True, notimestamps=True), caplog)
+    messages = compare(file_l, file_r, dict(options, notimestamps=True), caplog)
+    assert set(messages) - set(expected) == {'Skipped 1 identical subtree(s) holding 2 file(s)'}
+    assert set(expected) - set(messages) == set()
+    expected = compare(file_l, file_r, dict(options, full_compare=True), caplog)
+
+    # Out of order: compared in full
+    file_r = write_report(tmp_path / 'r.thd', elements_r[3:] + elements_r[:3])
+    messages = compare(file_l, file_r, options, caplog)
+    assert set(messages) == set(expected) | {'Comparing in full: "a" is out of order'}
+
+
+def test_compare_identical_trees(tmp_path, caplog):
+    file_l = write_report(tmp_path / 'l.thd', [element('f', 'aa' * 16)])
+    file_r = write_report(tmp_path / 'r.thd', [element('f', 'aa' * 16, mtime=5)])
+    for filename in [file_l, file_r]:
+        with open(filename, 'a', encoding='utf-8') as fileh:
+            fileh.write('#  Tree digests: {md5: %s}\n' % ('0f' * 16))
+    messages = compare(file_l, file_r, {'notimestamps': True}, caplog)
+    assert messages[-1] == 'SAME  : Trees are identical (md5 %s)' % ('0f' * 16)
+    # Only the timestamp changed, which the tree digests can't tell
+    assert 'SAME-T: 4s: "f"' in compare(file_l, file_r, {}, caplog)
+    assert 'SAME-T: 4s: "f"' in compare(file_l, file_r, {'full_compare': True}, caplog)
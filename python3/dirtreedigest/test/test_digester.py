@@ -0,0 +1,364 @@
+
+import hashlib
+import mmap
+import os
+import re
+import types
+import zlib
+
+import pytest
+import dirtreedigest.digester as dtdigester
+import dirtreedigest.reader as dtreader
+import dirtreedigest.treehash as dttreehash
+
+
+@pytest.mark.parametrize(
+    ('digest_name', 'rval'), [
+        ('crc32', '{:08x}'.format(zlib.crc32(b''))),
+        ('adler32', '{:08x}'.format(zlib.adler32(b''))),
+        ('md5', hashlib.md5(b'').hexdigest()),
+        ('sha256', hashlib.sha256(b'').hexdigest()),
+        ('sha3_512', hashlib.sha3_512(b'').hexdigest()),
+    ])
+def test_empty_digests(digest_name, rval):
+    assert dtdigester.EMPTY_DIGESTS[digest_name] == rval
+
+
+@pytest.mark.parametrize(
+    ('calibration_file', 'engine', 'rval'), [
+        (None, 'processes', None),
+        (None, 'threads', None),
+        ('calibration.json', 'threads', None),
+        ('calibration.json', 'processes', ['adler32', 'crc32', 'md5']),  # Packed onto at most 2 workers
+    ])
+def test_validate_digests_max_jobs(calibration_file, engine, rval):
+    control_data = {
+        'selected_digests': ['md5', 'crc32', 'adler32'],
+        'max_concurrent_jobs': 2,
+        'calibration_file': calibration_file,
+        'engine': engine,
+    }
+    assert dtdigester.validate_digests(control_data) == rval
+
+
+@pytest.mark.parametrize(
+    ('data', 'file_size', 'low_impact'), [
+        (b'', 0, False),
+        (b'abc', 3, True),
+        (b'x' * 5000, None, False),
+    ])
+def test_digest_file_small(tmp_path, data, file_size, low_impact):
+    element = tmp_path / 'elem'
+    element.write_bytes(data)
+    control_data = {
+        'selected_digests': ['crc32', 'md5', 'sha1'],
+        'inline_max_size': 64 * 1024,
+        'counts': {'bytes_read': 0, 'bytes_copied': 0},
+        'stage_times': {},
+        'low_impact': low_impact,
+    }
+    if file_size is None:
+        hash_stats = dtdigester.digest_file_inline(control_data, str(element))
+    else:
+        hash_stats = dtdigester.digest_file(control_data, str(element), file_size)
+    assert hash_stats == {
+        'crc32': '{:08x}'.format(zlib.crc32(data)),
+        'md5': hashlib.md5(data).hexdigest(),
+        'sha1': hashlib.sha1(data).hexdigest(),
+    }
+    assert control_data['counts']['bytes_read'] == len(data)
+    if file_size != 0:
+        assert set(control_data['stage_times']) == {'open', 'read', 'hash.crc32', 'hash.md5', 'hash.sha1'}
+        assert control_data['stage_times']['hash.md5'][1] == 1
+
+
+@pytest.mark.parametrize(
+    ('size', 'block_size', 'mmap_mode', 'low_impact'), [
+        (1, 4, False, False),
+        (10, 4, False, True),
+        (12, 4, True, False),
+        (100000, 65536, True, False),
+        (100000, 65536, True, True),
+    ])
+def test_digest_whole_file(tmp_path, size, block_size, mmap_mode, low_impact):
+    data = bytes(i % 251 for i in range(size))
+    element = tmp_path / 'elem'
+    element.write_bytes(data)
+    (hash_stats, bytes_read, error, stage_times, hole_bytes) = dtdigester.digest_whole_file(
+        str(element), ['adler32', 'sha256'], size, block_size, mmap_mode, low_impact)
+    assert error is None
+    assert bytes_read == size
+    assert hole_bytes == 0
+    blocks = -(-size // block_size)
+    assert stage_times['hash.sha256'][1] == blocks
+    assert stage_times['read'][1] == blocks + 1  # Up to the empty read at EOF
+    assert hash_stats == {
+        'adler32': '{:08x}'.format(zlib.adler32(data)),
+        'sha256': hashlib.sha256(data).hexdigest(),
+    }
+
+
+@pytest.mark.parametrize('mmap_mode', [False, True])
+def test_digest_whole_file_sparse(tmp_path, mmap_mode):
+    size = 3 * 1024 * 1024 + 5
+    element = str(tmp_path / 'sparse')
+    with open(element, 'wb') as fileh:
+        fileh.write(b'head')
+        fileh.seek(2 * 1024 * 1024)
+        fileh.write(b'middle')
+        fileh.truncate(size)
+    with open(element, 'rb') as fileh:
+        data = fileh.read()
+    (hash_stats, bytes_read, error, _, hole_bytes) = dtdigester.digest_whole_file(
+        element, ['md5', 'sha256tree'], size, 256 * 1024, mmap_mode)
+    assert (error, bytes_read) == (None, size)
+    assert hole_bytes <= size - 10
+    digest_instance = dtdigester.DIGEST_FUNCTIONS['sha256tree']['entry']()
+    digest_instance.update(data)
+    assert hash_stats == {'md5': hashlib.md5(data).hexdigest(), 'sha256tree': digest_instance.hexdigest()}
+
+
+def test_digest_whole_file_missing(tmp_path):
+    (hash_stats, bytes_read, error, _, _) = dtdigester.digest_whole_file(
+        str(tmp_path / 'missing'), ['md5'], 10, 4)
+    assert hash_stats == {}
+    assert error
+
+
+@pytest.fixture(params=['read', 'extents'])
+def failing_reads(request, monkeypatch):
+    """ The second read of every file fails, or finding its holes does
+        Returns the memory maps made meanwhile
+    """
+    maps = []
+    reads = []
+    read_block_into = dtreader.read_block_into
+
+    def recording_mmap(*args, **kwargs):
+        maps.append(mmap.mmap(*args, **kwargs))
+        return maps[-1]
+
+    def failing_read(file_obj, file_map, offset, view):
+        reads.append(offset)
+        if offset:
+            raise OSError(5, 'Input/output error')
+        return read_block_into(file_obj, file_map, offset, view)
+
+    def failing_extents(file_obj, file_size):
+        raise OSError(5, 'Input/output error')
+
+    monkeypatch.setattr(dtdigester, 'mmap', types.SimpleNamespace(mmap=recording_mmap, ACCESS_READ=mmap.ACCESS_READ))
+    monkeypatch.setattr(dtdigester.dtreader, 'read_block_into', failing_read)
+    if request.param == 'extents':
+        monkeypatch.setattr(dtdigester.dtreader, 'Extents', failing_extents)
+    return maps
+
+
+def test_mmap_closed_after_failed_read(tmp_path, failing_reads):
+    element = tmp_path / 'elem'
+    element.write_bytes(os.urandom(300 * 1024))
+    (hash_stats, _, error, _, _) = dtdigester.digest_whole_file(str(element), ['md5'], 300 * 1024, 64 * 1024, True)
+    assert hash_stats == {}
+    assert 'Input/output error' in error
+    digester = dtdigester.ThreadedDigester({
+        'selected_digests': ['md5'],
+        'pipeline_depth': 1,
+        'min_block_size': 64 * 1024,
+        'max_block_size': 64 * 1024,
+        'max_buffers': 2,
+        'mmap_mode': True,
+        'low_impact': False,
+        'stage_times': {},
+    })
+    try:
+        assert digester.wait(digester.submit(str(element), 300 * 1024)) == {}
+    finally:
+        digester.shutdown()
+    assert len(failing_reads) == 2
+    assert all(file_map.closed for file_map in failing_reads)
+
+
+digest_whole_file = dtdigester.digest_whole_file
+
+
+def crashing_digest(element, *args):
+    """ digest_whole_file, except that the pool process dies on a file named 'crash' """
+    if element.endswith('crash'):
+        os._exit(1)
+    return digest_whole_file(element, *args)
+
+
+def test_file_pool_broken(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(dtdigester, 'digest_whole_file', crashing_digest)
+    data = os.urandom(1000)
+    for name in ['crash', 'fine']:
+        (tmp_path / name).write_bytes(data)
+    control_data = {
+        'file_pool_size': 1,
+        'profile_prefix': None,
+        'selected_digests': ['md5'],
+        'max_block_size': 64 * 1024,
+        'mmap_mode': False,
+        'low_impact': False,
+        'stage_times': {},
+        'counts': {'bytes_read': 0, 'bytes_copied': 0, 'hole_bytes': 0},
+    }
+    digester = dtdigester.FilePoolDigester(control_data)
+    try:
+        # Like an unreadable file: no digests, so the report gets placeholders
+        assert digester.wait(digester.submit(str(tmp_path / 'crash'), len(data))) == {}
+        assert re.search(r'Problem reading ".*crash": a file pool process died', caplog.text)
+        # And the next file goes to a new pool
+        assert digester.wait(digester.submit(str(tmp_path / 'fine'), len(data))) == {
+            'md5': hashlib.md5(data).hexdigest()}
+    finally:
+        digester.shutdown()
+    assert control_data['counts']['bytes_read'] == len(data)
+
+
+def test_file_pool_leaf_threads():
+    digester = dtdigester.FilePoolDigester({'file_pool_size': 2, 'profile_prefix': None})
+    try:
+        # Each pool process takes its share of the cores for hashing tree leaves
+        assert digester.pool.submit(dttreehash.leaf_threads).result() == max(1, (os.cpu_count() or 1) // 2)
+    finally:
+        digester.shutdown()
+
+
+def file_digests(elements):
+    """ {relname: digests} for the files in a report """
+    return {elem['full_name']: elem['digests'] for elem in elements if elem['type'] == 'F'}
+
+
+def expected_digests(contents, digest_names):
+    """ What file_digests should be: hashlib's digests, or error placeholders for unreadable files """
+    def digest(name, data):
+        if data is None:
+            return '!' * dtdigester.DIGEST_FUNCTIONS[name]['len']
+        return hashlib.new(name, data).hexdigest()
+    return {relname: {name: digest(name, data) for name in digest_names} for (relname, data) in contents.items()}
+
+
+@pytest.mark.parametrize('mmap_mode', [False, True])
+def test_threaded_engine(tmp_path, run_digester, mmap_mode):
+    root = tmp_path / 'tree'
+    (root / 'sub').mkdir(parents=True)
+    contents = {
+        'empty': b'',
+        'small': os.urandom(1000),
+        'big': os.urandom(300 * 1024),  # Several blocks at --blocksize 64K
+        'sub/big2': os.urandom(200 * 1024 + 7),
+        'sub/file.unreadable': None,
+    }
+    for (relname, data) in contents.items():
+        (root / relname).write_bytes(os.urandom(100 * 1024) if data is None else data)
+    args = ['--engine', 'threads', '--digests', 'md5,sha256', '--blocksize', '64K', '--inline', '0']
+    (elements, log_text) = run_digester(root, *args + (['--mmap'] if mmap_mode else []))
+    assert file_digests(elements) == expected_digests(contents, ['md5', 'sha256'])
+    assert re.search(r'Problem opening ".*file\.unreadable"', log_text)
+    assert re.search(r'F Problems processing .*file\.unreadable', log_text)
+
+
+def hole_bytes(filename, size):
+    """ How much of a file is holes, as the filesystem reports them """
+    holes = 0
+    with open(filename, 'rb') as fileh:
+        if not dtreader.is_sparse(fileh):
+            return 0
+        offset = 0
+        while offset < size:
+            (is_hole, end) = dtreader.next_extent(fileh.fileno(), offset, size)
+            holes += end - offset if is_hole else 0
+            offset = end
+    return holes
+
+
+@pytest.mark.parametrize(
+    ('engine_args'), [
+        [],
+        ['--noshm'],
+        ['--engine', 'threads'],
+        ['--engine', 'threads', '--mmap'],
+    ])
+def test_sparse_files(tmp_path, run_digester, engine_args):
+    root = tmp_path / 'tree'
+    root.mkdir()
+    contents = {'dense': os.urandom(200 * 1024 + 7)}
+    for (name, size, runs) in [
+            ('sparse', 3 * 1024 * 1024 + 5, [(0, 4 * 1024), (2 * 1024 * 1024, 8 * 1024)]),
+            ('sparse_tail', 1024 * 1024, [(0, 100)]),  # Ends in a hole
+            ('sparse_head', 512 * 1024 + 3, [(256 * 1024, 256 * 1024 + 3)])]:  # Starts with one
+        with open(str(root / name), 'wb') as fileh:
+            for (offset, count) in runs:
+                fileh.seek(offset)
+                fileh.write(os.urandom(count))
+            fileh.truncate(size)
+        contents[name] = (root / name).read_bytes()
+    (root / 'dense').write_bytes(contents['dense'])
+    args = ['--digests', 'md5,sha256', '--blocksize', '64K', '--inline', '0'] + engine_args
+    (elements, log_text) = run_digester(root, *args)
+    assert file_digests(elements) == expected_digests(contents, ['md5', 'sha256'])
+    holes = sum(hole_bytes(str(root / name), len(data)) for (name, data) in contents.items())
+    assert int(re.search(r'hole_bytes= (\d+)', log_text).group(1)) == holes
+
+
+@pytest.mark.parametrize(
+    ('engine_args'), [
+        [],
+        ['--noshm'],
+        ['--engine', 'threads'],
+        ['--engine', 'threads', '--mmap'],
+        ['--filepool', '2'],
+        ['--inline', '32'],  # Small files inline
+    ])
+def test_low_impact_engines(tmp_path, run_digester, engine_args):
+    root = tmp_path / 'tree'
+    root.mkdir()
+    contents = {'empty': b'', 'small': os.urandom(1000), 'big': os.urandom(300 * 1024 + 1)}
+    for (relname, data) in contents.items():
+        (root / relname).write_bytes(data)
+    args = ['--digests', 'md5,sha1', '--blocksize', '64K', '--inline', '0', '--low-impact'] + engine_args
+    (elements, log_text) = run_digester(root, *args)
+    assert 'low_impact: True' in log_text
+    assert file_digests(elements) == expected_digests(contents, ['md5', 'sha1'])
+
+
+@pytest.mark.parametrize('shm', [True, False])
+def test_pipeline_order(tmp_path, run_digester, shm):
+    root = tmp_path / 'tree'
+    root.mkdir()
+    contents = {}
+    for i in range(20):  # Small and multi-block files interleaved, with one that fails partway
+        relname = f'f{i:02d}.unreadable' if i == 7 else f'f{i:02d}'
+        data = os.urandom(300 * 1024 + i if i % 2 else 2000 + i)
+        (root / relname).write_bytes(data)
+        contents[relname] = None if i == 7 else data
+    args = ['--digests', 'md5,sha1', '--blocksize', '64K', '--inline', '0'] + ([] if shm else ['--noshm'])
+    (pipelined, _) = run_digester(root, '--prefetch', '8', *args)
+    (serial, _) = run_digester(root, '--prefetch', '1', *args)
+    assert [elem['full_name'] for elem in pipelined] == sorted(contents)
+    assert [(elem['full_name'], elem['digests']) for elem in pipelined] == [
+        (elem['full_name'], elem['digests']) for elem in serial]
+    assert file_digests(pipelined) == expected_digests(contents, ['md5', 'sha1'])
+
+
+def test_dir_digester():
+    def rollup(children):
+        dir_digester = dtdigester.DirDigester(['md5', 'crc32'])
+        for child in children:
+            dir_digester.add(*child)
+        return dir_digester.hexdigests()
+    children = [
+        ('F', 'a', {'md5': '00' * 16, 'crc32': '0badf00d'}),
+        ('D', 'b', {'md5': '11' * 16, 'crc32': '00000001'}),
+    ]
+    digests = rollup(children)
+    assert sorted(digests) == ['crc32', 'md5']
+    assert len(digests['md5']) == 32 and len(digests['crc32']) == 8
+    assert rollup(children) == digests
+    assert rollup(children[::-1]) != digests
+    assert rollup([('F', 'a2', children[0][2]), children[1]]) != digests
+    assert rollup([('D', 'a', children[0][2]), children[1]]) != digests
+    assert rollup([('F', 'a', None, '!'), children[1]]) != digests
+    assert rollup([('F', 'a', None, '!')]) == rollup([('F', 'a', {'md5': '!' * 32, 'crc32': '!' * 8})])
+    assert rollup([]) != rollup([('F', 'a', None, '?')])
@@ -0,0 +1,76 @@
+
+import random
+
+import pytest
+import dirtreedigest.extsort as dtextsort
+
+
+@pytest.mark.parametrize(
+    ('rows', 'run_rows'), [
+        (0, 10),
+        (5, 10),
+        (100, 10),
+        (1000, 7),
+    ])
+def test_external_sort(tmp_path, monkeypatch, rows, run_rows):
+    monkeypatch.setattr(dtextsort, 'SPOOL_BATCH_ROWS', 3)
+    rand = random.Random(rows)
+    records = [(rand.randrange(20), i) for i in range(rows)]
+    result = list(dtextsort.external_sort(iter(records), str(tmp_path), run_rows, key=lambda record: record[0]))
+    assert result == sorted(records, key=lambda record: record[0])  # Stable, like sorted()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_external_sort_merge_passes(tmp_path, monkeypatch):
+    monkeypatch.setattr(dtextsort, 'MERGE_FAN_IN', 3)
+    reading = [0, 0]  # Runs being read now, and at most
+    spool_iter = dtextsort.Spool.__iter__
+
+    def counting_iter(spool):
+        reading[0] += 1
+        reading[1] = max(reading)
+        try:
+            yield from spool_iter(spool)
+        finally:
+            reading[0] -= 1
+    monkeypatch.setattr(dtextsort.Spool, '__iter__', counting_iter)
+    rand = random.Random(1)
+    records = [(rand.randrange(20), i) for i in range(1000)]  # 143 runs: merged in 5 passes
+    result = list(dtextsort.external_sort(iter(records), str(tmp_path), 7, key=lambda record: record[0]))
+    assert result == sorted(records, key=lambda record: record[0])
+    assert reading[1] == 3
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.parametrize(
+    ('run_rows', 'rval'), [
+        (1, (1, 4096)),
+        (100000, (781, 312500)),
+        (10000000, (4096, 1024 * 1024)),
+    ])
+def test_merge_sizes(run_rows, rval):
+    assert dtextsort.merge_sizes(run_rows) == rval
+
+
+def test_spool(tmp_path):
+    spool = dtextsort.Spool(str(tmp_path))
+    for i in range(10000):
+        spool.write((b'x', str(i)))
+    assert spool.rows == 10000
+    assert list(spool) == [(b'x', str(i)) for i in range(10000)]
+    spool = dtextsort.Spool(str(tmp_path), batch_rows=10, buffer_size=4096)
+    for i in range(25):
+        spool.write(i)
+    spool.close()
+    assert list(spool) == list(range(25))
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_bloom_filter():
+    bloom = dtextsort.BloomFilter(1000)
+    keys = [bytes([i % 256, i // 256]) for i in range(1000)]
+    for key in keys:
+        bloom.add(key)
+    assert all(key in bloom for key in keys)
+    false_positives = sum(bytes([i % 256, i // 256, 0]) in bloom for i in range(10000))
+    assert false_positives < 300  # ~1% expected
@@ -0,0 +1,112 @@
+
+import io
+
+import pytest
+import dirtreedigest.progress as dtprogress
+import dirtreedigest.utils as dtutils
+
+
+def test_prescan_totals(tmp_path):
+    (tmp_path / 'a' / 'b').mkdir(parents=True)
+    (tmp_path / 'Temp').mkdir()
+    (tmp_path / 'f1').write_bytes(b'x' * 10)
+    (tmp_path / 'a' / 'f2').write_bytes(b'x' * 20)
+    (tmp_path / 'a' / 'b' / 'f3').write_bytes(b'')
+    (tmp_path / 'a' / 'pagefile.sys').write_bytes(b'x' * 40)
+    (tmp_path / 'Temp' / 'f4').write_bytes(b'x' * 80)
+    totals = dtprogress.prescan_totals(
+        str(tmp_path), dtutils.compile_patterns(['Temp']), dtutils.compile_patterns(['pagefile.sys']))
+    assert totals == (3, 30)
+
+
+def test_report_totals(tmp_path):
+    report = tmp_path / 'old.thd'
+    report.write_text('\n'.join([
+        '#  Base path: /base',
+        'D;{md5: ----};00000000;00000000;00000000;41ed;0000;0000000000;d',
+        'F;{md5: 00};00000000;00000000;00000000;81a4;0000;0000000010;d/f1',
+        'F;{md5: 11};00000000;00000000;00000000;81a4;0000;0000000100;d/f2',
+    ]) + '\n', encoding='utf-8')
+    assert dtprogress.report_totals(str(report)) == (2, 0x110)
+
+
+@pytest.mark.parametrize(
+    ('secs', 'rval'), [
+        (0, '0:00:00'),
+        (59.6, '0:01:00'),
+        (3725, '1:02:05'),
+    ])
+def test_format_duration(secs, rval):
+    assert dtprogress.format_duration(secs) == rval
+
+
+def test_format_bytes():
+    assert dtprogress.format_bytes(1000) == '1000.0 B'
+    assert dtprogress.format_bytes(3 << 20) == '3.0 MB'
+    assert dtprogress.format_bytes(5 << 50) == '5120.0 TB'
+
+
+def test_progress_status():
+    reporter = dtprogress.ProgressReporter(60, 'lines', stream=io.StringIO())
+    reporter.start_time = dtutils.curr_time_secs() - 10
+    reporter.add(100)
+    reporter.add(300)
+    status = reporter.status()
+    assert (status['files'], status['bytes'], status['bytes_remaining'], status['eta_s']) == (2, 400, None, None)
+    (reporter.files_total, reporter.bytes_total) = (8, 1600)
+    status = reporter.status()
+    assert status['bytes_remaining'] == 1200
+    assert status['eta_s'] == pytest.approx(30, rel=0.01)
+    line = reporter.format_line(status)
+    assert line.startswith('PROGRESS elapsed_s=10.0 files=2 files_total=8 bytes=400 bytes_total=1600 ')
+    assert line.endswith(' bytes_remaining=1200 eta_s=30 done=0\n')
+    reporter.fmt = 'tty'
+    line = reporter.format_line(status)
+    assert line.startswith('\r2/8 files | 400.0 B of 1.6 KB (25%) | 0 files/s | 0.0 MB/s | ETA 0:00:30')
+    assert not line.endswith('\n')
+    assert reporter.format_line(status, done=True).endswith('| in 0:00:10\x1b[K\n')
+
+
+def test_progress_status_reused():
+    reporter = dtprogress.ProgressReporter(60, 'lines', stream=io.StringIO())
+    reporter.start_time = dtutils.curr_time_secs() - 10
+    reporter.add(100 << 20)
+    reporter.add(900 << 20, reused=True)  # From the update baseline or the cache: no time spent hashing
+    (reporter.files_total, reporter.bytes_total) = (4, 2000 << 20)
+    status = reporter.status()
+    assert (status['bytes'], status['bytes_reused']) == (1000 << 20, 900 << 20)
+    assert status['bytes_remaining'] == 1000 << 20
+    assert status['mb_per_s'] == pytest.approx(10, rel=0.01)
+    assert status['eta_s'] == pytest.approx(100, rel=0.01)
+    line = reporter.format_line(status)
+    assert ' bytes_total=2097152000 bytes_reused=943718400 files_reused=1 files_per_s=0.1 mb_per_s=10.0 ' in line
+    reporter.fmt = 'tty'
+    assert '| 1000.0 MB of 2.0 GB (50%), 900.0 MB reused | 0 files/s | 10.0 MB/s | ETA 0:01:40' in (
+        reporter.format_line(status))
+    # Nothing hashed yet: no rate to go by
+    reporter = dtprogress.ProgressReporter(60, 'lines', stream=io.StringIO())
+    reporter.start_time = dtutils.curr_time_secs() - 10
+    reporter.add(500, reused=True)
+    (reporter.files_total, reporter.bytes_total) = (4, 2000)
+    status = reporter.status()
+    assert (status['files'], status['files_reused']) == (1, 1)
+    assert (status['files_per_s'], status['mb_per_s'], status['eta_s']) == (0, 0, None)
+    # Only hashed files (of no size) to go by
+    reporter.add(0)
+    status = reporter.status()
+    assert status['files_per_s'] == pytest.approx(0.1, rel=0.01)
+    assert status['eta_s'] == pytest.approx(20, rel=0.01)
+
+
+def test_progress_reporter():
+    stream = io.StringIO()
+    reporter = dtprogress.ProgressReporter(0.01, 'auto', estimate=lambda: (1, 5), stream=stream)
+    assert reporter.fmt == 'lines'  # Not a terminal
+    reporter.start()
+    reporter.estimate_thread.join()
+    reporter.add(5)
+    reporter.stop()
+    lines = stream.getvalue().splitlines()
+    assert lines[-1].startswith('PROGRESS ')
+    assert ' files=1 files_total=1 bytes=5 bytes_total=5 ' in lines[-1]
+    assert lines[-1].endswith(' bytes_remaining=0 eta_s=0 done=1')
@@ -0,0 +1,252 @@
+import hashlib
+import mmap
+import multiprocessing
+import os
+
+import pytest
+import dirtreedigest.digester as dtdigester
+import dirtreedigest.reader as dtreader
+import dirtreedigest.utils as dtutils
+import dirtreedigest.worker as dtworker
+
+if dtutils.shared_memory_available() and os.name == 'posix':
+    from multiprocessing import resource_tracker
+else:
+    resource_tracker = None
+
+KB = 1024
+MB = 1024 * 1024
+
+
+class FakeSegment(object):
+    def __init__(self, size):
+        self.size = size
+
+
+def new_ring(slots, budget, min_size=64 * KB):
+    destroyed = []
+    ring = dtreader.BufferRing(slots, budget, min_size, FakeSegment, destroyed.append)
+    return (ring, destroyed)
+
+
+@pytest.mark.parametrize(
+    ('file_size', 'rval'), [
+        (None, 16 * MB),
+        (10 * MB, 10 * MB),
+        (16 * MB, 16 * MB),
+        (17 * MB, 8704 * KB),  # Two even blocks, not 16MB and a 1MB sliver
+        (1000, 4096),
+    ])
+def test_block_size_unmeasured(file_size, rval):
+    sizer = dtreader.BlockSizer(64 * KB, 16 * MB)
+    assert sizer.block_size(file_size) == rval
+
+
+@pytest.mark.parametrize(
+    ('rate', 'rval'), [
+        (100 * MB, 2 * MB),  # 2MB in 0.02s
+        (1 * MB, 64 * KB),  # Never below the smallest block
+        (10000 * MB, 16 * MB),  # Never above the largest block
+    ])
+def test_block_size_measured(rate, rval):
+    sizer = dtreader.BlockSizer(64 * KB, 16 * MB)
+    sizer.record(rate, 1.0)
+    assert sizer.target_size() == rval
+    assert sizer.block_size(100 * rval) == rval
+
+
+def test_block_size_ignores_small_files():
+    sizer = dtreader.BlockSizer(64 * KB, 16 * MB)
+    sizer.record(4 * KB, 0.5)
+    sizer.record(MB, 0)
+    assert sizer.rate is None
+    sizer.record(100 * MB, 1.0)
+    sizer.record(300 * MB, 1.0)
+    assert sizer.rate == 150 * MB
+
+
+def test_buffer_ring_grows_on_demand():
+    (ring, destroyed) = new_ring(4, 64 * MB)
+    assert ring.allocated == 0
+    slot = ring.acquire(100 * KB)
+    assert ring.size(slot) == 128 * KB
+    ring.release(slot)
+    assert ring.acquire(100 * KB) == slot  # Reused as it's big enough
+    ring.release(slot)
+    bigger = ring.acquire(3 * MB)  # Into an empty slot while there is one
+    assert ring.size(bigger) == 4 * MB
+    assert (ring.allocated, ring.allocations) == (4 * MB + 128 * KB, 2)
+    assert not destroyed
+
+
+def test_buffer_ring_replaces_smallest():
+    (ring, destroyed) = new_ring(1, 64 * MB)
+    ring.release(ring.acquire(KB))
+    slot = ring.acquire(MB)
+    assert (ring.size(slot), ring.allocated, ring.peak) == (MB, MB, MB)
+    assert [segment.size for segment in destroyed] == [64 * KB]
+
+
+def test_buffer_ring_budget():
+    (ring, destroyed) = new_ring(4, 8 * MB)
+    slots = [ring.acquire(3 * MB), ring.acquire(3 * MB)]
+    assert ring.acquire(3 * MB) is None  # 12MB would be over budget
+    ring.release(slots[0])
+    small = ring.acquire(MB)
+    assert small == slots[0]  # A free buffer that's big enough
+    ring.release(small)
+    assert ring.acquire(8 * MB) is None  # The busy one still holds 4MB
+    assert not destroyed
+    ring.release(slots[1])
+    slot = ring.acquire(8 * MB)  # Drops both free ones to make room
+    assert ring.size(slot) == 8 * MB
+    assert ring.allocated == 8 * MB
+    assert len(destroyed) == 2
+
+
+def test_buffer_ring_slots():
+    (ring, _) = new_ring(2, 64 * MB)
+    slots = [ring.acquire(KB), ring.acquire(KB)]
+    assert ring.acquire(KB) is None
+    ring.release(slots[1])
+    assert ring.acquire(KB) == slots[1]
+
+
+def test_buffer_ring_trim_and_close():
+    (ring, destroyed) = new_ring(3, 64 * MB)
+    slots = [ring.acquire(MB), ring.acquire(MB)]
+    ring.release(slots[0])
+    ring.trim(0)
+    assert ring.size(slots[0]) == 0 and ring.allocated == MB
+    ring.close()
+    assert ring.allocated == 0 and len(destroyed) == 2
+    assert ring.peak == 2 * MB
+
+
+def write_sparse(filename, size, runs):
+    with open(filename, 'wb') as fileh:
+        for (offset, data) in runs:
+            fileh.seek(offset)
+            fileh.write(data)
+        fileh.truncate(size)
+
+
+def test_extents(tmp_path):
+    filename = str(tmp_path / 'sparse')
+    runs = [(0, os.urandom(4 * KB)), (MB, os.urandom(8 * KB)), (3 * MB, os.urandom(100))]
+    write_sparse(filename, 4 * MB, runs)
+    with open(filename, 'rb') as fileh:
+        expected = fileh.read()
+    with open(filename, 'rb', buffering=0) as file_obj:
+        extents = dtreader.Extents(file_obj, 4 * MB)
+        rebuilt = bytearray()
+        holes = 0
+        while len(rebuilt) < 4 * MB:
+            count = extents.limit(len(rebuilt), 256 * KB)
+            assert count > 0
+            if extents.hole:
+                rebuilt += bytes(count)
+                holes += count
+            else:
+                block = bytearray(count)
+                assert dtreader.read_block_into(file_obj, None, len(rebuilt), memoryview(block)) == count
+                rebuilt += block
+    assert rebuilt == expected
+    if extents.sparse:  # Where the filesystem keeps holes
+        assert holes >= 2 * MB
+
+
+def test_extents_dense(tmp_path):
+    filename = tmp_path / 'dense'
+    filename.write_bytes(os.urandom(64 * KB))
+    with open(str(filename), 'rb', buffering=0) as file_obj:
+        extents = dtreader.Extents(file_obj, 64 * KB)
+        assert not extents.sparse
+        assert extents.limit(0, 16 * KB) == 16 * KB and not extents.hole
+
+
+@pytest.mark.parametrize('mmap_mode', [False, True])
+def test_low_impact_read(tmp_path, mmap_mode):
+    filename = tmp_path / 'elem'
+    data = os.urandom(300 * KB)
+    filename.write_bytes(data)
+    old_time = 1000000000
+    os.utime(str(filename), (old_time, old_time))
+    with dtreader.open_element(str(filename), low_impact=True) as file_obj:
+        file_map = mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ) if mmap_mode else None
+        rebuilt = bytearray()
+        while len(rebuilt) < len(data):
+            block = bytearray(min(128 * KB, len(data) - len(rebuilt)))
+            count = dtreader.read_block_into(file_obj, file_map, len(rebuilt), memoryview(block))
+            dtreader.advise_read(file_obj, file_map, len(rebuilt), count, 128 * KB)
+            rebuilt += block[:count]
+        if file_map is not None:
+            file_map.close()
+    assert rebuilt == data
+    if hasattr(os, 'O_NOATIME'):  # Owners may always use it
+        assert os.stat(str(filename)).st_atime == old_time
+
+
+def test_open_element_missing(tmp_path):
+    for low_impact in (False, True):
+        with pytest.raises(FileNotFoundError):
+            dtreader.open_element(str(tmp_path / 'missing'), low_impact)
+
+
+@pytest.mark.parametrize('shm_mode', [True, False])
+def test_reader_and_workers(tmp_path, shm_mode):
+    digest_names = ['md5', 'sha256']
+    files = []
+    for i in range(2):
+        filename = str(tmp_path / f'f{i}')
+        with open(filename, 'wb') as fileh:
+            fileh.write(os.urandom(300 * KB + i))  # 5 blocks each, with 2 buffers
+        files.append(filename)
+    if shm_mode and resource_tracker:
+        resource_tracker.ensure_running()  # As the walker does, so there's just the one
+    debug_queue = multiprocessing.Queue()
+    results_queue = multiprocessing.Queue()
+    reader_cmd_queue = multiprocessing.Queue()
+    buffer_sems = [multiprocessing.Semaphore(0) for _ in range(2)] if shm_mode else []
+    worker_cmd_queues = [multiprocessing.JoinableQueue() for _ in digest_names]
+    procs = [
+        multiprocessing.Process(target=dtworker.worker_process, name=f'worker-{i}', daemon=True, args=(
+            debug_queue, worker_cmd_queues[i], results_queue, buffer_sems, shm_mode,
+            [(i, dtdigester.DIGEST_FUNCTIONS[digest_name]['entry'])]))
+        for (i, digest_name) in enumerate(digest_names)]
+    procs.append(multiprocessing.Process(target=dtreader.reader_process, name='reader', daemon=True, args=(
+        debug_queue, reader_cmd_queue, results_queue, worker_cmd_queues, buffer_sems, shm_mode,
+        2 * 64 * KB, 64 * KB)))
+    for proc in procs:
+        proc.start()
+    for (file_id, filename) in enumerate(files):
+        reader_cmd_queue.put((dtutils.Cmd.INIT.value, file_id, filename, 64 * KB))
+    digests = {file_id: {} for file_id in range(len(files))}
+    done = {}
+    while len(done) < len(files) or sum(len(found) for found in digests.values()) < len(files) * len(digest_names):
+        record = results_queue.get(timeout=30)
+        if record[0] == dtutils.Cmd.RESULT:
+            digests[record[1]][digest_names[record[2]]] = record[3]
+        elif record[0] == dtutils.Cmd.DONE:
+            done[record[1]] = record[2:4]  # (error, bytes_read)
+    reader_cmd_queue.put((dtutils.Cmd.QUIT.value,))
+    for worker_cmd_queue in worker_cmd_queues:
+        worker_cmd_queue.put((dtutils.Cmd.QUIT.value,))
+    stats = {}
+    while len(stats) < len(procs):
+        record = results_queue.get(timeout=30)
+        assert record[0] == dtutils.Cmd.QUIT
+        stats[record[1]['proc']] = record[1]
+    for proc in procs:
+        proc.join()
+    for (file_id, filename) in enumerate(files):
+        with open(filename, 'rb') as fileh:
+            data = fileh.read()
+        assert done[file_id] == (None, len(data))
+        assert digests[file_id] == {name: hashlib.new(name, data).hexdigest() for name in digest_names}
+    assert stats['reader']['blocks'] == 10
+    assert all(stats[f'worker-{i}']['blocks'] == 10 for i in range(len(digest_names)))
+    if shm_mode:
+        assert stats['reader']['buffers_busy'] == 0
+        assert stats['reader']['buffer_allocs'] <= 2
+        assert not any(buffer_sem.acquire(False) for buffer_sem in buffer_sems)  # No release left uncollected
@@ -0,0 +1,153 @@
+
+import logging
+import os
+
+import pytest
+import dirtreedigest.main_convert as dtmainconv
+import dirtreedigest.thdx as dtthdx
+import dirtreedigest.utils as dtutils
+import dirtreedigest.writer as dtwriter
+
+DIGEST_WIDTHS = {'md5': 16, 'crc32': 4}
+ELEMENTS = [
+    ('D', None, '-', 'a'),
+    ('F', {'md5': '00' * 16, 'crc32': '0badf00d'}, None, 'a/b'),
+    ('F', None, '!', 'a/unreadable'),
+    ('F', {'md5': 'ff' * 16, 'crc32': '00000001'}, None, 'a/c/é ü;x'),
+    ('J', None, 'x', 'junction'),
+    ('F', {'md5': '?' * 32, 'crc32': '?' * 8}, None, 'top'),
+]
+
+
+@pytest.mark.parametrize(
+    ('group_rows'), [
+        1,
+        4,
+        65536,
+    ])
+def test_write_read(tmp_path, monkeypatch, group_rows):
+    monkeypatch.setattr(dtthdx, 'ROW_GROUP_ROWS', group_rows)
+    filename = str(tmp_path / 'report.thdx')
+    writer = dtthdx.ThdxWriter(filename, 'X:/base', DIGEST_WIDTHS)
+    for (i, (elem_type, digests, fill, name)) in enumerate(ELEMENTS):
+        writer.write(elem_type, digests, i, -i, 2 ** 40 + i, 0x81a4, 0x20, i * 1000, name, fill)
+    writer.close('Processed: nothing')
+    assert dtthdx.is_thdx(filename)
+
+    report = dtthdx.ThdxReport(filename)
+    assert report.basepath == 'X:/base'
+    assert report.summary == 'Processed: nothing'
+    assert report.rows == len(ELEMENTS)
+    assert len(report.row_groups) == -(-len(ELEMENTS) // group_rows)
+    elements = list(report.iter_elements())
+    report.close()
+    for (i, (elem, (elem_type, digests, fill, name))) in enumerate(zip(elements, ELEMENTS)):
+        assert elem['type'] == elem_type
+        assert elem['full_name'] == name
+        assert elem['dir_name'] == os.path.dirname(name)
+        assert elem['file_name'] == os.path.basename(name)
+        assert elem['mtime'] == '{:08x}'.format(-i)
+        assert elem['ctime'] == '{:08x}'.format(2 ** 40 + i)
+        assert elem['attr_std'] == '81a4'
+        assert elem['attr_win'] == '0020'
+        assert elem['size'] == '{:010x}'.format(i * 1000)
+        if fill:
+            assert elem['digests'] == {'md5': fill * 32, 'crc32': fill * 8}
+        else:
+            assert elem['digests'] == digests
+
+
+@pytest.mark.parametrize(
+    ('group_rows'), [
+        1,
+        4,
+        65536,
+    ])
+def test_patch_digests(tmp_path, monkeypatch, group_rows):
+    monkeypatch.setattr(dtthdx, 'ROW_GROUP_ROWS', group_rows)
+    filename = str(tmp_path / 'report.thdx')
+    writer = dtthdx.ThdxWriter(filename, '', DIGEST_WIDTHS)
+    rows = [writer.write(elem_type, digests, 0, 0, 0, 0, 0, 0, name, fill)
+            for (elem_type, digests, fill, name) in ELEMENTS]
+    assert rows == list(range(len(ELEMENTS)))
+    patched = {'md5': '12' * 16, 'crc32': '00c0ffee'}
+    writer.patch_digests(0, patched)  # Written out already, unless the row group is big enough
+    writer.patch_digests(len(ELEMENTS) - 1, patched)  # Still in memory
+    writer.close('Processed: nothing', {'md5': '34' * 16})
+    report = dtthdx.ThdxReport(filename)
+    elements = list(report.iter_elements())
+    assert report.tree_digests == {'md5': '34' * 16}
+    report.close()
+    assert elements[0]['digests'] == patched
+    assert elements[-1]['digests'] == patched
+    assert elements[1]['digests'] == ELEMENTS[1][1]
+    assert elements[2]['digests'] == {'md5': '!' * 32, 'crc32': '!' * 8}
+
+
+def test_empty_report(tmp_path):
+    filename = str(tmp_path / 'report.thdx')
+    dtthdx.ThdxWriter(filename, '', DIGEST_WIDTHS).close()
+    report = dtthdx.ThdxReport(filename)
+    assert list(report.iter_elements()) == []
+    assert report.summary is None
+    assert report.tree_digests is None
+    report.close()
+
+
+def test_not_thdx(tmp_path):
+    filename = tmp_path / 'report.thd'
+    filename.write_text('#\n')
+    assert not dtthdx.is_thdx(str(filename))
+    assert not dtthdx.is_thdx(str(tmp_path / 'missing'))
+
+
+@pytest.mark.parametrize(
+    ('report'), [
+        'data_old.thd',
+        'data_new.thd',
+    ])
+def test_convert_round_trip(tmp_path, report):
+    logger = logging.getLogger('test')
+    original = os.path.join(os.path.dirname(__file__), report)
+    binary = str(tmp_path / 'report.thdx')
+    text = str(tmp_path / 'report.thd')
+    rows = dtmainconv.thd_to_thdx(original, binary, logger)
+    assert dtmainconv.thdx_to_thd(binary, text, logger) == rows
+    expected = list(dtutils.iter_dtd_report(original, logger, all_types=True))
+    assert list(dtutils.iter_dtd_report(binary, logger, all_types=True)) == expected
+    assert list(dtutils.iter_dtd_report(text, logger, all_types=True)) == expected
+    assert dtutils.read_dtd_report(binary, logger) == dtutils.read_dtd_report(original, logger)
+
+
+def test_convert_stage_times(tmp_path):
+    logger = logging.getLogger('test')
+    with open(os.path.join(os.path.dirname(__file__), 'data_new.thd'), 'r', encoding='utf-8') as fileh:
+        lines = [line for line in fileh.read().splitlines() if line and line[0] != '#']
+    stage_times = {'walk.lstat': [0.0123, 7], 'read': [1.5, 40], 'hash.md5': [0.75, 40]}
+    original = tmp_path / 'original.thd'
+    original.write_text('\n'.join(
+        dtwriter.header_lines('X:/base') + lines +
+        dtwriter.footer_lines('Processed: 11 file(s)', {'md5': '00' * 16}, dtutils.stage_table(stage_times, 2.0))
+    ) + '\n', encoding='utf-8')
+    binary = str(tmp_path / 'report.thdx')
+    text = tmp_path / 'report.thd'
+    dtmainconv.thd_to_thdx(str(original), binary, logger)
+    report = dtthdx.ThdxReport(binary)
+    assert report.stage_times == {'walk.lstat': [0.012, 7], 'read': [1.5, 40], 'hash.md5': [0.75, 40]}
+    report.close()
+    dtmainconv.thdx_to_thd(binary, str(text), logger)
+    assert text.read_bytes() == original.read_bytes()
+
+
+def test_convert_stage_times_from_thdx(tmp_path):
+    logger = logging.getLogger('test')
+    stage_times = {'read': [1.5, 40], 'hash.md5': [0.75, 40]}
+    binary = str(tmp_path / 'report.thdx')
+    writer = dtthdx.ThdxWriter(binary, 'X:/base', DIGEST_WIDTHS)
+    writer.close('Processed: 0 file(s)', None, stage_times)
+    text = str(tmp_path / 'report.thd')
+    dtmainconv.thdx_to_thd(binary, text, logger)
+    with open(text, 'r', encoding='utf-8') as fileh:
+        lines = fileh.read().splitlines()
+    table = ['#    {}'.format(line) for line in dtutils.stage_table(stage_times)]
+    assert lines[-len(table) - 3:-2] == ['#  Stage times:'] + table
@@ -0,0 +1,93 @@
+
+import hashlib
+import os
+import random
+import threading
+
+import pytest
+import dirtreedigest.digester as dtdigester
+import dirtreedigest.treehash as dttreehash
+
+LEAF = 16
+
+
+def merkle_root(leaves):
+    """ RFC 6962 Merkle tree hash """
+    if len(leaves) == 1:
+        return hashlib.sha256(b'\x00' + leaves[0]).digest()
+    split = 1 << ((len(leaves) - 1).bit_length() - 1)
+    return hashlib.sha256(b'\x01' + merkle_root(leaves[:split]) + merkle_root(leaves[split:])).digest()
+
+
+def blake2b_tree(leaves):
+    params = {'digest_size': 64, 'fanout': 0, 'depth': 2, 'leaf_size': LEAF, 'inner_size': 64}
+    root = hashlib.blake2b(node_offset=0, node_depth=1, last_node=True, **params)
+    for (i, leaf) in enumerate(leaves):
+        root.update(hashlib.blake2b(
+            leaf, node_offset=i, node_depth=0, last_node=(i == len(leaves) - 1), **params).digest())
+    return root.digest()
+
+
+def split_leaves(data):
+    return [data[i:i + LEAF] for i in range(0, len(data), LEAF)] or [b'']
+
+
+@pytest.mark.parametrize('size', [0, 1, LEAF - 1, LEAF, LEAF + 1, 3 * LEAF, 5 * LEAF + 7, 16 * LEAF, 33 * LEAF])
+@pytest.mark.parametrize(('digest_class', 'reference'), [
+    (dttreehash.Sha256Tree, merkle_root),
+    (dttreehash.Blake2bTree, blake2b_tree),
+])
+def test_tree_digest(monkeypatch, digest_class, reference, size):
+    monkeypatch.setattr(dttreehash, 'TREE_LEAF_SIZE', LEAF)
+    data = os.urandom(size)
+    expected = reference(split_leaves(data)).hex()
+    whole = digest_class()
+    whole.update(data)
+    assert whole.hexdigest() == expected
+    # However the stream is cut up into blocks
+    rng = random.Random(size)
+    for _ in range(5):
+        pieces = digest_class()
+        offset = 0
+        while offset < size:
+            count = rng.choice([1, LEAF - 1, LEAF, LEAF + 1, 3 * LEAF, rng.randint(1, 4 * LEAF)])
+            pieces.update(memoryview(bytearray(data[offset:offset + count])))
+            offset += count
+        assert pieces.hexdigest() == expected
+
+
+@pytest.mark.parametrize('name', ['sha256tree', 'blake2btree'])
+def test_tree_digest_registered(name):
+    info = dtdigester.DIGEST_FUNCTIONS[name]
+    digest_instance = info['entry']()
+    digest_instance.update(os.urandom(3 * dttreehash.TREE_LEAF_SIZE + 5))
+    assert digest_instance.name == name
+    assert len(digest_instance.hexdigest()) == info['len']
+    assert name in dtdigester.DIGEST_PRIORITY
+    assert dtdigester.EMPTY_DIGESTS[name] == info['entry']().hexdigest()
+
+
+@pytest.mark.parametrize('count', [1, 3])
+def test_set_leaf_threads(monkeypatch, count):
+    monkeypatch.setattr(dttreehash, 'TREE_LEAF_SIZE', LEAF)
+    data = os.urandom(16 * LEAF)
+    threads = set()
+
+    def leaf_func(leaf):
+        threads.add(threading.current_thread())
+        return bytes(leaf)
+    dttreehash.set_leaf_threads(count)
+    try:
+        assert dttreehash.leaf_threads() == count
+        assert dttreehash.hash_leaves(leaf_func, split_leaves(data)) == split_leaves(data)
+        if count == 1:
+            assert threads == {threading.current_thread()}
+        else:
+            assert dttreehash.leaf_pool()._max_workers == count
+            assert threading.current_thread() not in threads
+        digest_instance = dttreehash.Sha256Tree()
+        digest_instance.update(data)
+        assert digest_instance.hexdigest() == merkle_root(split_leaves(data)).hex()
+    finally:
+        dttreehash.set_leaf_threads(None)
+    assert dttreehash.leaf_threads() == (os.cpu_count() or 1)
@@ -1,4 +1,8 @@
 
+import logging
+import os
+import pstats
+
 import pytest
 import dirtreedigest.utils as dtutils
 
@@ -31,6 +35,24 @@ def test_split_net_drive(path, rval):
     assert dtutils.split_net_drive(path) == rval
 
 
+@pytest.mark.parametrize(
+    ('value', 'rval'), [
+        ('16', 16 * 1024 * 1024),
+        ('512K', 512 * 1024),
+        ('512k', 512 * 1024),
+        ('4M', 4 * 1024 * 1024),
+        ('0.5', 512 * 1024),
+    ])
+def test_parse_size(value, rval):
+    assert dtutils.parse_size(value) == rval
+
+
+@pytest.mark.parametrize('value', ['', 'K', '4G', 'big'])
+def test_parse_size_invalid(value):
+    with pytest.raises(ValueError):
+        dtutils.parse_size(value)
+
+
 @pytest.mark.parametrize(
     ('root', 'elem', 'rval'), [
         ('C:/', 'C:/test/a', 'test/a'),
@@ -58,3 +80,134 @@ def test_get_relative_path(root, elem, rval):
 def test_elem_is_matched(root, elem, patterns, ignorecase, rval):
     re_pats = dtutils.compile_patterns(patterns, ignorecase)
     assert dtutils.elem_is_matched(root, elem, re_pats) == rval
+
+
+@pytest.mark.parametrize(
+    ('name', 'patterns', 'ignorecase', 'rval'), [
+        ('Temp', ['Temp'], False, True),
+        ('temp', ['Temp'], False, False),
+        ('temp', ['Temp'], True, True),
+        ('Temporary', ['Temp'], False, False),
+        ('a.b', ['a?b', 'a.b'], False, True),
+        ('Temp', [], False, False),
+    ])
+def test_name_is_matched(name, patterns, ignorecase, rval):
+    re_pats = dtutils.compile_patterns(patterns, ignorecase)
+    assert dtutils.name_is_matched(name, re_pats) == rval
+
+
+def test_path_sort_key():
+    walk_order = ['a', 'a/b', 'a/b/c', 'a/z', 'a b', 'a b/c', 'a-b', 'ab', 'b']
+    assert sorted(reversed(walk_order), key=dtutils.path_sort_key) == walk_order
+
+
+def test_iter_dtd_report():
+    logger = logging.getLogger('test')
+    filename = os.path.join(os.path.dirname(__file__), 'data_old.thd')
+    header = {}
+    elements = list(dtutils.iter_dtd_report(filename, logger, header))
+    (basepath, read_elements) = dtutils.read_dtd_report(filename, logger)
+    assert header['basepath'] == basepath == 'X:/test_files/data_old'
+    assert [elem['full_name'] for elem in elements] == [elem['full_name'] for elem in read_elements]
+
+
+@pytest.mark.parametrize(
+    ('lines', 'rval'), [
+        (['F;{md5: 00, sha1: 11};1;2;3;81a4;0020;00000004;a/b;c'],
+         [('F', {'md5': '00', 'sha1': '11'}, 'a/b;c', 'a', 'b;c')]),
+        (['F;{md5: 00, sha1: 11};1;2;3;81a4;0020;00000004;a',
+          'D;{md5: --, sha1: --};1;2;3;41ed;0010;00000000;b/c'],
+         [('F', {'md5': '00', 'sha1': '11'}, 'a', '', 'a'), ('D', {'md5': '--', 'sha1': '--'}, 'b/c', 'b', 'c')]),
+        (['F;{md5: 00, sha1: 11};1;2;3;81a4;0020;00000004;a', 'F;{md5: 22,sha1:   33};1;2;3;81a4;0020;00000004;b'],
+         [('F', {'md5': '00', 'sha1': '11'}, 'a', '', 'a'), ('F', {'md5': '22', 'sha1': '33'}, 'b', '', 'b')]),
+        (['F;{md5: 00, sha1: 11};1;2;3;81a4;0020;00000004;/a'],
+         [('F', {'md5': '00', 'sha1': '11'}, '/a', '/', 'a')]),
+        (['00ff;1;2;3;0020;00000004;x/y', '--;1;2;3;0010;00000000;x', '??;1;2;3;0020;00000004;z'],
+         [('F', {'md5': '00ff'}, 'x/y', 'x', 'y'), ('D', {'md5': '--'}, 'x', '', 'x'),
+          ('?', {'md5': '??'}, 'z', '', 'z')]),
+        (['00ff;1;2;3;0020;00000004;x', 'F;{md5: 00};1;2;3;81a4;0020;00000004;a', '11ff;1;2;3;0020;00000004;y'],
+         [('F', {'md5': '00ff'}, 'x', '', 'x'), ('F', {'md5': '11ff'}, 'y', '', 'y')]),
+        (['# comment', '', 'junk'], []),
+    ])
+def test_parse_thd_lines(lines, rval):
+    elements = list(dtutils.parse_thd_lines(lines, lambda level, message: None))
+    assert [(elem['type'], elem['digests'], elem['full_name'], elem['dir_name'], elem['file_name'])
+            for elem in elements] == rval
+
+
+def test_parse_thd_lines_shares_dir_names():
+    lines = ['F;{md5: 00};1;2;3;81a4;0020;00000004;' + name for name in ['dir/a', 'dir/b']]
+    (elem_a, elem_b) = dtutils.parse_thd_lines(lines, lambda level, message: None)
+    assert elem_a['dir_name'] is elem_b['dir_name']
+
+
+@pytest.mark.parametrize(
+    ('report'), [
+        'data_old.thd',
+        'data_new.thd',
+        'data_interrupted.thd',
+    ])
+def test_read_dtd_report_chunked(monkeypatch, report):
+    monkeypatch.setattr(dtutils, 'PARSE_CHUNK_MIN_SIZE', 0)
+    logger = logging.getLogger('test')
+    filename = os.path.join(os.path.dirname(__file__), report)
+    assert dtutils.read_dtd_report(filename, logger, processes=3) == dtutils.read_dtd_report(filename, logger)
+
+
+@pytest.mark.parametrize(
+    ('filler_lines'), [
+        0,
+        20000,  # Well past the tail that's read
+    ])
+def test_read_report_footer(tmp_path, filler_lines):
+    filename = tmp_path / 'report.thd'
+    lines = ['#  Base path: /base']
+    lines += [
+        'F;{md5: %032x};00000000;00000000;00000000;81a4;0000;0000000001;f%d' % (i, i) for i in range(filler_lines)]
+    lines += ['#', '#  Tree digests: {md5: %s, sha1: %s}' % ('ab' * 16, 'cd' * 20), '#  Processed: 1 file(s)', '#']
+    filename.write_text('\r\n'.join(lines) + '\r\n', encoding='utf-8')
+    assert dtutils.read_report_footer(str(filename)) == {
+        'summary': 'Processed: 1 file(s)',
+        'tree_digests': {'md5': 'ab' * 16, 'sha1': 'cd' * 20},
+    }
+    filename.write_text('\n'.join(lines[:-3]) + '\n', encoding='utf-8')
+    assert dtutils.read_report_footer(str(filename)) == {'summary': None, 'tree_digests': None}
+
+
+@pytest.mark.parametrize(
+    ('names', 'seeks', 'rval', 'skipped'), [
+        (['a', 'a/b', 'b'], ['a', 'a/b', 'b'], ['a', 'a/b', 'b'], 0),
+        (['a', 'a/b', 'b'], ['0', 'a/a', 'a/c', 'c'], [None, None, None, None], 0),
+        (['a', 'a/b', 'b'], ['b'], ['b'], 0),
+        (['a', 'c', 'b', 'd'], ['a', 'b', 'c', 'd'], ['a', None, 'c', 'd'], 1),
+        ([], ['a'], [None], 0),
+    ])
+def test_report_cursor(names, seeks, rval, skipped):
+    cursor = dtutils.ReportCursor(({'full_name': name} for name in names), logging.getLogger('test'))
+    found = [cursor.seek(name) for name in seeks]
+    assert [elem['full_name'] if elem else None for elem in found] == rval
+    assert cursor.skipped == skipped
+    cursor.close()
+
+
+def test_stage_times():
+    stage_times = {}
+    dtutils.add_stage_time(stage_times, 'read', 1.5)
+    dtutils.add_stage_time(stage_times, 'read', 0.5, 3)
+    dtutils.merge_stage_times(stage_times, {'hash.md5': [4.0, 8], 'read': [1.0, 1]})
+    dtutils.merge_stage_times(stage_times, None)
+    assert stage_times == {'read': [3.0, 5], 'hash.md5': [4.0, 8]}
+    lines = dtutils.stage_table(stage_times, wall_time=8.0)
+    assert lines[0].split() == ['stage', 'seconds', 'count', 'us/each', '%wall']
+    assert lines[1].split() == ['hash.md5', '4.000', '8', '500000.0', '50.0%']
+    assert lines[2].split() == ['read', '3.000', '5', '600000.0', '37.5%']
+    assert '%wall' not in dtutils.stage_table(stage_times)[0]
+
+
+def test_run_profiled(tmp_path):
+    assert dtutils.profile_name(None, '---Worker-0') is None
+    filename = dtutils.profile_name(str(tmp_path / 'run'), '---Worker-0')
+    assert filename == str(tmp_path / 'run.worker-0.prof')
+    assert dtutils.run_profiled(None, sum, [1, 2]) == 3
+    assert dtutils.run_profiled(filename, sum, [1, 2]) == 3
+    assert pstats.Stats(filename).total_calls > 0
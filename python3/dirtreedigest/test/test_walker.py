@@ -0,0 +1,41 @@
+import os
+
+import pytest
+
+
+def walk_order(root, prefix=''):
+    """ Names in the walker's order: sorted within each directory, each directory before its contents """
+    names = []
+    for name in sorted(os.listdir(root)):
+        names.append(prefix + name)
+        if os.path.isdir(os.path.join(root, name)):
+            names += walk_order(os.path.join(root, name), prefix + name + '/')
+    return names
+
+
+@pytest.fixture
+def mixed_tree(tmp_path):
+    """ Nested directories whose names mix case and sort around '/' ('a-b' < 'a.b' < 'a/x' < 'a0') """
+    root = tmp_path / 'tree'
+    dirs = ['A', 'a', 'a/a', 'a/a/B', 'a.b', 'a0', 'a0/a-b', 'B/a/a_']
+    files = ['Z.txt', 'z.txt', 'a b', 'a-b', 'a_', 'b', 'A/b', 'a/a b', 'a/a/a-b', 'a/a/B/a.b', 'a/a0',
+             'a.b/a', 'a.b/A', 'a0/a-b/a b', 'a0/a-b/a.b', 'B/a/a_/z', 'B/a.b']
+    for name in dirs:
+        (root / name).mkdir(parents=True)
+    for (i, name) in enumerate(files):
+        (root / name).write_bytes(os.urandom(100 * i))
+    return root
+
+
+def test_walk_order(mixed_tree, run_digester):
+    expected = walk_order(str(mixed_tree))
+    assert 'a-b' in expected and 'a/a' in expected and 'a0/a-b/a b' in expected
+    # Depth first, so not the order of the full names: 'a/a' < 'a b' < 'a-b' < 'a.b' < 'a0' < 'a_'
+    assert expected.index('a/a') < expected.index('a b') < expected.index('a-b') < expected.index('a.b')
+    assert expected != sorted(expected)
+    (serial, _) = run_digester(mixed_tree, '--digests', 'md5', '--walkers', '0')
+    assert [elem['full_name'] for elem in serial] == expected
+    for walkers in [1, 4]:
+        (threaded, _) = run_digester(mixed_tree, '--digests', 'md5', '--walkers', str(walkers))
+        assert [(elem['full_name'], elem['type'], elem['digests']) for elem in threaded] == [
+            (elem['full_name'], elem['type'], elem['digests']) for elem in serial]
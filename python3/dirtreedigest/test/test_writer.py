@@ -0,0 +1,87 @@
+
+import os
+
+import pytest
+import dirtreedigest.writer as dtwriter
+
+
+@pytest.mark.parametrize(
+    ('lines', 'batch_lines', 'fsync'), [
+        (0, 1024, 'none'),
+        (5, 2, 'none'),
+        (3000, 1024, 'close'),
+        (10, 1, 'flush'),
+    ])
+def test_report_writer(tmp_path, lines, batch_lines, fsync):
+    filename = tmp_path / 'report.thd'
+    filename.write_text('header\n')
+    writer = dtwriter.ReportWriter(str(filename), flush_secs=0.01, fsync=fsync, batch_lines=batch_lines)
+    expected = ['header']
+    for i in range(lines):
+        writer.write(dtwriter.ALT_LINE('-' * 8, i, i, i, 0, i, f'dir/file {i}'))
+        expected.append('--------;{0:08x};{0:08x};{0:08x};0000;{0:010x};dir/file {0}'.format(i))
+    writer.close()
+    with open(filename, 'r', encoding='utf-8') as fileh:
+        assert fileh.read().splitlines() == expected
+
+
+@pytest.mark.parametrize(
+    ('batch_lines'), [
+        1,
+        3,
+        1024,
+    ])
+def test_report_writer_patch(tmp_path, batch_lines):
+    filename = tmp_path / 'report.thd'
+    filename.write_text('header\n')
+    writer = dtwriter.ReportWriter(str(filename), flush_secs=60, batch_lines=batch_lines)
+    writer.write('D;{md5: ----};é\n', mark='é')
+    for i in range(5):
+        writer.write('F;{md5: 0000};é/%d\n' % i)
+    writer.write('D;{md5: ----};x\n', mark='x')
+    writer.patch('x', 2, '{md5: 2222}')
+    writer.patch('é', 2, '{md5: 1111}')
+    writer.close()
+    with open(filename, 'r', encoding='utf-8') as fileh:
+        lines = fileh.read().splitlines()
+    assert lines[1] == 'D;{md5: 1111};é'
+    assert lines[2:7] == ['F;{md5: 0000};é/%d' % i for i in range(5)]
+    assert lines[7] == 'D;{md5: 2222};x'
+
+
+@pytest.mark.parametrize(
+    ('fsync', 'rval'), [
+        ('none', set()),
+        ('close', {'report', 'patch'}),
+        ('flush', {'report', 'patch'}),
+    ])
+def test_report_writer_patch_fsync(tmp_path, monkeypatch, fsync, rval):
+    synced = []
+    writer = None
+
+    def fake_fsync(fd):
+        synced.append('patch' if writer.patch_fileh and fd == writer.patch_fileh.fileno() else 'report')
+    monkeypatch.setattr(dtwriter.os, 'fsync', fake_fsync)
+    filename = tmp_path / 'report.thd'
+    writer = dtwriter.ReportWriter(str(filename), flush_secs=60, fsync=fsync, batch_lines=1)
+    writer.write('D;{md5: ----};d\n', mark='d')
+    writer.write('F;{md5: 0000};d/f\n')
+    writer.patch('d', 2, '{md5: 1111}')  # In the file: its batch has been handed off
+    writer.close()
+    assert set(synced) == rval
+    assert synced[-1:] == (['patch'] if rval else [])
+    assert filename.read_text(encoding='utf-8').splitlines() == ['D;{md5: 1111};d', 'F;{md5: 0000};d/f']
+
+
+def test_footer_lines():
+    lines = dtwriter.footer_lines('Processed: x', {'sha1': '11', 'md5': '00'})
+    assert '#  Tree digests: {md5: 00, sha1: 11}' in lines
+    assert '#  Processed: x' in lines
+    assert not any('Tree digests' in line for line in dtwriter.footer_lines('Processed: x'))
+    lines = dtwriter.footer_lines('Processed: x', stage_lines=['stage  seconds', 'read  1.000'])
+    assert lines[lines.index('#  Stage times:') + 1:][:2] == ['#    stage  seconds', '#    read  1.000']
+
+
+def test_element_line():
+    line = dtwriter.ELEMENT_LINE('F', '{md5: x}', 1, 2, 3, 0x81a4, 0, 10, 'a/é')
+    assert line == 'F;{md5: x};00000001;00000002;00000003;81a4;0000;000000000a;a/é' + os.linesep
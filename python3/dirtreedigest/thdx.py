@@ -0,0 +1,343 @@
+"""
+
+    Copyright (c) 2017-2021 Martin F. Falatic
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Binary columnar report format (.thdx)
+
+    MAGIC, version (uint32)
+    row group 0 .. N-1, each a run of 8-byte aligned columns:
+        type, fill                  uint8 (fill is 0 when the digests are real,
+                                    else the character the text report pads with)
+        atime, mtime, ctime, size   int64
+        attr_std, attr_win          uint32
+        dir                         uint32 index into the path table
+        name_offsets, names         uint32 offsets (rows + 1) into utf-8 base names
+        one column per digest       raw digest bytes, fixed width
+    path table: offsets (uint64, count + 1) and utf-8 directory names
+    footer: utf-8 JSON with the column index and report details
+    trailer: footer length (uint64), MAGIC
+
+"""
+
+import array
+import bisect
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+
+MAGIC = b'THDX'
+VERSION = 1
+EXTENSION = 'thdx'
+ROW_GROUP_ROWS = 65536
+HEADER = struct.Struct('<4sI')
+TRAILER = struct.Struct('<Q4s')
+
+INT_COLUMNS = [
+    ('type', 'B'),
+    ('fill', 'B'),
+    ('atime', 'q'),
+    ('mtime', 'q'),
+    ('ctime', 'q'),
+    ('size', 'q'),
+    ('attr_std', 'I'),
+    ('attr_win', 'I'),
+    ('dir', 'I'),
+]
+
+
+def is_thdx(filename):
+    """ Check whether a report is in the binary format """
+    try:
+        with open(filename, 'rb') as fileh:
+            return fileh.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def digest_bytes(digest_value, width):
+    """ Raw bytes for a hex digest; None if it's a placeholder (e.g., '!!!!') """
+    try:
+        raw = bytes.fromhex(digest_value)
+    except ValueError:
+        return None
+    return raw if len(raw) == width else None
+
+
+class ThdxWriter(object):
+    """ Writes a report as row groups of columns, a row group at a time """
+
+    def __init__(self, filename, basepath, digest_widths):
+        self.filename = filename
+        self.basepath = basepath
+        self.digest_widths = digest_widths  # {digest_name: raw length in bytes}
+        self.digest_names = sorted(digest_widths)
+        self.fileh = open(filename, 'wb', buffering=1024 * 1024)
+        self.fileh.write(HEADER.pack(MAGIC, VERSION))
+        self.row_groups = []
+        self.group_starts = []  # First row of each written row group
+        self.paths = {}
+        self.rows = 0
+        self.write_time = 0.0  # Spent writing out row groups
+        self.write_calls = 0
+        self._new_group()
+
+    def write(self, elem_type, digests, atime, mtime, ctime, attr_std, attr_win, size, name, fill=None):
+        """ Add one element; digests are hex strings, or fill gives the placeholder character
+            Returns the element's row, for patch_digests
+        """
+        (dir_name, _, file_name) = name.rpartition('/')
+        dir_index = self.paths.get(dir_name)
+        if dir_index is None:
+            dir_index = self.paths[dir_name] = len(self.paths)
+        cols = self.cols
+        cols['type'].append(ord(elem_type))
+        cols['atime'].append(atime)
+        cols['mtime'].append(mtime)
+        cols['ctime'].append(ctime)
+        cols['size'].append(size)
+        cols['attr_std'].append(attr_std)
+        cols['attr_win'].append(attr_win)
+        cols['dir'].append(dir_index)
+        self.names.append(file_name.encode('utf-8'))
+        raw_digests = []
+        if fill is None:
+            for digest_name in self.digest_names:
+                raw = digest_bytes(digests.get(digest_name, ''), self.digest_widths[digest_name])
+                if raw is None:
+                    fill = (digests.get(digest_name) or '?')[0]
+                    break
+                raw_digests.append(raw)
+        if fill is None:
+            cols['fill'].append(0)
+            for (digest_name, raw) in zip(self.digest_names, raw_digests):
+                self.digests[digest_name].append(raw)
+        else:
+            cols['fill'].append(ord(fill))
+            for digest_name in self.digest_names:
+                self.digests[digest_name].append(bytes(self.digest_widths[digest_name]))
+        self.rows += 1
+        if len(self.names) >= ROW_GROUP_ROWS:
+            self._write_group()
+        return self.rows - 1
+
+    def patch_digests(self, row, digests):
+        """ Give an earlier row real digests (hex strings for every digest column) """
+        group_start = self.rows - len(self.names)
+        if row >= group_start:
+            index = row - group_start
+            self.cols['fill'][index] = 0
+            for digest_name in self.digest_names:
+                self.digests[digest_name][index] = bytes.fromhex(digests[digest_name])
+            return
+        group_index = bisect.bisect_right(self.group_starts, row) - 1
+        columns = self.row_groups[group_index]['columns']
+        index = row - self.group_starts[group_index]
+        end = self.fileh.tell()
+        self.fileh.seek(columns['fill'][0] + index)
+        self.fileh.write(b'\0')
+        for digest_name in self.digest_names:
+            self.fileh.seek(columns['digest:' + digest_name][0] + index * self.digest_widths[digest_name])
+            self.fileh.write(bytes.fromhex(digests[digest_name]))
+        self.fileh.seek(end)
+
+    def close(self, summary=None, tree_digests=None, stage_times=None, stage_lines=None):
+        """ Write the last row group, the path table and the footer
+            stage_lines keeps a text report's stage table as written, for converting back
+        """
+        self._write_group()
+        path_names = [name.encode('utf-8') for name in self.paths]  # In index order
+        paths = {
+            'offsets': self._write_column(_offsets(path_names, 'Q')),
+            'names': self._write_column(b''.join(path_names)),
+            'count': len(path_names),
+        }
+        footer = json.dumps({
+            'version': VERSION,
+            'byteorder': sys.byteorder,
+            'basepath': self.basepath,
+            'summary': summary,
+            'tree_digests': tree_digests,
+            'stage_times': stage_times,
+            'stage_lines': stage_lines,
+            'digests': [[digest_name, self.digest_widths[digest_name]] for digest_name in self.digest_names],
+            'rows': self.rows,
+            'row_groups': self.row_groups,
+            'paths': paths,
+        }).encode('utf-8')
+        self.fileh.write(footer)
+        self.fileh.write(TRAILER.pack(len(footer), MAGIC))
+        self.fileh.close()
+
+    def _new_group(self):
+        """ Start collecting the next row group """
+        self.cols = {col_name: array.array(typecode) for (col_name, typecode) in INT_COLUMNS}
+        self.names = []
+        self.digests = {digest_name: [] for digest_name in self.digest_names}
+
+    def _write_group(self):
+        """ Write out the collected rows as one row group """
+        if not self.names:
+            return
+        start_time = time.perf_counter()
+        group = {'rows': len(self.names), 'columns': {}}
+        self.group_starts.append(self.rows - len(self.names))
+        for (col_name, _) in INT_COLUMNS:
+            group['columns'][col_name] = self._write_column(self.cols[col_name])
+        group['columns']['name_offsets'] = self._write_column(_offsets(self.names, 'I'))
+        group['columns']['names'] = self._write_column(b''.join(self.names))
+        for digest_name in self.digest_names:
+            group['columns']['digest:' + digest_name] = self._write_column(b''.join(self.digests[digest_name]))
+        self.row_groups.append(group)
+        self._new_group()
+        self.write_time += time.perf_counter() - start_time
+        self.write_calls += 1
+
+    def _write_column(self, data):
+        """ Write one 8-byte aligned column; returns its [offset, length] """
+        offset = self.fileh.tell()
+        padding = -offset % 8
+        if padding:
+            self.fileh.write(bytes(padding))
+            offset += padding
+        data = memoryview(data).cast('B')
+        self.fileh.write(data)
+        return [offset, len(data)]
+
+
+def _offsets(blobs, typecode):
+    """ Start offsets of each blob when concatenated, plus the total length """
+    offsets = array.array(typecode, [0])
+    total = 0
+    for blob in blobs:
+        total += len(blob)
+        offsets.append(total)
+    return offsets
+
+
+class ThdxReport(object):
+    """ A memory-mapped .thdx report
+
+        Columns are read in place from the mapping as typed memoryviews;
+        nothing is decoded until it's asked for.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as fileh:
+            self.map = mmap.mmap(fileh.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        (magic, version) = HEADER.unpack_from(self.map, 0)
+        (footer_len, end_magic) = TRAILER.unpack_from(self.map, len(self.map) - TRAILER.size)
+        if magic != MAGIC or end_magic != MAGIC or version > VERSION:
+            self.close()
+            raise ValueError(f'Not a readable .{EXTENSION} report: {filename}')
+        footer_end = len(self.map) - TRAILER.size
+        self.footer = json.loads(bytes(self.map[footer_end - footer_len:footer_end]).decode('utf-8'))
+        self.swap = self.footer['byteorder'] != sys.byteorder
+        self.basepath = self.footer['basepath']
+        self.summary = self.footer['summary']
+        self.tree_digests = self.footer.get('tree_digests')  # None for reports written without them
+        self.stage_times = self.footer.get('stage_times')
+        self.stage_lines = self.footer.get('stage_lines')  # Only in reports converted from text
+        self.digest_widths = dict(self.footer['digests'])
+        self.digest_names = [digest_name for (digest_name, _) in self.footer['digests']]
+        self.rows = self.footer['rows']
+        self.row_groups = self.footer['row_groups']
+        paths = self.footer['paths']
+        self.paths = self._strings(
+            self.column(paths['offsets'], 'Q'), self.column(paths['names']), paths['count'])
+
+    def column(self, location, typecode='B'):
+        """ A column as a typed view into the mapping """
+        (offset, length) = location
+        if not length:
+            return array.array(typecode)
+        col = self.view[offset:offset + length].cast(typecode)
+        if self.swap and col.itemsize > 1:
+            col = array.array(typecode, col)
+            col.byteswap()
+        return col
+
+    def group_columns(self, group):
+        """ All of a row group's columns, by name """
+        cols = {
+            col_name: self.column(group['columns'][col_name], typecode) for (col_name, typecode) in INT_COLUMNS}
+        cols['names'] = self._strings(
+            self.column(group['columns']['name_offsets'], 'I'), self.column(group['columns']['names']), group['rows'])
+        for digest_name in self.digest_names:
+            cols['digest:' + digest_name] = self.column(group['columns']['digest:' + digest_name])
+        return cols
+
+    def iter_elements(self):
+        """ Yield every element as the same dict read_dtd_report builds from a text report """
+        hex8 = '{:08x}'.format
+        hex4 = '{:04x}'.format
+        hex10 = '{:010x}'.format
+        paths = self.paths
+        for group in self.row_groups:
+            cols = self.group_columns(group)
+            # Whole columns at a time: one hex() call per digest, one tolist() per integer column
+            digest_cols = []
+            for digest_name in self.digest_names:
+                hex_width = 2 * self.digest_widths[digest_name]
+                hex_col = cols['digest:' + digest_name].hex()
+                digest_cols.append((digest_name, hex_col, hex_width))
+            rows = zip(
+                cols['type'].tolist(), cols['fill'].tolist(),
+                cols['atime'].tolist(), cols['mtime'].tolist(), cols['ctime'].tolist(),
+                cols['attr_std'].tolist(), cols['attr_win'].tolist(),
+                cols['size'].tolist(), cols['dir'].tolist(), cols['names'])
+            for (row, (elem_type, fill, atime, mtime, ctime, attr_std, attr_win, size, dir_index, file_name)) in (
+                    enumerate(rows)):
+                if fill:
+                    digests = {digest_name: chr(fill) * hex_width for (digest_name, _, hex_width) in digest_cols}
+                else:
+                    digests = {
+                        digest_name: hex_col[row * hex_width:(row + 1) * hex_width]
+                        for (digest_name, hex_col, hex_width) in digest_cols}
+                dir_name = paths[dir_index]
+                yield {
+                    'digests': digests,
+                    'type': chr(elem_type),
+                    'atime': hex8(atime),
+                    'mtime': hex8(mtime),
+                    'ctime': hex8(ctime),
+                    'attr_std': hex4(attr_std),
+                    'attr_win': hex4(attr_win),
+                    'size': hex10(size),
+                    'full_name': f'{dir_name}/{file_name}' if dir_name else file_name,
+                    'dir_name': dir_name,
+                    'file_name': file_name,
+                }
+
+    def close(self):
+        """ Release the mapping """
+        self.paths = None
+        self.view.release()
+        self.map.close()
+
+    def _strings(self, offsets, blob, count):
+        """ Decode a run of utf-8 strings given their offsets """
+        data = bytes(blob)
+        return [data[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(count)]
+
+
+def thdx_filename(filename):
+    """ The .thdx name for a text report (or any other file name) """
+    (root, ext) = os.path.splitext(filename)
+    return f'{root if ext == ".thd" else filename}.{EXTENSION}'
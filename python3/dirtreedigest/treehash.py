@@ -0,0 +1,224 @@
+"""
+
+    Copyright (c) 2017-2021 Martin F. Falatic
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Tree-hash digests, whose leaves can be hashed in parallel
+
+    A stream digest such as sha256 has to see a file's bytes in order, so
+    however many cores there are, one huge file hashes on one of them.
+    These digests split their input into fixed-size leaves, hash the
+    leaves of each block on a shared thread pool (hashlib lets go of the
+    GIL while it hashes), and combine the leaf digests into one:
+
+      sha256tree   a Merkle tree over sha256, as in RFC 6962: leaves are
+                   sha256(0x00 + leaf), nodes sha256(0x01 + left + right),
+                   split at the largest power of two below the leaf count
+
+      blake2btree  BLAKE2b's own tree mode: unlimited fanout, depth 2,
+                   with the leaf digests hashed in order by the root node
+
+    The pool has a thread per core, unless set_leaf_threads() says
+    otherwise: processes that hash side by side share the cores out, and
+    with one thread apiece they hash their leaves serially.
+
+    They look like any other digest (update, hexdigest, name), so they
+    work in every engine and in the reports and comparator. The leaf size
+    is part of each digest's definition: changing it changes the digests.
+
+"""
+
+import hashlib
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+TREE_LEAF_SIZE = 1024 * 1024
+
+_pool_lock = threading.Lock()
+_pool = None
+_leaf_threads = None  # One per core
+
+
+def _forget_pool():
+    """ A forked child has none of its parent's pool threads (and maybe a held lock): start over """
+    global _pool, _pool_lock
+    _pool = None
+    _pool_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_pool)
+
+
+def set_leaf_threads(count):
+    """ How many threads this process hashes leaves on (None: one per core, 1: no pool) """
+    global _pool, _leaf_threads
+    with _pool_lock:
+        _leaf_threads = count
+        if _pool is not None:
+            _pool.shutdown(wait=False)
+            _pool = None
+
+
+def leaf_threads():
+    """ How many threads this process hashes leaves on """
+    return _leaf_threads or os.cpu_count() or 1
+
+
+def leaf_pool():
+    """ The thread pool for hashing leaves, shared by every tree digest in the process """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=leaf_threads(), thread_name_prefix='leaf')
+        return _pool
+
+
+def hash_leaves(leaf_func, leaves):
+    """ [leaf_func(leaf) ...], in parallel when there's more than one leaf and more than one thread """
+    if len(leaves) < 2 or leaf_threads() < 2:
+        return [leaf_func(leaf) for leaf in leaves]
+    return list(leaf_pool().map(leaf_func, leaves))
+
+
+class TreeHash(object):
+    """ Splits a stream into TREE_LEAF_SIZE leaves, hashing each block's leaves in parallel
+
+        Subclasses define _hash_leaf(index, leaf, last) (run on the pool),
+        _add_leaf(leaf_digest), which is given the leaf digests in order,
+        and _root(). With hold_last, a full leaf isn't hashed until more
+        data follows it, for constructions that mark the last leaf.
+    """
+    hold_last = False
+
+    def __init__(self):
+        self.pending = bytearray()  # The start of the next leaf
+        self.leaves = 0
+        self.result = None
+
+    def update(self, data):
+        """ Take in more of the stream; the data isn't referenced once this returns """
+        with memoryview(data) as view, view.cast('B') as byte_view:
+            self._update(byte_view)
+
+    def _update(self, view):
+        leaves = []
+        offset = 0
+        if self.pending:
+            offset = min(len(view), TREE_LEAF_SIZE - len(self.pending))
+            self.pending += view[:offset]
+            if len(self.pending) < TREE_LEAF_SIZE or (self.hold_last and offset == len(view)):
+                return
+            leaves.append(self.pending)
+            self.pending = bytearray()
+        end = len(view) - (len(view) - offset) % TREE_LEAF_SIZE
+        if self.hold_last and end == len(view) and end > offset:
+            end -= TREE_LEAF_SIZE
+        leaves.extend(view[start:start + TREE_LEAF_SIZE] for start in range(offset, end, TREE_LEAF_SIZE))
+        self.pending += view[end:]
+        first = self.leaves
+        self.leaves += len(leaves)
+        for leaf_digest in hash_leaves(self._hash_leaf_at, list(enumerate(leaves, first))):
+            self._add_leaf(leaf_digest)
+        for leaf in leaves:
+            if isinstance(leaf, memoryview):
+                leaf.release()
+
+    def _hash_leaf_at(self, indexed_leaf):
+        (index, leaf) = indexed_leaf
+        return self._hash_leaf(index, leaf, False)
+
+    def digest(self):
+        """ The digest of everything so far (further updates aren't allowed) """
+        if self.result is None:
+            if self.pending or not self.leaves:
+                self._add_leaf(self._hash_leaf(self.leaves, self.pending, True))
+                self.leaves += 1
+                self.pending = bytearray()
+            self.result = self._root()
+        return self.result
+
+    def hexdigest(self):
+        return self.digest().hex()
+
+
+class Sha256Tree(TreeHash):
+    """ Merkle tree over sha256 (RFC 6962 layout), kept as a stack of complete subtrees """
+    name = 'sha256tree'
+    digest_size = 32
+
+    def __init__(self):
+        super().__init__()
+        self.stack = []  # (leaf count, node digest), subtree sizes strictly decreasing
+
+    @staticmethod
+    def _hash_leaf(index, leaf, last):
+        leaf_digest = hashlib.sha256(b'\x00')
+        leaf_digest.update(leaf)
+        return leaf_digest.digest()
+
+    @staticmethod
+    def _node(left, right):
+        return hashlib.sha256(b'\x01' + left + right).digest()
+
+    def _add_leaf(self, leaf_digest):
+        node = (1, leaf_digest)
+        while self.stack and self.stack[-1][0] == node[0]:
+            (count, left) = self.stack.pop()
+            node = (count * 2, self._node(left, node[1]))
+        self.stack.append(node)
+
+    def _root(self):
+        root = self.stack[-1][1]
+        for (_, left) in reversed(self.stack[:-1]):
+            root = self._node(left, root)
+        return root
+
+
+class Blake2bTree(TreeHash):
+    """ BLAKE2b tree mode: depth 2, unlimited fanout, TREE_LEAF_SIZE leaves """
+    name = 'blake2btree'
+    digest_size = 64
+    hold_last = True
+
+    def __init__(self):
+        super().__init__()
+        self.root = hashlib.blake2b(**self._params(0, 1, True))
+
+    @staticmethod
+    def _params(node_offset, node_depth, last_node):
+        return {
+            'digest_size': Blake2bTree.digest_size,
+            'fanout': 0,
+            'depth': 2,
+            'leaf_size': TREE_LEAF_SIZE,
+            'inner_size': Blake2bTree.digest_size,
+            'node_offset': node_offset,
+            'node_depth': node_depth,
+            'last_node': last_node,
+        }
+
+    @staticmethod
+    def _hash_leaf(index, leaf, last):
+        leaf_digest = hashlib.blake2b(**Blake2bTree._params(index, 0, last))
+        leaf_digest.update(leaf)
+        return leaf_digest.digest()
+
+    def _add_leaf(self, leaf_digest):
+        self.root.update(leaf_digest)
+
+    def _root(self):
+        return self.root.digest()
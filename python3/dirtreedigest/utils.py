@@ -16,19 +16,38 @@
 
 """
 
+import cProfile
+import gc
+import io
 import logging
+import multiprocessing.util
 import os
 import re
 import sys
 import time
 
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import contextmanager
 from datetime import datetime
-from enum import Enum
-from os.path import basename, dirname
+from enum import IntEnum
+from os.path import dirname
+
+import dirtreedigest.thdx as dtthdx
 
 # Enums to communicate with subprocesses
-Cmd = Enum('Cmd', 'INIT PROCESS FREE RESULT QUIT')
+# Queue messages are fixed-layout tuples led by a Cmd value (sent as a plain int so it pickles compactly):
+#   parent -> reader:   (INIT, file_id, element, block_size), (QUIT,)
+#   reader -> worker:   (INIT, file_id), (PROCESS, buf_index, block_size, buf_block), (RESULT,)
+#                       where buf_block is the data, or with shared memory the buffer's segment name
+#                       (buf_index is None for a hole's zeros, which aren't released)
+#   parent -> worker:   (QUIT,)
+#   worker -> parent:   (RESULT, file_id, digest_index, digest_value, hash_secs)
+#   reader -> parent:   (DONE, file_id, error, bytes_read, bytes_copied, read_secs, hole_bytes)
+#   either -> parent:   (QUIT, proc_stats)
+Cmd = IntEnum('Cmd', 'INIT PROCESS RESULT DONE QUIT')
+
+# Upper bound for any single blocking queue wait (keeps Ctrl+C responsive)
+QUEUE_WAIT_SECS = 1.0
 
 
 def shared_memory_available():
@@ -61,6 +80,15 @@ def unixify_path(path):
     return path.replace('\\', '/')
 
 
+def parse_size(value, unit=1024 * 1024):
+    """ Bytes in a size such as '16' (in units), '512K' or '4M'; for argparse, so raises ValueError """
+    value = value.strip().upper()
+    multiplier = {'K': 1024, 'M': 1024 * 1024}.get(value[-1:])
+    if multiplier:
+        value = value[:-1]
+    return int(float(value) * (multiplier or unit))
+
+
 def compile_patterns(patterns, ignorecase=False):
     """ Compile exclusion patterns to regular expressions """
     re_pats = []
@@ -83,6 +111,14 @@ def elem_is_matched(root, elem, patterns):
     return False
 
 
+def name_is_matched(name, patterns):
+    """ Check if a bare element name matches any of the exclusion patterns """
+    for re_pat in patterns:
+        if re_pat.match(name):
+            return True
+    return False
+
+
 def split_net_drive(elem):
     """ For network shares, split network and path parts """
     mval = re.match(r"^(//[^/]+)(.*)$", elem)
@@ -134,6 +170,107 @@ def curr_time_secs():
     return time.perf_counter()
 
 
+def cpu_time_secs():
+    """ Get CPU time consumed by the current process """
+    return time.process_time()
+
+
+def cpu_stats(start_wall, start_cpu):
+    """ Busy-vs-idle accounting for the current process since the given start times """
+    wall_time = curr_time_secs() - start_wall
+    cpu_time = cpu_time_secs() - start_cpu
+    return {
+        'wall_time': wall_time,
+        'cpu_time': cpu_time,
+        'busy_pct': 100.0 * cpu_time / wall_time if wall_time > 0 else 0.0,
+    }
+
+
+def add_stage_time(stage_times, stage, secs, count=1):
+    """ Tally time spent in a stage; stage_times maps each stage to [seconds, count] """
+    entry = stage_times.get(stage)
+    if entry is None:
+        stage_times[stage] = [secs, count]
+    else:
+        entry[0] += secs
+        entry[1] += count
+
+
+def merge_stage_times(stage_times, other):
+    """ Add another process's (or thread's) stage times into stage_times """
+    for (stage, (secs, count)) in (other or {}).items():
+        add_stage_time(stage_times, stage, secs, count)
+
+
+def stage_table(stage_times, wall_time=None):
+    """ Lines of a table of stage times, most time first
+        Stages in different processes overlap, so shares of wall_time may add up past 100%
+    """
+    lines = ['{:<16} {:>10} {:>10} {:>10}{}'.format(
+        'stage', 'seconds', 'count', 'us/each', ' {:>7}'.format('%wall') if wall_time else '')]
+    for (stage, (secs, count)) in sorted(stage_times.items(), key=lambda item: (-item[1][0], item[0])):
+        lines.append('{:<16} {:>10.3f} {:>10d} {:>10.1f}{}'.format(
+            stage, secs, count, 1000000.0 * secs / count if count else 0.0,
+            ' {:>6.1f}%'.format(100.0 * secs / wall_time) if wall_time else ''))
+    return lines
+
+
+def parse_stage_table(stage_lines):
+    """ The stage times in the lines of a stage_table(), as {stage: [seconds, count]} """
+    stage_times = {}
+    for line in stage_lines[1:]:
+        fields = line.split()
+        try:
+            stage_times[fields[0]] = [float(fields[1]), int(fields[2])]
+        except (IndexError, ValueError):
+            continue
+    return stage_times
+
+
+def profile_name(prefix, proc_name):
+    """ Where a process's profile goes ('---Worker-0' -> PREFIX.worker-0.prof), or None when not profiling """
+    if not prefix:
+        return None
+    return '{}.{}.prof'.format(prefix, proc_name.strip('-').lower())
+
+
+def run_profiled(filename, func, *args):
+    """ Run func(*args), under cProfile with its stats dumped to filename if one is given
+        Only the calling thread is profiled
+    """
+    if not filename:
+        return func(*args)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args)
+    finally:
+        profiler.dump_stats(filename)
+
+
+def start_pool_profiling(prefix):
+    """ ProcessPoolExecutor initializer: profile the pool process until it exits """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    filename = profile_name(prefix, f'pool-{os.getpid()}')
+    # Pool processes skip atexit, but do run multiprocessing's finalizers
+    multiprocessing.util.Finalize(None, _stop_profiling, args=(profiler, filename), exitpriority=10)
+
+
+def _stop_profiling(profiler, filename):
+    profiler.disable()
+    profiler.dump_stats(filename)
+
+
+def peak_rss_bytes():
+    """ Peak resident set size of the current process (None where it isn't available) """
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # Elsewhere it's in KB
+
+
 def flush_debug_queue(debug_queue, logger):
     """ Flush the debug message queue """
     while not debug_queue.empty():
@@ -165,86 +302,332 @@ def outfile_write(fname, fmode, lines):
             fileh.write('{}\n'.format(line))
 
 
-def read_dtd_report(filename, logger):
-    element_pat = re.compile(
-        r"^(.+?);{(.+?)};(.+?);(.+?);(.+?);(.+?);(.+?);(.+?);(.*)$")
-    legacy_pat = re.compile(
-        r"^(.+?);(.+?);(.+?);(.+?);(.+?);(.+?);(.*)$")
-    basepath_pat = re.compile(
-        r"^#\s+Base path:\s+(.*)$")
-    comment_pat = re.compile(
-        r"^\s*#\s*(.*)\s*$")
+# Text reports below this size are always parsed in-process
+PARSE_CHUNK_MIN_SIZE = 4 * 1024 * 1024
+
+# Footers are looked for in this much of the end of a text report
+FOOTER_TAIL_SIZE = 64 * 1024
+
+
+def read_dtd_report(filename, logger, processes=0):
+    """ Read a whole report: returns (basepath, elements)
+        With processes, a large text report is parsed in chunks by that many processes
+    """
+    header = {'basepath': ''}
     elements = []
-    basepath = ''
-    logger.info(f"READ  : {filename}")
+    gc_enabled = gc.isenabled()
+    gc.disable()  # Nothing built here is cyclic; collecting as the list grows only costs time
+    try:
+        for elem in iter_dtd_report(filename, logger, header, processes=processes):
+            elem['id'] = len(elements)
+            elements.append(elem)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return (header['basepath'], elements)
+
+
+def iter_dtd_report(filename, logger, header=None, all_types=False, processes=0):
+    """ Yield a report's D and F elements (or all of them) one at a time, in file order
+        Reads text and binary reports alike; the base path, summary line and
+        tree digests are stored in header (if given) once they've been read
+    """
+    if dtthdx.is_thdx(filename):
+        logger.info(f"READ  : {filename}")
+        elements = _iter_thdx_report(filename, header)
+    elif processes and os.path.getsize(filename) >= PARSE_CHUNK_MIN_SIZE:
+        logger.info(f"READ  : {filename} ({processes} processes)")
+        elements = _read_thd_report_chunked(filename, logger, header, processes)
+    else:
+        logger.info(f"READ  : {filename}")
+        elements = _iter_thd_report(filename, logger, header)
+    for elem in elements:
+        if all_types or elem['type'] in ['D', 'F']:
+            yield elem
+        else:
+            logger.warning(f"Ignoring file type '{elem['type']}' for {elem['full_name']}")
+
+
+def read_report_footer(filename):
+    """ A report's summary line and tree digests, read from its end
+        Returns {'summary': ..., 'tree_digests': ...}, with None for anything not found
+    """
+    header = {'summary': None, 'tree_digests': None}
+    if dtthdx.is_thdx(filename):
+        report = dtthdx.ThdxReport(filename)
+        (header['summary'], header['tree_digests']) = (report.summary, report.tree_digests)
+        report.close()
+        return header
+    with open(filename, 'rb') as fileh:
+        start = max(0, fileh.seek(0, os.SEEK_END) - FOOTER_TAIL_SIZE)
+        fileh.seek(start)
+        lines = fileh.read().decode('utf-8', errors='replace').splitlines()
+    if start:
+        lines = lines[1:]  # Partial
+    found = {}
+    comments = (line for line in lines if line.lstrip().startswith('#'))
+    for _ in parse_thd_lines(comments, lambda level, message: None, found):
+        pass
+    return {key: found.get(key) for key in header}
+
+
+def _iter_thdx_report(filename, header):
+    """ Yield all elements of a binary report from a memory mapping """
+    report = dtthdx.ThdxReport(filename)
+    try:
+        if header is not None:
+            header['basepath'] = report.basepath
+            header['summary'] = report.summary
+            header['tree_digests'] = report.tree_digests
+            header['stage_times'] = report.stage_times
+            header['stage_lines'] = report.stage_lines
+        yield from report.iter_elements()
+    finally:
+        report.close()
+
+
+def _iter_thd_report(filename, logger, header):
+    """ Yield all elements of a text report """
+    with open(filename, 'r', encoding='utf-8') as fileh:
+        yield from parse_thd_lines(fileh, logger.log, header)
+
+
+class DigestLayouts(object):
+    """ Parses digest blobs like '{md5: ..., sha1: ...}', once per distinct layout
+
+        Every line of a report normally has the same digests with the same
+        value lengths, so after the first one a blob only has to be checked
+        against the known layout (its length and the text between values)
+        and sliced.
+    """
+
+    def __init__(self):
+        self.layouts = {}  # Blob length: [(separators, slices)]
+
+    def parse(self, blob):
+        """ Returns {digest_name: digest_value} """
+        for (separators, slices) in self.layouts.get(len(blob), []):
+            if all(blob.startswith(separator, pos) for (pos, separator) in separators):
+                return {digest_name: blob[start:end] for (digest_name, start, end) in slices}
+        return self._learn(blob)
+
+    def _learn(self, blob):
+        """ Parse a blob the slow way and remember its layout """
+        digests = {}
+        separators = []
+        slices = []
+        (pos, prev_end) = (1, 0)
+        for digestpair in blob[1:-1].split(','):
+            (digest, val) = digestpair.split(':')
+            digest_name = digest.strip()
+            digest_value = val.strip()
+            digests[digest_name] = digest_value
+            start = pos + len(digest) + 1 + len(val) - len(val.lstrip())
+            separators.append((prev_end, blob[prev_end:start]))
+            slices.append((digest_name, start, start + len(digest_value)))
+            prev_end = start + len(digest_value)
+            pos += len(digestpair) + 1
+        separators.append((prev_end, blob[prev_end:]))
+        if len(slices) == len(digests) and all(end > start for (_, start, end) in slices):
+            self.layouts.setdefault(len(blob), []).append((separators, slices))
+        return digests
+
+
+def parse_thd_lines(lines, log, header=None, is_legacy=None):
+    """ Yield all elements from lines of a text report
+
+        Fields are split on ';' with a bounded count, so names may contain
+        ';'. Digest blobs are parsed once per distinct layout and directory
+        names are shared between elements. log(level, message) reports
+        problems; is_legacy may be given to skip format detection.
+    """
+    layouts = DigestLayouts()
+    dir_names = {}
+    mixed_nonce = True
+    stage_lines = None  # While in the footer's stage table
+    for line in lines:
+        line = line.rstrip('\n').lstrip()
+        if not line:
+            continue
+        if line[0] == '#':
+            comment = line[1:].lstrip()
+            if stage_lines is not None:
+                if comment:
+                    stage_lines.append(comment)
+                    continue
+                stage_lines = None
+            if comment.startswith('Base path:'):
+                basepath = comment[len('Base path:'):].lstrip()
+                if header is not None:
+                    header['basepath'] = basepath
+                log(logging.DEBUG, f"Basepath: {basepath}")
+            elif comment.startswith('Processed:'):
+                if header is not None:
+                    header['summary'] = comment
+            elif comment.startswith('Tree digests:'):
+                if header is not None:
+                    header['tree_digests'] = layouts.parse(comment[len('Tree digests:'):].lstrip())
+            elif comment == 'Stage times:':
+                stage_lines = []
+                if header is not None:
+                    header['stage_lines'] = stage_lines
+            elif comment:
+                log(logging.DEBUG, f"Comments: {comment}")
+            continue
+        fields = line.split(';', 8)
+        if len(fields) == 9 and fields[1][:1] == '{' and fields[1][-1:] == '}':
+            if is_legacy is None:
+                is_legacy = False
+            elif is_legacy:
+                if mixed_nonce:
+                    log(logging.WARNING, "Legacy format; skipping new formatted lines")
+                    mixed_nonce = False
+                continue
+            (elem_type, blob, atime, mtime, ctime, attr_std, attr_win, size, full_name) = fields
+            digests = layouts.parse(blob)
+        else:  # Legacy
+            fields = line.split(';', 6)
+            if len(fields) != 7:
+                continue
+            if is_legacy is None:
+                is_legacy = True
+            elif not is_legacy:
+                if mixed_nonce:
+                    log(logging.WARNING, "New format; skipping legacy formatted lines")
+                    mixed_nonce = False
+                continue
+            (md5, atime, mtime, ctime, attr_win, size, full_name) = fields
+            digests = {'md5': md5}
+            attr_std = '0000'
+            elem_type = 'F'
+            if md5.startswith('?'):
+                elem_type = '?'
+            elif md5.startswith('-'):
+                elem_type = 'D'
+        (dir_name, _, file_name) = full_name.rpartition('/')
+        if dir_name.endswith('/') or not dir_name and full_name.startswith('/'):
+            dir_name = dirname(full_name)  # Keep the root's slashes, as dirname() does
+        dir_name = dir_names.setdefault(dir_name, dir_name)
+        yield {
+            'digests': digests,
+            'type': elem_type,
+            'atime': atime,
+            'mtime': mtime,
+            'ctime': ctime,
+            'attr_std': attr_std,
+            'attr_win': attr_win,
+            'size': size,
+            'full_name': full_name,
+            'dir_name': dir_name,
+            'file_name': file_name,
+        }
+
+
+def _read_thd_report_chunked(filename, logger, header, processes):
+    """ Parse a text report in line-aligned chunks on a process pool """
+    file_size = os.path.getsize(filename)
+    bounds = [0]
+    with open(filename, 'rb') as fileh:
+        for i in range(1, processes):
+            fileh.seek(max(file_size * i // processes, bounds[-1]))
+            fileh.readline()  # Finish the line the split landed in
+            bounds.append(min(fileh.tell(), file_size))
+    bounds.append(file_size)
+    is_legacy = _thd_is_legacy(filename)  # Every chunk uses the format of the first element line
+    chunks = [(start, end) for (start, end) in zip(bounds, bounds[1:]) if end > start]
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        results = pool.map(
+            _parse_thd_chunk,
+            [filename] * len(chunks),
+            [start for (start, _) in chunks],
+            [end for (_, end) in chunks],
+            [is_legacy] * len(chunks))
+        for (elements, chunk_header, messages) in results:
+            for (level, message) in messages:
+                logger.log(level, message)
+            if header is not None:
+                header.update(chunk_header)
+            yield from elements
+
+
+def _thd_is_legacy(filename):
+    """ Whether a text report's first element line is in the legacy format (None if there are none) """
     with open(filename, 'r', encoding='utf-8') as fileh:
-        IS_LEGACY = None
-        MIXED_NONCE = True
         for line in fileh:
             line = line.rstrip('\n').lstrip()
-            if not line:
+            if not line or line[0] == '#':
                 continue
-            elem = {}
-            mval = element_pat.match(line)
-            if mval:
-                if IS_LEGACY is None:
-                    IS_LEGACY = False
-                elif IS_LEGACY is True and MIXED_NONCE:
-                    logger.warning("Legacy format; skipping new formatted lines")
-                    MIXED_NONCE = False
-                    continue
-                elem['digests'] = {}
-                for digestpair in mval[2].split(','):
-                    (digest, val) = digestpair.strip().split(':')
-                    elem['digests'][digest.strip()] = val.strip()
-                elem['type'] = mval[1]
-                elem['atime'] = mval[3]
-                elem['mtime'] = mval[4]
-                elem['ctime'] = mval[5]
-                elem['attr_std'] = mval[6]
-                elem['attr_win'] = mval[7]
-                elem['size'] = mval[8]
-                elem['full_name'] = mval[9]
-                elem['dir_name'] = dirname(elem['full_name'])
-                elem['file_name'] = basename(elem['full_name'])
-            else:  # Legacy
-                mval = legacy_pat.match(line)
-                if mval:
-                    if IS_LEGACY is None:
-                        IS_LEGACY = True
-                    elif IS_LEGACY is False and MIXED_NONCE:
-                        logger.warning("New format; skipping legacy formatted lines")
-                        MIXED_NONCE = False
-                        continue
-                    elem['digests'] = {}
-                    elem['digests']['md5'] = mval[1]
-                    elem['type'] = 'F'
-                    if elem['digests']['md5'].startswith('?'):
-                        elem['type'] = '?'
-                    elif elem['digests']['md5'].startswith('-'):
-                        elem['type'] = 'D'
-                    elem['atime'] = mval[2]
-                    elem['mtime'] = mval[3]
-                    elem['ctime'] = mval[4]
-                    elem['attr_std'] = '0000'
-                    elem['attr_win'] = mval[5]
-                    elem['size'] = mval[6]
-                    elem['full_name'] = mval[7]
-                    elem['dir_name'] = dirname(elem['full_name'])
-                    elem['file_name'] = basename(elem['full_name'])
-                else:
-                    mval = basepath_pat.match(line)
-                    if mval:
-                        basepath = mval[1]
-                        logger.debug(f"Basepath: {(mval[1])}")
-                    else:
-                        mval = comment_pat.match(line)
-                        if mval:
-                            logger.debug(f"Comments: {(mval[1])}")
-            if elem:
-                if elem['type'] not in ['D', 'F']:
-                    logger.warning(f"Ignoring file type '{elem['type']}' for {elem['full_name']}")
-                else:
-                    elem['id'] = len(elements)
-                    elements.append(elem)
-    return (basepath, elements)
+            fields = line.split(';', 8)
+            if len(fields) == 9 and fields[1][:1] == '{' and fields[1][-1:] == '}':
+                return False
+            if len(line.split(';', 6)) == 7:
+                return True
+    return None
+
+
+def _parse_thd_chunk(filename, start, end, is_legacy):
+    """ Parse the lines of a text report between two byte offsets
+        Runs in a pool process, so it reports back rather than logging:
+        returns (elements, header, messages)
+    """
+    with open(filename, 'rb') as fileh:
+        fileh.seek(start)
+        data = fileh.read(end - start)
+    header = {}
+    messages = []
+    lines = io.TextIOWrapper(io.BytesIO(data), encoding='utf-8')
+    gc.disable()  # A pool process; see read_dtd_report
+    elements = list(parse_thd_lines(lines, lambda level, message: messages.append((level, message)), header, is_legacy))
+    return (elements, header, messages)
+
+
+def path_sort_key(relname):
+    """ Walk order: names are visited sorted within each directory, each directory before its contents """
+    return tuple(relname.split('/'))
+
+
+class ReportCursor(object):
+    """ Steps through a report in lockstep with the directory walk (a streaming merge-join)
+
+        The report is expected in walk order, so looking up each walked
+        element in turn only ever moves forward through it, and just one
+        element is held at a time. Elements that break the order can't be
+        joined and are skipped.
+    """
+
+    def __init__(self, elements, logger):
+        self.logger = logger
+        self.elements = elements
+        self.current = None
+        self.current_key = None
+        self.skipped = 0
+        self._advance()
+
+    def seek(self, relname):
+        """ Return the report's element named relname, or None if it has none
+            Calls must be made in walk order
+        """
+        key = path_sort_key(relname)
+        while self.current is not None and self.current_key < key:
+            self._advance()
+        if self.current is not None and self.current_key == key:
+            return self.current
+        return None
+
+    def close(self):
+        """ Stop reading the report """
+        if self.skipped:
+            self.logger.warning('Skipped %d out-of-order element(s) in the update file', self.skipped)
+        self.elements.close()
+        self.current = None
+
+    def _advance(self):
+        """ Move to the next element that's in order """
+        for elem in self.elements:
+            key = path_sort_key(elem['full_name'])
+            if self.current_key is not None and key <= self.current_key:
+                self.skipped += 1
+                continue
+            (self.current, self.current_key) = (elem, key)
+            return
+        self.current = None
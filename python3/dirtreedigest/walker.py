@@ -16,22 +16,32 @@
 
 """
 
+import collections
 import ctypes
+import functools
 import logging
 import multiprocessing
 import os
+import queue
+import sqlite3
 import stat
 import sys
 
+from concurrent.futures import ThreadPoolExecutor
+
+import dirtreedigest.cache as dtcache
 import dirtreedigest.digester as dtdigester
+import dirtreedigest.progress as dtprogress
 import dirtreedigest.reader as dtreader
+import dirtreedigest.thdx as dtthdx
 import dirtreedigest.utils as dtutils
 import dirtreedigest.worker as dtworker
+import dirtreedigest.writer as dtwriter
 
-if dtutils.shared_memory_available():
-    from multiprocessing import shared_memory  # Python 3.8+
+if dtutils.shared_memory_available() and os.name == 'posix':
+    from multiprocessing import resource_tracker  # Python 3.8+, where segments need unlinking
 else:
-    shared_memory = None
+    resource_tracker = None
 
 
 # pylint: disable=bad-whitespace
@@ -63,10 +73,28 @@ class Walker(object):
 
     def __init__(self):
         self.logger = logging.getLogger('walker')
+        self.pending = collections.deque()
+        self.inflight = 0
+        self.scan_pool = None
+        self.scans = {}
+        self.dir_stack = None
+        self.failed_dirs = set()
+        self.debug = self.logger.isEnabledFor(logging.DEBUG)
+        self.walking_level = logging.INFO
 
     def _init_misc(self, control_data):
         """ Initialize items """
         control_data['debug_queue'] = multiprocessing.Queue()
+        control_data['results_queue'] = multiprocessing.Queue()
+        control_data['proc_stats'] = []
+        control_data['stage_times'] = {}
+        control_data['subproc_log_level'] = min(control_data['logfile_level'], control_data['console_level'])
+        control_data['walk_stats'] = {
+            'dirs': 0,
+            'entries': 0,
+            'stat_calls': 0,
+            'stat_time': 0.0,
+        }
         control_data['ignored_file_pats'] = dtutils.compile_patterns(
             control_data['ignored_files'],
             control_data['ignore_path_case'],
@@ -77,27 +105,16 @@ class Walker(object):
         )
 
     def _start_shared_memory(self, control_data):
-        """ Initialize shared memory """
-        control_data['buffer_blocks'] = []
-        control_data['buffer_sizes'] = []
-        control_data['buffer_names'] = []
-        for _ in range(control_data['max_buffers']):
-            if control_data['shm_mode']:
-                buf = shared_memory.SharedMemory(create=True, size=control_data['max_block_size'])
-                buffer_name = buf.name
-                control_data['buffer_blocks'].append(buf)
-                control_data['buffer_names'].append(buffer_name)
-            else:
-                control_data['buffer_blocks'].append([None])
-            control_data['buffer_sizes'].append(0)
-
-    def _end_shared_memory(self, control_data):
-        """ Clean up shared memory """
+        """ Initialize shared memory
+            The reader creates (and sizes) the buffers themselves as it needs them
+        """
+        control_data['buffer_sems'] = []
         if control_data['shm_mode']:
-            for i in range(control_data['max_buffers']):
-                shm_buf = shared_memory.SharedMemory(name=control_data['buffer_names'][i])
-                shm_buf.close()
-                shm_buf.unlink()
+            if resource_tracker:
+                # Started before the subprocesses, so the segments they make and map are all tracked in one place
+                resource_tracker.ensure_running()
+            for _ in range(control_data['max_buffers']):
+                control_data['buffer_sems'].append(multiprocessing.Semaphore(0))
 
     def _start_reader(self, control_data):
         """ Start long-running worker processes
@@ -105,34 +122,64 @@ class Walker(object):
         """
         control_data['reader_proc'] = None
         control_data['reader_cmd_queue'] = multiprocessing.Queue()
-        control_data['reader_results_queue'] = multiprocessing.Queue()
-        reader_proc = multiprocessing.Process(
-            target=dtreader.reader_process,
-            args=(
+        reader_proc = self._new_process(
+            control_data,
+            '---Reader',
+            dtreader.reader_process,
+            (
                 control_data['debug_queue'],
                 control_data['reader_cmd_queue'],
-                control_data['reader_results_queue'],
+                control_data['results_queue'],
+                control_data['worker_cmd_queues'],
+                control_data['buffer_sems'],
                 control_data['shm_mode'],
-                control_data['max_block_size'],
+                control_data['buffer_memory'],
+                control_data['min_block_size'],
+                control_data['mmap_mode'],
+                control_data['low_impact'],
+                control_data['subproc_log_level'],
             ),
         )
-        reader_proc.name = '---Reader'
         reader_proc.start()
+        control_data['reader_proc'] = reader_proc
 
     def _end_reader(self, control_data):
         """ End reader subprocess """
-        control_data['reader_cmd_queue'].put({
-            'cmd': dtutils.Cmd.QUIT,
-        })
-        import time
-        time.sleep(0.5)  # Because reasons
-        while not control_data['reader_results_queue'].empty():
-            retval = control_data['reader_results_queue'].get()
-            self.logger.debug('Draining queue: %s', retval)
+        control_data['reader_cmd_queue'].put((dtutils.Cmd.QUIT.value,))
+        self._collect_proc_stats(
+            control_data,
+            control_data['results_queue'],
+            [control_data['reader_proc']],
+        )
         dtutils.flush_debug_queue(control_data['debug_queue'], logging.getLogger('reader'))
-        while control_data['reader_proc']:
-            if control_data['reader_proc'] and not control_data['reader_proc'].is_alive():
-                control_data['reader_proc'] = None
+        control_data['reader_proc'].join()
+        control_data['reader_proc'] = None
+
+    def _collect_proc_stats(self, control_data, results_queue, procs):
+        """ Drain a results queue until each quitting subprocess has reported its stats
+            Gives up early if the subprocesses have already exited (e.g., after Ctrl+C)
+        """
+        pending = len(procs)
+        while pending > 0:
+            try:
+                retval = results_queue.get(timeout=dtutils.QUEUE_WAIT_SECS)
+            except queue.Empty:
+                if not any(proc.is_alive() for proc in procs):
+                    break
+                continue
+            if retval[0] == dtutils.Cmd.QUIT:
+                control_data['proc_stats'].append(retval[1])
+                dtutils.merge_stage_times(control_data['stage_times'], retval[1].get('stage_times'))
+                pending -= 1
+            else:
+                self.logger.debug('Draining queue: %s', retval)
+
+    def _new_process(self, control_data, name, target, args):
+        """ A subprocess that will run target(*args), under cProfile when profiling """
+        filename = dtutils.profile_name(control_data['profile_prefix'], name)
+        if filename:
+            (target, args) = (dtutils.run_profiled, (filename, target) + args)
+        return multiprocessing.Process(target=target, args=args, name=name)
 
     def _start_workers(self, control_data):
         """ Start long-running worker processes
@@ -140,55 +187,156 @@ class Walker(object):
         """
         control_data['worker_procs'] = []
         control_data['worker_cmd_queues'] = []
-        control_data['worker_results_queue'] = multiprocessing.Queue()
-        for i in range(len(control_data['selected_digests'])):
+        selected_digests = control_data['selected_digests']
+        worker_digests = control_data['worker_digests'] or [[digest_name] for digest_name in selected_digests]
+        leaf_threads = max(1, (os.cpu_count() or 1) // len(worker_digests))  # Each worker's share of the cores
+        for (i, digest_names) in enumerate(worker_digests):
             control_data['worker_cmd_queues'].append(multiprocessing.JoinableQueue())
-            worker_proc = multiprocessing.Process(
-                target=dtworker.worker_process,
-                args=(
+            worker_proc = self._new_process(
+                control_data,
+                f'---Worker-{i}',
+                dtworker.worker_process,
+                (
                     control_data['debug_queue'],
                     control_data['worker_cmd_queues'][i],
-                    control_data['worker_results_queue'],
+                    control_data['results_queue'],
+                    control_data['buffer_sems'],
                     control_data['shm_mode'],
+                    [
+                        (selected_digests.index(digest_name), dtdigester.DIGEST_FUNCTIONS[digest_name]['entry'])
+                        for digest_name in digest_names],
+                    control_data['subproc_log_level'],
+                    leaf_threads,
                 ),
             )
-            worker_proc.name = f'---Worker-{i}'
             worker_proc.start()
             control_data['worker_procs'].append(worker_proc)
 
     def _end_workers(self, control_data):
         """ End worker subprocesses """
         for worker_cmd_queue in control_data['worker_cmd_queues']:
-            worker_cmd_queue.put({
-                'cmd': dtutils.Cmd.QUIT,
-            })
-        while not control_data['worker_results_queue'].empty():
-            retval = control_data['worker_results_queue'].get()
-            self.logger.debug('Draining queue: %s', retval)
+            worker_cmd_queue.put((dtutils.Cmd.QUIT.value,))
+        self._collect_proc_stats(
+            control_data,
+            control_data['results_queue'],
+            control_data['worker_procs'],
+        )
         dtutils.flush_debug_queue(control_data['debug_queue'], logging.getLogger('worker'))
-        while any(control_data['worker_procs']):
-            for i in range(len(control_data['selected_digests'])):
-                if (control_data['worker_procs'][i] is not None) and (
-                        not control_data['worker_procs'][i].is_alive()):
-                    self.logger.debug(
-                        'join %d (state = %s) at %f',
-                        i,
-                        control_data['worker_procs'][i].is_alive(),
-                        dtutils.curr_time_secs(),
-                    )
-                    control_data['worker_procs'][i].join()
-                    control_data['worker_procs'][i] = None
+        for i, worker_proc in enumerate(control_data['worker_procs']):
+            worker_proc.join()
+            self.logger.debug('join %d at %f', i, dtutils.curr_time_secs())
+        control_data['worker_procs'] = []
+
+    def _start_writers(self, control_data):
+        """ Open the report(s) for buffered background writing """
+        control_data['report_writer'] = dtwriter.ReportWriter(
+            control_data['outfile_name'],
+            flush_secs=control_data['report_flush_secs'],
+            fsync=control_data['report_fsync'],
+        )
+        control_data['alt_writer'] = None
+        if control_data['altfile_digest']:
+            control_data['alt_writer'] = dtwriter.ReportWriter(
+                control_data['altfile_name'],
+                flush_secs=control_data['report_flush_secs'],
+                fsync=control_data['report_fsync'],
+            )
+        control_data['thdx_writer'] = None
+        if control_data['thdx_name']:
+            control_data['thdx_writer'] = dtthdx.ThdxWriter(
+                control_data['thdx_name'],
+                control_data['root_dir'],
+                {digest_name: dtdigester.DIGEST_FUNCTIONS[digest_name]['len'] // 2
+                 for digest_name in control_data['selected_digests']},
+            )
+
+    def _end_writers(self, control_data):
+        """ Flush and close the report(s) """
+        for (writer_key, stage) in [('report_writer', 'write.thd'), ('alt_writer', 'write.alt')]:
+            if control_data[writer_key]:
+                control_data[writer_key].close()
+                dtutils.add_stage_time(
+                    control_data['stage_times'], stage,
+                    control_data[writer_key].write_time, control_data[writer_key].write_calls)
+                control_data[writer_key] = None
+        if control_data['thdx_writer']:
+            thdx_writer = control_data['thdx_writer']
+            thdx_writer.close(
+                dtwriter.summary_line(control_data['counts']), control_data['tree_digests'],
+                control_data['stage_times'])
+            # Only the text reports' footers get this (and the last row group)
+            dtutils.add_stage_time(
+                control_data['stage_times'], 'write.thdx', thdx_writer.write_time, thdx_writer.write_calls)
+            control_data['thdx_writer'] = None
+
+    def _start_progress(self, control_data):
+        """ Start reporting progress, estimating the totals from a pre-scan or the update baseline """
+        control_data['progress'] = None
+        if not control_data['progress_secs']:
+            return
+        estimate = None
+        if control_data['progress_prescan']:
+            estimate = functools.partial(
+                dtprogress.prescan_totals,
+                control_data['root_dir'],
+                control_data['ignored_dir_pats'],
+                control_data['ignored_file_pats'],
+            )
+        elif control_data['update_file']:
+            estimate = functools.partial(dtprogress.report_totals, control_data['update_file'])
+        control_data['progress'] = dtprogress.ProgressReporter(
+            control_data['progress_secs'], control_data['progress_format'], estimate)
+        control_data['progress'].start()
+        self.walking_level = logging.DEBUG  # The status says as much, and doesn't scroll the console
+
+    def _end_progress(self, control_data):
+        """ Stop reporting progress, after a final report """
+        if control_data['progress']:
+            control_data['progress'].stop()
+            control_data['progress'] = None
 
     def initialize(self, control_data):
         self._init_misc(control_data)
+        self._start_writers(control_data)
+        self._start_progress(control_data)
+        control_data['digest_cache'] = None
+        if control_data['cache_file']:
+            try:
+                control_data['digest_cache'] = dtcache.DigestCache(
+                    control_data['cache_file'],
+                    control_data['cache_max_age_days'] * 24 * 60 * 60,
+                    control_data['cache_max_size_mb'] * 1024 * 1024,
+                )
+            except (OSError, sqlite3.Error) as err:
+                self.logger.warning('Not using digest cache "%s": %s', control_data['cache_file'], err)
+        control_data['file_pool'] = None
+        if control_data['file_pool_size']:
+            control_data['file_pool'] = dtdigester.FilePoolDigester(control_data)
+        if control_data['engine'] == 'threads':
+            control_data['digest_engine'] = dtdigester.ThreadedDigester(control_data)
+            return
         self._start_shared_memory(control_data)
+        self._start_workers(control_data)  # The reader feeds the workers' queues directly
         self._start_reader(control_data)
-        self._start_workers(control_data)
+        control_data['digest_engine'] = dtdigester.DigestPipeline(control_data)
 
     def teardown(self, control_data):
-        self._end_shared_memory(control_data)
-        self._end_reader(control_data)
-        self._end_workers(control_data)
+        self._end_progress(control_data)
+        # The engines go first, so that their stage times make it into the reports
+        if control_data['file_pool']:
+            control_data['file_pool'].shutdown()
+        if control_data['engine'] == 'threads':
+            control_data['digest_engine'].shutdown()
+        else:
+            self._end_reader(control_data)
+            self._end_workers(control_data)
+        self._end_writers(control_data)
+        if control_data['update_report']:
+            control_data['update_report'].close()
+            control_data['update_report'] = None
+        if control_data['digest_cache']:
+            control_data['digest_cache'].close()
+            control_data['digest_cache'] = None
 
     def get_win_filemode(self, elem):
         """ Windows: get system-specific file stats """
@@ -200,76 +348,205 @@ class Walker(object):
             self.get_win_filemode(elem) & self.FILE_ATTRIBUTE_REPARSE_POINT)
 
     def process_tree(self, control_data):
-        """ Process the given directory tree """
+        """ Process the given directory tree
+
+            Each directory's line is written with placeholder digests and
+            patched once everything under it is done (see _roll_up).
+        """
         results = []
-        self._walk_tree(
-            control_data=control_data,
-            root_dir=control_data['root_dir'],
-            callback=self.visit_element,
-            results=results)
+        self.dir_stack = [('', 'D', dtdigester.DirDigester(control_data['selected_digests']), None)]
+        if control_data['walk_threads']:
+            self.scan_pool = ThreadPoolExecutor(
+                max_workers=control_data['walk_threads'], thread_name_prefix='scanner')
+        try:
+            self._walk_tree(
+                control_data=control_data,
+                root_dir=control_data['root_dir'],
+                root_rel='',
+                callback=self._queue_element,
+                results=results)
+        finally:
+            for future in self.scans.values():
+                future.cancel()
+            self.scans = {}
+            if self.scan_pool:
+                self.scan_pool.shutdown()
+                self.scan_pool = None
+        self._complete_elements(control_data, results, 0)
+        while len(self.dir_stack) > 1:
+            self._close_dir(control_data)
+        root_digester = self.dir_stack.pop()[2]
+        if '' in self.failed_dirs:
+            root_digester.add('!', '')
+        control_data['tree_digests'] = root_digester.hexdigests()
+        self.dir_stack = None
         return results
 
-    def _walk_tree(self, control_data, root_dir, callback, results):
-        """ Re-entrant directory tree walker """
+    def _roll_up(self, control_data, elem_data, fill_char, thdx_row):
+        """ Add a finished element to its directory's rollup, closing any directories left behind
+
+            Elements arrive in walk order, so every open directory that isn't
+            this element's parent is complete.
+        """
+        (parent, _, name) = elem_data['name'].rpartition('/')
+        while len(self.dir_stack) > 1 and self.dir_stack[-1][0] != parent:
+            self._close_dir(control_data)
+        if elem_data['type'] in ['D', 'J']:
+            self.dir_stack.append((
+                elem_data['name'], elem_data['type'],
+                dtdigester.DirDigester(control_data['selected_digests']), thdx_row))
+        else:
+            self.dir_stack[-1][2].add(elem_data['type'], name, elem_data['digests'], fill_char or '?')
+
+    def _close_dir(self, control_data):
+        """ Finish the innermost open directory: patch in its digests and add it to its parent """
+        (relname, elem_type, dir_digester, thdx_row) = self.dir_stack.pop()
+        if relname in self.failed_dirs:
+            self.failed_dirs.remove(relname)
+            dir_digester.add('!', '')  # Unreadable, which isn't the same as empty
+        digests = dir_digester.hexdigests()
+        if elem_type == 'D':  # Junctions keep their 'x' placeholders
+            control_data['report_writer'].patch(relname, 2, dtdigester.digest_str(digests))  # Just after 'D;'
+            if control_data['thdx_writer']:
+                control_data['thdx_writer'].patch_digests(thdx_row, digests)
+        self.dir_stack[-1][2].add(elem_type, relname.rpartition('/')[2], digests)
+
+    def _scan_dir(self, dir_path):
+        """ List a directory and lstat its entries, sorted by name
+            Runs on the scan pool, so it only reports back:
+            returns (entries, missing, error, stat_time, list_time)
+        """
+        list_start = dtutils.curr_time_secs()
         try:
-            dir_list = os.listdir(root_dir)
-        except FileNotFoundError:
-            self.logger.warning('FileNotFoundError %s', root_dir)
-            control_data['counts']['errors'] += 1
-            return
-        except NotADirectoryError:
-            self.logger.warning('NotADirectoryError %s', root_dir)
-            control_data['counts']['errors'] += 1
-            return
-        except PermissionError:
-            self.logger.warning('PermissionError %s', root_dir)
-            control_data['counts']['errors'] += 1
-            return
-        for elem in sorted(dir_list):
-            pathname = dtutils.unixify_path(os.path.join(root_dir, elem))
+            with os.scandir(dir_path) as dir_iter:
+                dir_entries = sorted(dir_iter, key=lambda entry: entry.name)
+        except (FileNotFoundError, NotADirectoryError, PermissionError) as err:
+            return (None, 0, err.__class__.__name__, 0.0, 0.0)
+        entries = []
+        missing = 0
+        start_time = dtutils.curr_time_secs()
+        list_time = start_time - list_start
+        for entry in dir_entries:
             try:
-                stats = os.lstat(pathname)
+                stats = entry.stat(follow_symlinks=False)  # Reuses the DirEntry's stat where the OS provides it
             except FileNotFoundError:
-                self.logger.warning('FileNotFoundError %s', root_dir)
-                control_data['counts']['errors'] += 1
+                missing += 1
                 continue
+            entries.append((entry.name, dtutils.unixify_path(entry.path), stats))
+        return (entries, missing, None, dtutils.curr_time_secs() - start_time, list_time)
+
+    def _request_scan(self, control_data, dir_path):
+        """ Start scanning a directory ahead of the walk, if there is room """
+        if self.scan_pool and len(self.scans) < control_data['walk_prefetch']:
+            self.scans[dir_path] = self.scan_pool.submit(self._scan_dir, dir_path)
+
+    def _get_scan(self, control_data, dir_path):
+        """ Get a directory's scan, doing it now if it wasn't started early """
+        future = self.scans.pop(dir_path, None)
+        scan = future.result() if future else self._scan_dir(dir_path)
+        walk_stats = control_data['walk_stats']
+        walk_stats['dirs'] += 1
+        dtutils.add_stage_time(control_data['stage_times'], 'walk.list', scan[4])
+        if scan[0] is not None:
+            walk_stats['entries'] += len(scan[0])
+            walk_stats['stat_calls'] += len(scan[0]) + scan[1]
+            walk_stats['stat_time'] += scan[3]
+            dtutils.add_stage_time(control_data['stage_times'], 'walk.lstat', scan[3], len(scan[0]) + scan[1])
+        return scan
+
+    def _walk_tree(self, control_data, root_dir, root_rel, callback, results):
+        """ Re-entrant directory tree walker
+
+            Subdirectories are scanned ahead on a thread pool, but elements are
+            always visited in sorted depth-first order.
+        """
+        (entries, missing, error, _, _) = self._get_scan(control_data, root_dir)
+        if error:
+            self.logger.warning('%s %s', error, root_dir)
+            control_data['counts']['errors'] += 1
+            self.failed_dirs.add(root_rel)
+            return
+        for _ in range(missing):
+            self.logger.warning('FileNotFoundError %s', root_dir)
+            control_data['counts']['errors'] += 1
+        queued = []
+        for (elem, pathname, stats) in entries:
+            relname = f'{root_rel}/{elem}' if root_rel else elem
+            ignored = False
+            if stat.S_ISDIR(stats.st_mode):
+                ignored = dtutils.name_is_matched(elem, control_data['ignored_dir_pats'])
+                if not ignored:
+                    self._request_scan(control_data, pathname)
+            elif stat.S_ISREG(stats.st_mode):
+                ignored = dtutils.name_is_matched(elem, control_data['ignored_file_pats'])
+            queued.append((pathname, relname, stats, ignored))
+        for (pathname, relname, stats, ignored) in queued:
             if stat.S_ISDIR(stats.st_mode):
-                if dtutils.elem_is_matched(
-                        root_dir,
-                        pathname,
-                        control_data['ignored_dir_pats']):
+                if ignored:
                     self.logger.info(f'D IGNORED: {pathname}')
                     control_data['counts']['ignored'] += 1
                     continue
                 else:
-                    self.logger.info(f'D WALKING: {pathname}')
-                results.append(self.visit_element(control_data, pathname, stats))
+                    self.logger.log(self.walking_level, f'D WALKING: {pathname}')
+                callback(control_data, pathname, stats, results, relname)
                 self._walk_tree(
                     control_data=control_data,
                     root_dir=pathname,
+                    root_rel=relname,
                     callback=callback,
                     results=results)
             elif stat.S_ISREG(stats.st_mode):
-                if dtutils.elem_is_matched(
-                        root_dir,
-                        pathname,
-                        control_data['ignored_file_pats']):
+                if ignored:
                     self.logger.info(f'F IGNORED: {pathname}')
                     control_data['counts']['ignored'] += 1
                     continue
-                results.append(self.visit_element(control_data, pathname, stats))
+                callback(control_data, pathname, stats, results, relname)
             else:
-                results.append(self.visit_element(control_data, pathname, stats))
-            dtutils.flush_debug_queue(control_data['debug_queue'], logging.getLogger('worker'))
+                callback(control_data, pathname, stats, results, relname)
+        dtutils.flush_debug_queue(control_data['debug_queue'], logging.getLogger('worker'))
+
+    def _queue_element(self, control_data, element, stats, results, relname=None):
+        """ Start processing an element, then finish any earlier ones that are ready
+
+            Up to pipeline_depth files may be digesting at once; elements are
+            always finished (and written out) in walk order.
+        """
+        (elem_data, future) = self._prepare_element(control_data, element, stats, relname)
+        inflight = future is not None and not future.done()
+        if inflight:
+            self.inflight += 1
+            dtdigester.poll_files(control_data)
+        self.pending.append((element, elem_data, future, inflight))
+        self._complete_elements(control_data, results, control_data['pipeline_depth'])
+
+    def _complete_elements(self, control_data, results, max_inflight):
+        """ Finish queued elements in walk order
+            Waits on the oldest digest while max_inflight or more are outstanding
+        """
+        while self.pending:
+            (element, elem_data, future, inflight) = self.pending[0]
+            if future is not None and not future.done() and self.inflight < max_inflight:
+                break
+            self.pending.popleft()
+            if inflight:
+                self.inflight -= 1
+            results.append(self._finish_element(control_data, element, elem_data, future))
 
     def visit_element(self, control_data, element, stats):
         """ Stat / digest a specific element found during the directory walk """
-        root_dir = control_data['root_dir']
+        (elem_data, future) = self._prepare_element(control_data, element, stats)
+        return self._finish_element(control_data, element, elem_data, future)
+
+    def _prepare_element(self, control_data, element, stats, relname=None):
+        """ Collect an element's stats and start digesting it if needed
+            Returns the element data and a Future for its digests (or None)
+        """
         elem_data = {}
-        relname = dtutils.get_relative_path(control_data['root_dir'], dtutils.unixify_path(element))
-        self.logger.debug("Processing element {}".format(relname))
+        if relname is None:
+            relname = dtutils.get_relative_path(control_data['root_dir'], dtutils.unixify_path(element))
+        self.logger.debug('Processing element %s', relname)
 
-        elem_data['name'] = dtutils.get_relative_path(root_dir, dtutils.unixify_path(element))
+        elem_data['name'] = relname
         elem_data['mode'] = stats.st_mode
         if sys.platform == 'win32':
             elem_data['mode_w'] = self.get_win_filemode(element)
@@ -281,30 +558,24 @@ class Walker(object):
         elem_data['ctime'] = stats[stat.ST_CTIME]
         elem_data['digests'] = None
         elem_data['type'] = '?'
-        alt_digest_len = 1
-        if control_data['altfile_digest']:
-            alt_digest_len = dtdigester.DIGEST_FUNCTIONS[control_data['altfile_digest']]['len']
 
         if sys.platform == 'win32' and self.is_win_symlink(element):
             elem_data['type'] = 'J'
-            alt_digest = 'x' * alt_digest_len
-            sorted_digests = dtdigester.fill_digest_str(control_data, 'x')
         elif stat.S_ISDIR(stats.st_mode):
             elem_data['type'] = 'D'
             elem_data['size'] = 0
-            alt_digest = '-' * alt_digest_len
-            sorted_digests = dtdigester.fill_digest_str(control_data, '-')
             control_data['counts']['dirs'] += 1
         elif stat.S_ISREG(stats.st_mode):
             elem_data['type'] = 'F'
         else:
             elem_data['type'] = '?'
-            sorted_digests = dtdigester.fill_digest_str(control_data, '?')
 
         SAME_METADATA = False
-        if relname in control_data['update_elements']:
-            self.logger.debug("Found existing element {}".format(relname))
-            existing = control_data['update_elements'][relname]
+        existing = None
+        if control_data['update_report']:
+            existing = control_data['update_report'].seek(relname)
+        if existing:
+            self.logger.debug('Found existing element %s', relname)
             if (
                 (elem_data['type'] == existing['type']) and
                 (elem_data['size'] == int(existing['size'], 16)) and
@@ -312,53 +583,94 @@ class Walker(object):
                 (elem_data['mtime'] == int(existing['mtime'], 16))
                ):
                 SAME_METADATA = True
-                self.logger.debug("SAME_METADATA {}".format(relname))
+                self.logger.debug('SAME_METADATA %s', relname)
 
+        future = None
         if elem_data['type'] == 'F':
             if SAME_METADATA:
                 elem_data['digests'] = existing['digests']
+            elif control_data['digest_cache']:
+                elem_data['cache_key'] = dtcache.cache_key(stats)
+                elem_data['digests'] = control_data['digest_cache'].lookup(
+                    elem_data['cache_key'], control_data['selected_digests'])
+                if elem_data['digests']:
+                    control_data['counts']['cache_hits'] += 1
+                else:
+                    future = dtdigester.submit_file(control_data, element, elem_data['size'])
             else:
-                elem_data['digests'] = dtdigester.digest_file(control_data, element)
+                future = dtdigester.submit_file(control_data, element, elem_data['size'])
+        return (elem_data, future)
 
+    def _finish_element(self, control_data, element, elem_data, future):
+        """ Wait for an element's digests (if any) and write out its report lines """
+        alt_digest_len = 1
+        if control_data['altfile_digest']:
+            alt_digest_len = dtdigester.DIGEST_FUNCTIONS[control_data['altfile_digest']]['len']
+
+        fill_char = None
+        if elem_data['type'] == 'J':
+            fill_char = 'x'
+        elif elem_data['type'] == 'D':
+            fill_char = '-'
+        elif elem_data['type'] == 'F':
+            if future is not None:
+                start_time = dtutils.curr_time_secs()
+                elem_data['digests'] = dtdigester.wait_file(control_data, future)
+                dtutils.add_stage_time(
+                    control_data['stage_times'], 'wait.digests', dtutils.curr_time_secs() - start_time)
+                if control_data['digest_cache']:
+                    control_data['digest_cache'].store(elem_data['cache_key'], elem_data['digests'])
+            if control_data['progress']:
+                control_data['progress'].add(elem_data['size'], reused=future is None)
             if elem_data['digests']:
                 control_data['counts']['files'] += 1
-                sorted_digests = '{' + ', '.join('{}: {}'.format(
-                    i, elem_data['digests'][i]) for i in sorted(
-                        elem_data['digests'])) + '}'
-                if control_data['altfile_digest']:
-                    alt_digest = elem_data['digests'][control_data['altfile_digest']]
             else:
                 self.logger.warning('F Problems processing %s', element)
                 control_data['counts']['errors'] += 1
-                sorted_digests = dtdigester.fill_digest_str(control_data, '!')
-                alt_digest = '!' * alt_digest_len
+                fill_char = '!'
+        else:
+            fill_char = '?'
+        if fill_char:
+            sorted_digests = dtdigester.fill_digest_str(control_data, fill_char)
+        else:
+            sorted_digests = '{' + ', '.join('{}: {}'.format(
+                i, elem_data['digests'][i]) for i in sorted(
+                    elem_data['digests'])) + '}'
 
-        file_details = '{};{};{:08x};{:08x};{:08x};{:04x};{:04x};{:010x};{}'.format(
+        file_details = dtwriter.ELEMENT_LINE(
             elem_data['type'],
             sorted_digests,
             elem_data['atime'], elem_data['mtime'], elem_data['ctime'],
             elem_data['mode'], elem_data['mode_w'],
             elem_data['size'],
             elem_data['name'])
-        alt_digest = '-' * alt_digest_len
-        if elem_data['type'] == 'D':
-            alt_digest = '-' * alt_digest_len
-        elif not elem_data['digests']:
-            alt_digest = '?' * alt_digest_len
-        elif control_data['altfile_digest']:
-            alt_digest = elem_data['digests'][control_data['altfile_digest']]
-        alt_details = '{};{:08x};{:08x};{:08x};{:04x};{:010x};{}'.format(
-            alt_digest,
-            elem_data['atime'], elem_data['mtime'], elem_data['ctime'],
-            elem_data['mode_w'],
-            elem_data['size'],
-            elem_data['name'])
-        self.logger.debug('%s', file_details)
-        dtutils.outfile_write(control_data['outfile_name'], 'a', [
-            '{}'.format(file_details),
-        ])
+        if self.debug:
+            self.logger.debug('%s', file_details.rstrip())
+        # Directory lines get their digests patched in once their contents are done
+        control_data['report_writer'].write(file_details, mark=elem_data['name'] if elem_data['type'] == 'D' else None)
+        thdx_row = None
+        if control_data['thdx_writer']:
+            thdx_row = control_data['thdx_writer'].write(
+                elem_data['type'],
+                elem_data['digests'],
+                elem_data['atime'], elem_data['mtime'], elem_data['ctime'],
+                elem_data['mode'], elem_data['mode_w'],
+                elem_data['size'],
+                elem_data['name'],
+                fill_char)
         if control_data['altfile_digest']:
-            dtutils.outfile_write(control_data['altfile_name'], 'a', [
-                '{}'.format(alt_details),
-            ])
+            if elem_data['type'] == 'D':
+                alt_digest = '-' * alt_digest_len
+            elif not elem_data['digests']:
+                alt_digest = '?' * alt_digest_len
+            else:
+                alt_digest = elem_data['digests'][control_data['altfile_digest']]
+            control_data['alt_writer'].write(dtwriter.ALT_LINE(
+                alt_digest,
+                elem_data['atime'], elem_data['mtime'], elem_data['ctime'],
+                elem_data['mode_w'],
+                elem_data['size'],
+                elem_data['name']))
+        if self.dir_stack:
+            self._roll_up(control_data, elem_data, fill_char, thdx_row)
         return elem_data
@@ -21,9 +21,11 @@
 """
 
 import logging  # For constants - do not log directly from here
+import multiprocessing
 import os
 import queue
 
+import dirtreedigest.treehash as dttreehash
 import dirtreedigest.utils as dtutils
 
 if dtutils.shared_memory_available():
@@ -32,81 +34,136 @@ else:
     shared_memory = None
 
 
-def worker_process(debug_queue, cmd_queue, results_queue, shm_mode):
+def worker_process(debug_queue, cmd_queue, results_queue, buffer_sems, shm_mode,
+                   digests, log_level=logging.INFO, leaf_threads=None):
     """ This is run as a subprocess, potentially with spawn()
         be careful with vars!
+
+        digests is a list of (digest_index, digest_func): a worker may run
+        several cheap digests, one after another over each block.
+        Debug messages are only built and sent when log_level enables them;
+        per-block activity is tallied in counters reported once, at quit.
+        Shared memory blocks are handed back by releasing the buffer's
+        semaphore, so the only results sent are one per digest per file.
+        The counters go back as stage times as well: hashing under each
+        digest's name, and waiting for commands as wait.worker. Each
+        result carries the time the worker spent hashing that file, for
+        block sizing. The reader names the segment behind each shared
+        memory block, as it resizes its buffers: a slot is reattached
+        when its name changes. Tree digests hash their leaves on
+        leaf_threads threads, the worker's share of the cores.
     """
+    dttreehash.set_leaf_threads(leaf_threads)
     pid = os.getpid()
-    digest_name = 'None'
+    debug = log_level <= logging.DEBUG
+    start_wall = dtutils.curr_time_secs()
+    start_cpu = dtutils.cpu_time_secs()
+    counters = {
+        'blocks': 0,
+        'bytes': 0,
+        'files': 0,
+        'messages': 0,
+        'commands': 0,
+        'wait_time': 0.0,
+        'hash_time': 0.0,
+    }
+    digest_names = [digest_func().name if digest_func else 'None' for (_, digest_func) in digests]
+    digest_name = ','.join(digest_names)
+    hash_times = [0.0] * len(digests)
+    digest_instances = []
+    file_id = None
+    file_hash_time = 0.0
     buf_refs = {}
     while True:
         try:
+            wait_start = dtutils.curr_time_secs()
             try:
                 cqi = cmd_queue.get()
-                cmd = cqi.get('cmd', None)
+                cmd = cqi[0]
             except queue.Empty:
                 cmd = None
+            counters['wait_time'] += dtutils.curr_time_secs() - wait_start
+            counters['commands'] += 1
             if cmd == dtutils.Cmd.INIT:
-                digest_func = cqi.get('digest_func', None)
-                if digest_func:
-                    digest_instance = digest_func()
-                    digest_name = digest_instance.name
+                file_id = cqi[1]
+                file_hash_time = 0.0
+                if all(digest_func for (_, digest_func) in digests):
+                    digest_instances = [digest_func() for (_, digest_func) in digests]
                 else:
-                    digest_name = 'None'
                     debug_queue.put((
                         logging.ERROR,
                         'worker_process({}) init -- pid={} Missing constructor'.format(
                             digest_name, pid)))
-                debug_queue.put((
-                    logging.DEBUG,
-                    'worker_process({}) init -- pid={}'.format(
-                        digest_name, pid)))
+                if debug:
+                    debug_queue.put((
+                        logging.DEBUG,
+                        'worker_process({}) init -- pid={}'.format(
+                            digest_name, pid)))
+                counters['files'] += 1
                 cmd_queue.task_done()
             elif cmd == dtutils.Cmd.PROCESS:
-                block_size = cqi.get('block_size', None)
-                buf_name = cqi.get('buf_name', None)
+                (_, buf_index, block_size, byte_block) = cqi
                 if shm_mode:
-                    if block_size > 0:
-                        if buf_name not in buf_refs:
-                            buf_refs[buf_name] = shared_memory.SharedMemory(buf_name)
-                        buf = buf_refs[buf_name]
-                        byte_block = buf.buf[:block_size]
+                    buf_ref = buf_refs.get(buf_index)
+                    if buf_ref is None or buf_ref.name != byte_block:
+                        if buf_ref is not None:
+                            buf_ref.close()
+                        buf_ref = buf_refs[buf_index] = shared_memory.SharedMemory(byte_block)
+                    byte_block = buf_ref.buf[:block_size]
+                    if debug:
                         debug_queue.put((
                             logging.DEBUG,
                             'worker_process() reading shared memory -- pid={} l={} c={} d={}'.format(
                                 pid, block_size, byte_block[0], digest_name)))
-                    else:
-                        byte_block = b''
-                else:
-                    byte_block = cqi.get('buf_block', None)
-                digest_instance.update(byte_block)
+                for (i, digest_instance) in enumerate(digest_instances):
+                    hash_start = dtutils.curr_time_secs()
+                    digest_instance.update(byte_block)
+                    hash_time = dtutils.curr_time_secs() - hash_start
+                    hash_times[i] += hash_time
+                    file_hash_time += hash_time
+                counters['blocks'] += 1
+                counters['bytes'] += block_size
                 if shm_mode:
                     del(byte_block)  # Otherwise shared_memory spews `BufferError: cannot close exported pointers exist`
-                debug_queue.put((
-                    logging.DEBUG,
-                    'worker_process() process -- pid={} buf_name={} l={} d={}'.format(
-                        pid, buf_name, block_size, digest_instance.hexdigest())))
-                results_queue.put({
-                    'msg': '{} processed'.format(digest_name),
-                })
+                    if buf_index is not None:  # Else it's the reader's shared zeros, for a hole
+                        buffer_sems[buf_index].release()
+                if debug:
+                    debug_queue.put((
+                        logging.DEBUG,
+                        'worker_process() process -- pid={} buf_index={} l={} d={}'.format(
+                            pid, buf_index, block_size,
+                            ','.join(digest_instance.hexdigest() for digest_instance in digest_instances))))
                 cmd_queue.task_done()
             elif cmd == dtutils.Cmd.RESULT:
-                debug_queue.put((
-                    logging.DEBUG,
-                    'worker_process({}) result -- pid={} digest={}'.format(
-                        digest_name, pid, digest_instance.hexdigest())))
-                results_queue.put({
-                    'digest_name': digest_name,
-                    'digest_value': digest_instance.hexdigest(),
-                })
+                for ((digest_index, _), digest_instance) in zip(digests, digest_instances):
+                    digest_value = digest_instance.hexdigest()
+                    if debug:
+                        debug_queue.put((
+                            logging.DEBUG,
+                            'worker_process({}) result -- pid={} digest={}'.format(
+                                digest_instance.name, pid, digest_value)))
+                    results_queue.put((dtutils.Cmd.RESULT.value, file_id, digest_index, digest_value, file_hash_time))
+                    counters['messages'] += 1
                 cmd_queue.task_done()
             elif cmd == dtutils.Cmd.QUIT:
-                # for buf in buf_refs:
-                #     del(buf)
-                debug_queue.put((
-                    logging.DEBUG,
-                    'worker_process({}) quit -- pid={}'.format(
-                        digest_name, pid)))
+                for buf_ref in buf_refs.values():
+                    buf_ref.close()
+                counters['messages'] += 1  # The stats message itself
+                counters['hash_time'] = sum(hash_times)
+                stats = dtutils.cpu_stats(start_wall, start_cpu)
+                stats.update(counters)
+                stats['proc'] = multiprocessing.current_process().name
+                stats['digest'] = digest_name
+                stats['stage_times'] = {
+                    f'hash.{name}': [hash_time, counters['blocks']]
+                    for (name, hash_time) in zip(digest_names, hash_times)}
+                stats['stage_times']['wait.worker'] = [counters['wait_time'], counters['commands']]
+                if debug:
+                    debug_queue.put((
+                        logging.DEBUG,
+                        'worker_process({}) quit -- pid={}'.format(
+                            digest_name, pid)))
+                results_queue.put((dtutils.Cmd.QUIT.value, stats))
                 cmd_queue.task_done()
                 break
             else:
@@ -0,0 +1,226 @@
+"""
+
+    Copyright (c) 2017-2021 Martin F. Falatic
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+"""
+
+import logging
+import os
+import queue
+import threading
+
+import dirtreedigest.digester as dtdigester
+import dirtreedigest.utils as dtutils
+
+# Pre-bound line templates (the report is opened in binary mode, so supply the platform line ending)
+ELEMENT_LINE = ('{};{};{:08x};{:08x};{:08x};{:04x};{:04x};{:010x};{}' + os.linesep).format
+ALT_LINE = ('{};{:08x};{:08x};{:08x};{:04x};{:010x};{}' + os.linesep).format
+
+FSYNC_POLICIES = ['none', 'flush', 'close']
+
+REPORT_COLUMNS = '#         Digests               |accessT |modifyT |createT |attr|watr|   size   |relative name'
+ALT_COLUMNS = '#        {} signature          |accessT |modifyT |createT |watr|   size   |relative name'
+
+
+def header_lines(basepath, columns=REPORT_COLUMNS):
+    """ Comment lines that start a report """
+    return [
+        '#{}'.format('-' * 78),
+        '#',
+        '#  Base path: {}'.format(basepath),
+        '#',
+        '#{}'.format('-' * 78),
+        columns,
+        '#{}'.format('-' * 78),
+        '',
+    ]
+
+
+def summary_line(counts):
+    """ One-line account of a run, as recorded in a report's footer """
+    return 'Processed: {:,d} file(s), {:,d} folder(s) ({:,d} ignored, {:,d} errors) comprising {:,d} bytes'.format(
+        counts['files'],
+        counts['dirs'],
+        counts['ignored'],
+        counts['errors'],
+        counts['bytes_read'],
+    )
+
+
+def footer_lines(summary, tree_digests=None, stage_lines=None):
+    """ Comment lines that end a report """
+    lines = [
+        '',
+        '#{}'.format('-' * 78),
+        '#',
+    ]
+    if tree_digests:
+        lines.append('#  Tree digests: {}'.format(dtdigester.digest_str(tree_digests)))
+    lines += [
+        '#  {}'.format(summary),
+        '#',
+    ]
+    if stage_lines:
+        lines.append('#  Stage times:')
+        lines += ['#    {}'.format(line) for line in stage_lines]
+        lines.append('#')
+    return lines + [
+        '#{}'.format('-' * 78),
+    ]
+
+
+class ReportWriter(object):
+    """ Appends report lines to an open file from a background thread
+
+        Lines are batched on the caller's side and handed over a batch at a
+        time; the thread writes them through a large file buffer and flushes
+        every flush_secs, optionally with an fsync. The caller never waits on
+        output I/O unless the hand-off queue fills up.
+
+        A line written with a mark can later be patched with text of the same
+        length (e.g., a directory's digests once its contents are done): in
+        the caller's batch if it's still there, else in the file, through
+        a second handle that's synced along with the first.
+    """
+
+    def __init__(self, filename, buffer_size=1024 * 1024, flush_secs=5.0, fsync='none', batch_lines=1024):
+        self.logger = logging.getLogger('writer')
+        self.filename = filename
+        self.flush_secs = flush_secs
+        self.fsync = fsync
+        self.batch_lines = batch_lines
+        self.batch = []
+        self.batch_marks = {}  # Index in batch: mark
+        self.marks = {}  # Mark: (batch, index)
+        self.patches = []
+        self.batch_time = dtutils.curr_time_secs()
+        self.error = None
+        self.fileh = open(filename, 'ab', buffering=buffer_size)
+        self.written = self.fileh.tell()  # Writer thread: bytes in the file, or on their way to it
+        self.flushed = self.written
+        self.offsets = {}  # Writer thread: mark: offset of its line
+        self.patch_fileh = None
+        self.patched = False  # Writer thread: patches made in the file since the last fsync
+        self.write_time = 0.0  # Writer thread: spent writing, patching and flushing
+        self.write_calls = 0
+        self.batches = queue.Queue(maxsize=64)
+        self.thread = threading.Thread(target=self._run, name='writer', daemon=True)
+        self.thread.start()
+
+    def write(self, line, mark=None):
+        """ Queue one formatted line (including its line ending), marked for patching if mark is given """
+        if mark is not None:
+            self.batch_marks[len(self.batch)] = mark
+            self.marks[mark] = (self.batch, len(self.batch))
+        self.batch.append(line)
+        if len(self.batch) >= self.batch_lines or (
+                dtutils.curr_time_secs() - self.batch_time >= self.flush_secs):
+            self._hand_off()
+
+    def patch(self, mark, start, text):
+        """ Overwrite a marked line from character start with text (ASCII, and not past the line's end) """
+        (batch, index) = self.marks.pop(mark)
+        if batch is self.batch:
+            line = batch[index]
+            batch[index] = line[:start] + text + line[start + len(text):]
+        else:
+            self.patches.append((mark, start, text))
+
+    def close(self):
+        """ Write out everything queued, stop the thread and close the file """
+        self._hand_off()
+        self.batches.put(None)
+        self.thread.join()
+        if self.error:
+            raise self.error
+
+    def _hand_off(self):
+        """ Pass the current batch (and patches to earlier ones) to the writer thread """
+        if self.batch or self.patches:
+            self.batches.put((self.batch, self.batch_marks, self.patches))
+            self.batch = []
+            self.batch_marks = {}
+            self.patches = []
+        self.batch_time = dtutils.curr_time_secs()
+
+    def _run(self):
+        """ Writer thread """
+        last_flush = dtutils.curr_time_secs()
+        closing = False
+        try:
+            while True:
+                try:
+                    batch = self.batches.get(timeout=self.flush_secs)
+                except queue.Empty:
+                    batch = []
+                if batch is None:
+                    closing = True
+                    break
+                if batch:
+                    self._write_batch(*batch)
+                if dtutils.curr_time_secs() - last_flush >= self.flush_secs:
+                    self._flush(self.fsync == 'flush')
+                    last_flush = dtutils.curr_time_secs()
+            self._flush(self.fsync != 'none')
+        except OSError as err:
+            self.error = err
+            self.logger.error('Problem writing "%s": %s', self.filename, err)
+            while not closing:  # Keep the caller from blocking on a full queue
+                closing = self.batches.get() is None
+        finally:
+            if self.patch_fileh:
+                self.patch_fileh.close()
+            self.fileh.close()
+
+    def _write_batch(self, batch, batch_marks, patches):
+        """ Writer thread: write lines, noting where marked ones start, then apply patches """
+        start_time = dtutils.curr_time_secs()
+        if batch_marks:
+            data = [line.encode('utf-8') for line in batch]
+            offset = self.written
+            for (index, line_data) in enumerate(data):
+                if index in batch_marks:
+                    self.offsets[batch_marks[index]] = offset
+                offset += len(line_data)
+            data = b''.join(data)
+        else:
+            data = ''.join(batch).encode('utf-8')
+        self.fileh.write(data)
+        self.written += len(data)
+        for (mark, start, text) in patches:
+            offset = self.offsets.pop(mark) + start
+            if offset + len(text) > self.flushed:
+                self.fileh.flush()
+                self.flushed = self.written
+            if not self.patch_fileh:
+                self.patch_fileh = open(self.filename, 'r+b', buffering=0)  # The report itself is append-only
+            self.patch_fileh.seek(offset)
+            self.patch_fileh.write(text.encode('ascii'))
+            self.patched = True
+        self.write_time += dtutils.curr_time_secs() - start_time
+        self.write_calls += 1
+
+    def _flush(self, sync):
+        """ Push buffered data to the OS, and optionally to disk """
+        start_time = dtutils.curr_time_secs()
+        self.fileh.flush()
+        self.flushed = self.written
+        if sync:
+            os.fsync(self.fileh.fileno())
+            if self.patched:  # Unbuffered, so already with the OS
+                os.fsync(self.patch_fileh.fileno())
+                self.patched = False
+        self.write_time += dtutils.curr_time_secs() - start_time
+        self.write_calls += 1